@@ -1,26 +1,60 @@
 import asyncio
 import bisect
 import collections
+import contextlib
 import copy
+import hashlib
 import logging
 import operator
+import os
+import pickle
+import shutil
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta
-from functools import partial
+from functools import lru_cache, partial
 from itertools import chain
 from operator import itemgetter
 from typing import Any
 
-from more_itertools import spy, take
 from numpy import (
+    arange,
     arccos,
+    argmin,
+    argsort,
+    array,
+    asarray,
+    bincount,
+    clip,
+    concatenate,
     cross,
+    cumsum,
     deg2rad,
     dot,
+    errstate,
+    floor,
+    indices,
+    inf,
+    lexsort,
+    linspace,
+    load,
+    maximum,
+    minimum,
+    ones,
+    power,
     rad2deg,
+    repeat,
+    save,
+    searchsorted,
+    setdiff1d,
     seterr,
+    sqrt,
+    take_along_axis,
+    tile,
+    unique,
+    where,
+    zeros,
 )
-from numpy.linalg import norm
 from nvector import (
     interpolate,
     lat_lon2n_E,
@@ -29,8 +63,15 @@ from nvector import (
     unit,
 )
 
-from trackers.base import cancel_and_wait_task, general_fut_done_callback, Observable, Tracker
+from trackers.base import (
+    DerivedPoint,
+    general_fut_done_callback,
+    KeyifyList,
+    Observable,
+    Tracker,
+)
 from trackers.contrib.dataclass_tools import add_slots
+from trackers.general import hash_packer
 
 logger = logging.getLogger(__name__)
 
@@ -45,6 +86,12 @@ class AnalyseTracker(Tracker):
                     track_break_dist=10000,
                     find_closest_cache=None,
                     processing_lock=None,
+                    bulk_min_points=10,
+                    analyse_pool=None,
+                    find_closest_quantum=None,
+                    checkpoint_every=100,
+                    state_path=None,
+                    save_state_interval=timedelta(minutes=5),
                     ):
         self = cls('analysed.{}'.format(org_tracker.name))
         self.org_tracker = org_tracker
@@ -52,7 +99,24 @@ class AnalyseTracker(Tracker):
         self.routes = routes
         self.track_break_time = track_break_time
         self.track_break_dist = track_break_dist
-        if find_closest_cache:
+        self.bulk_min_points = bulk_min_points
+        self.analyse_pool = analyse_pool
+        self.find_closest_quantum = find_closest_quantum
+        self.checkpoint_every = checkpoint_every
+        # If state_path, the state is saved to it every save_state_interval, as points are analysed, so that not much
+        # analysis is lost if the process is killed.
+        self.state_path = state_path
+        self.save_state_interval = save_state_interval
+        self.save_state_lock = asyncio.Lock()
+        self.save_state_fut = None
+        self.state_saved_time = datetime.now()
+        if find_closest_cache and find_closest_quantum:
+            # The cache only holds the candidate point pairs for positions snapped to find_closest_quantum. The travel
+            # window and the projection of the point onto the candidates are always done with the exact inputs.
+            find_closest_cache.func = partial(find_closest_point_pair_routes_candidates, routes, find_closest_quantum)
+            find_closest_cache.key = find_closest_point_pair_routes_candidates_cache_key
+            self.find_closest = partial(find_closest_point_pair_routes_quantized, find_closest_cache, find_closest_quantum)
+        elif find_closest_cache:
             find_closest_cache.func = find_closest_point_pair_routes
             find_closest_cache.key = find_closest_point_pair_routes_cache_key
             find_closest_cache.unpack = partial(find_closest_point_pair_routes_unpack, routes)
@@ -62,6 +126,7 @@ class AnalyseTracker(Tracker):
             self.find_closest = find_closest_point_pair_routes
 
         self.processing_lock = processing_lock if processing_lock else asyncio.Lock()
+        self.analysing = False
 
         self.completed = asyncio.ensure_future(self._completed())
 
@@ -72,10 +137,15 @@ class AnalyseTracker(Tracker):
         self.reset()
         self.do_est_finish_fut = None
 
-        self.process_initial_points_fut = asyncio.ensure_future(self.on_new_points(self.org_tracker, self.org_tracker.points))
+        initial_points = self.org_tracker.points
+        if state_path and await self.load_state(state_path):
+            initial_points = initial_points[self.analysed_count:]
+
+        self.process_initial_points_fut = asyncio.ensure_future(self.on_new_points(self.org_tracker, initial_points))
         self.process_initial_points_fut.add_done_callback(general_fut_done_callback)
         self.org_tracker.new_points_observable.subscribe(self.on_new_points)
         self.org_tracker.reset_points_observable.subscribe(self.on_reset_points)
+        self.org_tracker.rewind_points_observable.subscribe(self.on_rewind_points)
 
         return self
 
@@ -100,6 +170,30 @@ class AnalyseTracker(Tracker):
         self.prev_route_dist_time = None
         self.prev_on_route = None
 
+        self.analysed_count = 0
+        self.checkpoints = [self.get_checkpoint(0, 0, 0)]
+
+    # The state that analysing a point depends on, and changes.
+    state_attrs = (
+        'current_track_id', 'off_route_track_id', 'pre_post_track_id', 'finished', 'going_forward', 'total_dist',
+        'is_off_route', 'pre_post', 'prev_point_with_position', 'prev_point_with_position_point',
+        'non_prepost_prev_point_with_position', 'prev_closest', 'prev_route_dist', 'prev_route_dist_time',
+        'prev_on_route',
+    )
+
+    def get_checkpoint(self, pending_points, pending_off_route_points, pending_pre_post_points):
+        """
+        Returns a checkpoint of the state after analysing analysed_count org points, so that on_rewind_points can
+        resume from it. The pending_* args are the number of points analysed, but not yet added to the trackers.
+        """
+        return analyse_checkpoint(
+            self.analysed_count,
+            len(self.points) + pending_points,
+            len(self.off_route_tracker.points) + pending_off_route_points,
+            len(self.pre_post_tracker.points) + pending_pre_post_points,
+            {attr: getattr(self, attr) for attr in self.state_attrs},
+        )
+
     def stop(self):
         self.process_initial_points_fut.cancel()
         if self.do_est_finish_fut:
@@ -117,21 +211,159 @@ class AnalyseTracker(Tracker):
                     await self.do_est_finish_fut
                 except asyncio.CancelledError:
                     pass
+            if self.save_state_fut:
+                await self.save_state_fut
 
-    async def on_reset_points(self, tracker):
+    @contextlib.asynccontextmanager
+    async def analysing_lock(self):
+        """Acquire the processing lock, and mark that the analyse state is being changed."""
         async with self.processing_lock:
+            self.analysing = True
+            try:
+                yield
+            finally:
+                self.analysing = False
+
+    def state_key(self):
+        return analyse_state_version, self.analyse_start_time, self.track_break_time, self.track_break_dist, self.find_closest_quantum
+
+    def get_state(self):
+        """
+        Returns the org points that the state is for, and the state to save. The points and state are copied, so that
+        they can be written while analysis continues.
+        """
+        if self.analysing:
+            # The state is part way through a batch, and some analysed points may not be added to the trackers yet,
+            # so use the last checkpoint that has all its points added.
+            trackers_lens = (len(self.points), len(self.off_route_tracker.points), len(self.pre_post_tracker.points))
+            checkpoint = next(
+                checkpoint for checkpoint in reversed(self.checkpoints)
+                if all(checkpoint_len <= tracker_len for checkpoint_len, tracker_len in zip(
+                    (checkpoint.points_len, checkpoint.off_route_points_len, checkpoint.pre_post_points_len), trackers_lens))
+            )
+        else:
+            checkpoint = self.get_checkpoint(0, 0, 0)
+        data = {
+            'key': self.state_key(),
+            'checkpoint': checkpoint,
+            'points': self.points[:checkpoint.points_len],
+            'off_route_points': self.off_route_tracker.points[:checkpoint.off_route_points_len],
+            'pre_post_points': self.pre_post_tracker.points[:checkpoint.pre_post_points_len],
+        }
+        return self.org_tracker.points[:checkpoint.org_index], data
+
+    async def save_state(self, path=None):
+        """
+        Save the analysed points and the analyse state to path (default state_path), so that when the tracker is
+        started again, with the same org points, analysis resumes from where it is now, rather than from the start.
+        Routes are saved as their index, so the routes must be the same when loading. (Include the routes hash in
+        path.) The state is written in an executor, so that it does not block the event loop.
+        """
+        path = path or self.state_path
+        async with self.save_state_lock:
+            org_points, data = self.get_state()
+            try:
+                await asyncio.get_event_loop().run_in_executor(None, write_analyse_state, path, self.routes, org_points, data)
+            except Exception:
+                self.logger.exception('Error saving analyse state: ')
+            else:
+                self.logger.info(f'Saved analyse state after {data["checkpoint"].org_index} points.')
+            self.state_saved_time = datetime.now()
+
+    def save_state_if_due(self):
+        if (
+            self.state_path and not self.save_state_lock.locked() and
+            datetime.now() - self.state_saved_time >= self.save_state_interval
+        ):
+            self.save_state_fut = asyncio.ensure_future(self.save_state())
+            self.save_state_fut.add_done_callback(general_fut_done_callback)
+
+    async def load_state(self, path):
+        """
+        Load the state saved by save_state, if it matches this tracker's settings and org points. Returns True if it
+        was loaded.
+        """
+        try:
+            with open(path, 'rb') as f:
+                data = AnalyseStateUnpickler(f, self.routes).load()
+        except FileNotFoundError:
+            return False
+        except Exception:
+            self.logger.exception('Error loading analyse state: ')
+            return False
+
+        checkpoint = data['checkpoint']
+        if (
+            data['key'] != self.state_key() or
+            len(self.org_tracker.points) < checkpoint.org_index or
+            points_hash(self.org_tracker.points[:checkpoint.org_index]) != data['org_points_hash']
+        ):
+            self.logger.info('Saved analyse state does not match points or settings. Not using.')
+            return False
+
+        await self.new_points(data['points'])
+        await self.off_route_tracker.new_points(data['off_route_points'])
+        await self.pre_post_tracker.new_points(data['pre_post_points'])
+        for attr, value in checkpoint.state.items():
+            setattr(self, attr, value)
+        self.analysed_count = checkpoint.org_index
+        # Rewinds to before this need to start from the beginning.
+        self.checkpoints = [checkpoint]
+        self.logger.info(f'Loaded analyse state after {checkpoint.org_index} points.')
+        return True
+
+    async def on_reset_points(self, tracker):
+        async with self.analysing_lock():
             await self.reset_points()
             await self.off_route_tracker.reset_points()
             await self.pre_post_tracker.reset_points()
             self.reset()
 
+    async def on_rewind_points(self, tracker, index):
+        async with self.analysing_lock():
+            if self.do_est_finish_fut:
+                self.do_est_finish_fut.cancel()
+                self.do_est_finish_fut = None
+
+            # Resume from the last checkpoint at or before index.
+            checkpoint_i = bisect.bisect_right(KeyifyList(self.checkpoints, operator.attrgetter('org_index')), index) - 1
+            if checkpoint_i >= 0:
+                checkpoint = self.checkpoints[checkpoint_i]
+                del self.checkpoints[checkpoint_i + 1:]
+                self.logger.debug(f'Rewind to {index}. Resuming from checkpoint at {checkpoint.org_index}.')
+
+                trackers_lens = (
+                    (self, checkpoint.points_len),
+                    (self.off_route_tracker, checkpoint.off_route_points_len),
+                    (self.pre_post_tracker, checkpoint.pre_post_points_len),
+                )
+                for sub_tracker, points_len in trackers_lens:
+                    if len(sub_tracker.points) > points_len:
+                        await sub_tracker.rewind_points(points_len)
+
+                for attr, value in checkpoint.state.items():
+                    setattr(self, attr, value)
+                self.analysed_count = checkpoint.org_index
+                reanalyse_points = tracker.points[checkpoint.org_index:index]
+
+        if checkpoint_i < 0:
+            # Only when the state was loaded from after index (see load_state). Start again from the beginning.
+            await self.on_reset_points(tracker)
+            reanalyse_points = tracker.points
+
+        await self.on_new_points(tracker, reanalyse_points)
+
     async def on_new_points(self, tracker, new_points):
         self.logger.debug(
             'analyse_tracker_new_points ({} points)'.format(len(new_points)))
         if self.do_est_finish_fut:
-            cancel_and_wait_task(self.do_est_finish_fut)
+            self.do_est_finish_fut.cancel()
 
-        async with self.processing_lock:
+        # Submitted before waiting for the processing lock, so that the pool can work on many riders at once.
+        pool_closests_fut = self.submit_pool_closests(new_points)
+
+        async with self.analysing_lock():
+            pool_closests = await pool_closests_fut if pool_closests_fut else None
             new_new_points = []
             new_off_route_points = []
             new_pre_post_points = []
@@ -159,11 +391,11 @@ class AnalyseTracker(Tracker):
             last_point_i = len(new_points) - 1
             did_slow_log = False
 
-            for i, point in enumerate(new_points):
-                point = copy.deepcopy(point)
+            for i, (point, precalc) in enumerate(zip(new_points, self.iter_points_precalc(new_points, pool_closests))):
+                point = DerivedPoint(point)
                 self.pre_post = pre_post = self.finished or (self.analyse_start_time and self.analyse_start_time > point['time'])
                 if 'position' in point:
-                    point_point = Point(*point['position'][:2])
+                    point_point = precalc.point_point if precalc else Point(*point['position'][:2])
 
                     if not pre_post:
                         if self.prev_route_dist_time:
@@ -178,7 +410,8 @@ class AnalyseTracker(Tracker):
                         closest = self.find_closest(
                             self.routes, point_point, 5000,
                             self.prev_closest.route_i if self.prev_closest else None,
-                            250, self.prev_route_dist or 0, max_travel_dist)
+                            250, self.prev_route_dist or 0, max_travel_dist,
+                            precalc=precalc.closest if precalc else None)
                         if closest and closest.dist > 100000:
                             closest = None
                     else:
@@ -228,7 +461,10 @@ class AnalyseTracker(Tracker):
                         dist_from_last = route_dist
                     elif self.prev_point_with_position:
                         # as the crow flys distance
-                        dist_from_last = distance(point_point, self.prev_point_with_position_point)
+                        if precalc and precalc.dist_from_prev is not None:
+                            dist_from_last = precalc.dist_from_prev
+                        else:
+                            dist_from_last = distance(point_point, self.prev_point_with_position_point)
                         time = time_from_last
 
                     if dist_from_last:
@@ -291,6 +527,11 @@ class AnalyseTracker(Tracker):
                     self.set_finished()
                     self.pre_post_track_id += 1
 
+                self.analysed_count += 1
+                if self.analysed_count % self.checkpoint_every == 0:
+                    self.checkpoints.append(self.get_checkpoint(
+                        len(new_new_points), len(new_off_route_points), len(new_pre_post_points)))
+
                 is_last_point = i == last_point_i
                 if i % 10 == 9 or is_last_point:
                     now = datetime.now()
@@ -307,23 +548,115 @@ class AnalyseTracker(Tracker):
 
             await submit_points()
 
+        self.save_state_if_due()
+
+    bulk_chunk_size = 500
+
+    def iter_points_precalc(self, new_points, pool_closests=None):
+        """
+        Yields a point_precalc, or None, for each point.
+
+        For bulk analysis (e.g. replaying a static event, or catching up after a reconnect,) the positions, as the
+        crow flies distances and route projections are calculated in vectorised form, a chunk of points at a time.
+        Chunks are calculated lazily, so that the state from the previous chunk is available.
+
+        pool_closests: Optional route projections for each point, from submit_pool_closests.
+        """
+        if len(new_points) < self.bulk_min_points:
+            for _ in new_points:
+                yield None
+            return
+
+        for chunk_start in range(0, len(new_points), self.bulk_chunk_size):
+            chunk_end = chunk_start + self.bulk_chunk_size
+            yield from self.get_points_precalc(
+                new_points[chunk_start: chunk_end], pool_closests[chunk_start: chunk_end] if pool_closests else None)
+
+    def submit_pool_closests(self, new_points):
+        """
+        If there is an analyse_pool, and enough points for bulk analysis, start calculating the route projections for
+        the points in the pool. Returns a future of a list with the route projections, or None, for each point.
+        """
+        if not self.analyse_pool or not self.routes or self.find_closest_quantum or len(new_points) < self.bulk_min_points:
+            return None
+
+        needs_closest = [
+            'position' in point and not (self.analyse_start_time and self.analyse_start_time > point['time'])
+            for point in new_points
+        ]
+        nv_rows, pv_rows = points_nv_pv_rows([point for point, point_needs_closest in zip(new_points, needs_closest) if point_needs_closest])
+
+        async def get_closests():
+            closests = iter(await self.analyse_pool.find_closest_point_pair_routes_batch(nv_rows, pv_rows))
+            return [next(closests) if point_needs_closest else None for point_needs_closest in needs_closest]
+
+        return asyncio.ensure_future(get_closests())
+
+    def get_points_precalc(self, points, pool_closests=None):
+        with_position = [point for point in points if 'position' in point]
+        if not with_position:
+            return [None] * len(points)
+
+        nv_rows, pv_rows = points_nv_pv_rows(with_position)
+
+        point_points = []
+        for point, point_nv, point_pv in zip(with_position, nv_rows, pv_rows):
+            point_point = Point(*point['position'][:2])
+            point_point._nv = point_nv.reshape((3, 1))
+            point_point._pv = point_pv.reshape((3, 1))
+            point_points.append(point_point)
+
+        dists_from_prev = list(rows_norm(pv_rows[1:] - pv_rows[:-1]))
+        if self.prev_point_with_position_point:
+            dists_from_prev.insert(0, distance(point_points[0], self.prev_point_with_position_point))
+        else:
+            dists_from_prev.insert(0, None)
+
+        if pool_closests:
+            needs_closest = [closest is not None for point, closest in zip(points, pool_closests) if 'position' in point]
+            closests = (closest for closest in pool_closests if closest is not None)
+        else:
+            # With find_closest_quantum, find_closest uses candidates from the cache rather than the precalc.
+            needs_closest = array([
+                not self.find_closest_quantum and not self.finished and
+                not (self.analyse_start_time and self.analyse_start_time > point['time'])
+                for point in with_position
+            ], dtype=bool)
+            closests = iter(find_closest_point_pair_routes_batch(self.routes, nv_rows[needs_closest], pv_rows[needs_closest]))
+
+        with_position_precalc = iter([
+            point_precalc(point_point, next(closests) if point_needs_closest else None, dist_from_prev)
+            for point_point, point_needs_closest, dist_from_prev in zip(point_points, needs_closest, dists_from_prev)
+        ])
+        return [next(with_position_precalc) if 'position' in point else None for point in points]
+
     async def do_est_finish(self, time):
         delay = (time - datetime.now() + timedelta(minutes=5)).total_seconds()
         if delay > 0:
             await asyncio.sleep(delay)
-        self.set_finished()
-        point = {
-            'finished_time': time,
-            'time': time,
-            'rider_status': 'Finished',
-        }
-        await self.new_points([point])
+        # With the processing lock, so that the point is not added in the middle of on_new_points's points, which
+        # would throw out the checkpoints.
+        async with self.processing_lock:
+            self.set_finished()
+            point = {
+                'finished_time': time,
+                'time': time,
+                'rider_status': 'Finished',
+            }
+            await self.new_points([point])
 
     def set_finished(self):
         super().set_finished()
         self.org_tracker.set_finished()
 
     def get_predicted_position(self, time):
+        return get_predicted_positions((self, ), time)[0]
+
+    def get_predicted_position_or_along_route(self, time):
+        """
+        Returns the predicted position, or if the rider is predicted to follow the route, a predicted_along_route,
+        for get_predicted_positions to work out the position of.
+        """
         # TODO if time > a position received - then interpolate between those positions.
         pp = self.non_prepost_prev_point_with_position
         closest = self.prev_closest
@@ -336,21 +669,8 @@ class AnalyseTracker(Tracker):
 
             # Predicted to follow route if they are on the route and going forward.
             dist_route = pp['dist_route'] + dist_moved_from_last
-            proceeding_route = list(chain(
-                (closest.point, ),
-                closest.route['points'][closest.point_pair[1].index:],
-            ))
             # TODO continue main route
-            point_point = move_along_route(proceeding_route, dist_moved_from_last)
-            point = {
-                'position': [point_point.lat, point_point.lng],
-                'dist_route': round(dist_route),
-                'time': time
-            }
-            if 'elevation' in closest.route:
-                point['route_elevation'] = round(route_elevation(closest.route, dist_route))
-
-            return point
+            return predicted_along_route(closest, dist_moved_from_last, dist_route, time)
 
         if pp:
             point = {
@@ -364,6 +684,138 @@ class AnalyseTracker(Tracker):
             return point
 
 
+predicted_along_route = collections.namedtuple('predicted_along_route', ('closest', 'dist_moved', 'dist_route', 'time'))
+
+
+def get_predicted_positions(analyse_trackers, time):
+    """
+    Returns the predicted position of each of analyse_trackers at time. For the riders predicted to follow a route,
+    the positions are found with one search of the route's points' distances, and one interpolation, per route.
+    """
+    predicted = [analyse_tracker.get_predicted_position_or_along_route(time) for analyse_tracker in analyse_trackers]
+    route_indexes = collections.defaultdict(list)
+    for i, item in enumerate(predicted):
+        if isinstance(item, predicted_along_route):
+            route_indexes[id(item.closest.route)].append(i)
+
+    for indexes in route_indexes.values():
+        along_route = [predicted[i] for i in indexes]
+        route = along_route[0].closest.route
+        positions = move_along_route_batch(
+            route, [(item.closest.point, item.closest.point_pair[1].index) for item in along_route],
+            [item.dist_moved for item in along_route])
+        for i, item, position in zip(indexes, along_route, positions):
+            point = {
+                'position': position,
+                'dist_route': round(item.dist_route),
+                'time': item.time,
+            }
+            if 'elevation' in route:
+                point['route_elevation'] = round(route_elevation(route, item.dist_route))
+            predicted[i] = point
+    return predicted
+
+
+# Increment when changes to analysis make saved states invalid.
+analyse_state_version = 1
+
+
+class AnalyseStatePickler(pickle.Pickler):
+    # Routes are big, and shared, so they are pickled as their index.
+
+    def __init__(self, file, routes):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.routes_i = {id(route): route_i for route_i, route in enumerate(routes)}
+
+    def persistent_id(self, obj):
+        if type(obj) is dict:
+            route_i = self.routes_i.get(id(obj))
+            if route_i is not None:
+                return 'route', route_i
+
+
+class AnalyseStateUnpickler(pickle.Unpickler):
+
+    def __init__(self, file, routes):
+        super().__init__(file)
+        self.routes = routes
+
+    def persistent_load(self, pid):
+        type_, route_i = pid
+        return self.routes[route_i]
+
+
+def write_analyse_state(path, routes, org_points, data):
+    data = dict(data, org_points_hash=points_hash(org_points))
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        AnalyseStatePickler(f, routes).dump(data)
+    os.replace(tmp_path, path)
+
+
+def points_hash(points):
+    pack = hash_packer().pack
+    hasher = hashlib.sha1()
+    for point in points:
+        hasher.update(pack(sorted(point.items())))
+    return hasher.digest()
+
+
+analyse_checkpoint = collections.namedtuple(
+    'analyse_checkpoint', ('org_index', 'points_len', 'off_route_points_len', 'pre_post_points_len', 'state'))
+
+
+point_precalc = collections.namedtuple('point_precalc', ('point_point', 'closest', 'dist_from_prev'))
+
+
+def points_nv_pv_rows(points):
+    """nv and pv of the positions of points, as (n, 3) arrays."""
+    nv = lat_lon2n_E(
+        deg2rad(array([point['position'][0] for point in points], dtype=float)),
+        deg2rad(array([point['position'][1] for point in points], dtype=float)),
+    )
+    return nv.T, n_EB_E2p_EB_E(nv).T
+
+
+class AnalyseProcessPool(object):
+    """
+    Calculates find_closest_point_pair_routes_batch for AnalyseTrackers in worker processes, so that bulk analysis of
+    many riders can use multiple cores.
+
+    routes_arrays_path: Routes saved with save_routes_arrays. Each worker memory maps these when it starts, so the
+    routes are not copied to, or re-calculated in each worker.
+    """
+
+    def __init__(self, routes_arrays_path, max_workers=None, chunk_size=500):
+        self.chunk_size = chunk_size
+        self.executor = ProcessPoolExecutor(max_workers, initializer=analyse_process_init, initargs=(routes_arrays_path, ))
+
+    async def find_closest_point_pair_routes_batch(self, to_points_nv, to_points_pv):
+        loop = asyncio.get_event_loop()
+        chunks = await asyncio.gather(*(
+            loop.run_in_executor(
+                self.executor, analyse_process_find_closest_point_pair_routes_batch,
+                to_points_nv[i: i + self.chunk_size], to_points_pv[i: i + self.chunk_size])
+            for i in range(0, len(to_points_nv), self.chunk_size)
+        ))
+        return list(chain.from_iterable(chunks))
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+analyse_process_routes = None
+
+
+def analyse_process_init(routes_arrays_path):
+    global analyse_process_routes
+    analyse_process_routes = [route_from_arrays(arrays) for arrays in load_routes_arrays(routes_arrays_path)]
+
+
+def analyse_process_find_closest_point_pair_routes_batch(to_points_nv, to_points_pv):
+    return find_closest_point_pair_routes_batch(analyse_process_routes, to_points_nv, to_points_pv)
+
+
 @add_slots
 @dataclass
 class Point(object):
@@ -424,10 +876,138 @@ def get_analyse_route(org_route):
             simplified_points = ramer_douglas_peucker_sections(route_points, 500, route['split_at_dist'], route['split_point_range'])
 
     route['simplfied_point_pairs'] = [get_point_pair_precalc(*point_pair) for point_pair in pairs(simplified_points)]
+
+    route['points_pv'] = array([point.pv.reshape((3, )) for point in route_points], dtype=float).reshape((-1, 3))
+    route['points_distance'] = array([point.distance for point in route_points], dtype=float)
+    route['point_pairs_arrays'] = get_point_pairs_arrays(route['point_pairs'])
+    route['simplfied_point_pairs_arrays'] = get_point_pairs_arrays(route['simplfied_point_pairs'])
+    if len(route['simplfied_point_pairs']) >= grid_min_point_pairs:
+        route['simplfied_point_pairs_grid'] = get_point_pairs_grid(route['points_pv'], route['simplfied_point_pairs_arrays'])
     logger.debug('Route points: {}, simplified points: {}, distance: {}'.format(len(route_points), len(route['simplfied_point_pairs']), route_points[-1].distance))
     return route
 
 
+def get_route_arrays(route):
+    """
+    Compact representation of an analysed route, as a dict of arrays. It has the points' lat, lng, distance and
+    ECEF position, and the point pair arrays and grid. This is enough for find_closest_point_pair_routes_batch. See
+    route_from_arrays.
+    """
+    route_points = route['points']
+    arrays = {
+        'points_lat_lng': array([(point.lat, point.lng) for point in route_points], dtype=float).reshape((-1, 2)),
+        'points_distance': route['points_distance'],
+        'points_pv': route['points_pv'],
+    }
+    for key in ('point_pairs_arrays', 'simplfied_point_pairs_arrays', 'simplfied_point_pairs_grid'):
+        if route.get(key) is not None:
+            for field_name, value in route[key]._asdict().items():
+                arrays[f'{key}.{field_name}'] = asarray(value)
+    for key in ('main', 'dist_factor', 'start_distance', 'circular_range'):
+        if route.get(key) is not None:
+            arrays[key] = asarray(route[key])
+    return arrays
+
+
+def route_from_arrays(arrays):
+    """Route, from get_route_arrays, for use with find_closest_point_pair_routes_batch."""
+    route = {
+        'points_lat_lng': arrays['points_lat_lng'],
+        'points_distance': arrays['points_distance'],
+        'points_pv': arrays['points_pv'],
+        'point_pairs_arrays': point_pairs_arrays._make(
+            arrays[f'point_pairs_arrays.{field_name}'] for field_name in point_pairs_arrays._fields),
+        'simplfied_point_pairs_arrays': point_pairs_arrays._make(
+            arrays[f'simplfied_point_pairs_arrays.{field_name}'] for field_name in point_pairs_arrays._fields),
+    }
+    if 'simplfied_point_pairs_grid.cell_keys' in arrays:
+        route['simplfied_point_pairs_grid'] = point_pairs_grid._make(
+            arrays[f'simplfied_point_pairs_grid.{field_name}'] for field_name in point_pairs_grid._fields)._replace(
+                cell_size=arrays['simplfied_point_pairs_grid.cell_size'].item(),
+                n_point_pairs=arrays['simplfied_point_pairs_grid.n_point_pairs'].item())
+    for key in ('main', 'dist_factor', 'start_distance', 'circular_range'):
+        if key in arrays:
+            route[key] = arrays[key].item()
+    return route
+
+
+def save_routes_arrays(path, routes):
+    """
+    Save the arrays from get_route_arrays for routes, as a directory of .npy files, so that they can be memory mapped
+    by load_routes_arrays. Does nothing if path already exists.
+    """
+    if os.path.exists(path):
+        return
+    tmp_path = f'{path}.tmp-{os.getpid()}'
+    os.makedirs(tmp_path)
+    for route_i, route in enumerate(routes):
+        for name, value in get_route_arrays(route).items():
+            save(os.path.join(tmp_path, f'{route_i}.{name}.npy'), value)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Saved by another process in the mean time.
+        shutil.rmtree(tmp_path)
+
+
+def load_routes_arrays(path):
+    """Memory map the arrays saved by save_routes_arrays. Returns a list, per route, of dicts of arrays."""
+    routes_arrays = collections.defaultdict(dict)
+    for file_name in os.listdir(path):
+        route_i, name = file_name[:-len('.npy')].split('.', 1)
+        routes_arrays[int(route_i)][name] = load(os.path.join(path, file_name), mmap_mode='r')
+    return [routes_arrays[route_i] for route_i in range(len(routes_arrays))]
+
+
+def get_analyse_routes_cached(org_routes, routes_arrays_path):
+    """
+    Like get_analyse_routes, but if routes_arrays_path exists, the routes are re-built from the arrays saved there,
+    rather than re-calculated. Otherwise, the arrays are saved there with save_routes_arrays.
+    """
+    if os.path.exists(routes_arrays_path):
+        try:
+            routes_arrays = load_routes_arrays(routes_arrays_path)
+            if len(routes_arrays) != len(org_routes):
+                raise ValueError(f'Expected {len(org_routes)} routes, got {len(routes_arrays)}.')
+            return [analyse_route_from_arrays(org_route, arrays) for org_route, arrays in zip(org_routes, routes_arrays)]
+        except Exception:
+            logger.exception(f'Error loading routes arrays from {routes_arrays_path}. Re-calculating: ')
+            shutil.rmtree(routes_arrays_path, ignore_errors=True)
+
+    routes = get_analyse_routes(org_routes)
+    save_routes_arrays(routes_arrays_path, routes)
+    return routes
+
+
+def analyse_route_from_arrays(org_route, arrays):
+    """Re-build the route that get_analyse_route would return for org_route, from its get_route_arrays."""
+    route = copy.copy(org_route)
+    route.update(route_from_arrays(arrays))
+    del route['points_lat_lng']
+
+    points_lat_lng = arrays['points_lat_lng']
+    points_nv = lat_lon2n_E(deg2rad(points_lat_lng[:, 0]), deg2rad(points_lat_lng[:, 1]))
+    route['points'] = route_points = []
+    for i, (lat, lng, distance, point_nv, point_pv) in enumerate(zip(
+            points_lat_lng[:, 0].tolist(), points_lat_lng[:, 1].tolist(), arrays['points_distance'].tolist(),
+            points_nv.T, route['points_pv'])):
+        point = IndexedPoint(lat, lng, index=i, distance=distance)
+        point._nv = point_nv.reshape((3, 1))
+        point._pv = point_pv.reshape((3, 1))
+        route_points.append(point)
+
+    def get_point_pairs(arrays):
+        return [
+            (route_points[p1_index], route_points[p2_index], c12.reshape((3, 1)), p1h, p2h, dp1p2)
+            for p1_index, p2_index, c12, p1h, p2h, dp1p2 in zip(
+                arrays.p1_index.tolist(), arrays.p2_index.tolist(), arrays.c12, arrays.p1h, arrays.p2h, arrays.dp1p2)
+        ]
+
+    route['point_pairs'] = get_point_pairs(route['point_pairs_arrays'])
+    route['simplfied_point_pairs'] = get_point_pairs(route['simplfied_point_pairs_arrays'])
+    return route
+
+
 def route_with_distance_and_index(route):
     dist = 0
     previous_point = None
@@ -445,8 +1025,9 @@ def route_with_distance_and_index(route):
 
 
 def distance(point1, point2):
-    dist = norm(point1.pv - point2.pv)
-    return dist
+    # Same summing order as rows_norm, so that vectorised code gives exactly the same results.
+    x, y, z = (point1.pv - point2.pv)[:, 0]
+    return sqrt(x * x + y * y + z * z)
 
 
 def pairs(items):
@@ -494,10 +1075,10 @@ def ramer_douglas_peucker_sections(points, epsilon, split_at_dist, split_point_r
     return list(chain.from_iterable(simplified_points_sections))
 
 
-find_closest_point_pair_routes_result = collections.namedtuple('closest_point_pair_route', ('route_i', 'route', 'point_pair', 'dist', 'point'))
+find_closest_point_pair_routes_result = collections.namedtuple('find_closest_point_pair_routes_result', ('route_i', 'route', 'point_pair', 'dist', 'point'))
 
 
-def find_closest_point_pair_routes_cache_key(routes, to_point, min_search_complex_dist, prev_closest_route_i, break_out_dist, prev_dist, max_travel_dist):
+def find_closest_point_pair_routes_cache_key(routes, to_point, min_search_complex_dist, prev_closest_route_i, break_out_dist, prev_dist, max_travel_dist, precalc=None):
     return to_point.lat, to_point.lng, min_search_complex_dist, prev_closest_route_i, break_out_dist, prev_dist, max_travel_dist
 
 
@@ -515,7 +1096,71 @@ def find_closest_point_pair_routes_unpack(routes, packed):
         return find_closest_point_pair_routes_result(route_i, route, point_pair, dist, point)
 
 
-def find_closest_point_pair_routes(routes, to_point, min_search_complex_dist, prev_closest_route_i, break_out_dist, prev_dist, max_travel_dist):
+def quantize_point(point, quantum):
+    return round(point.lat / quantum), round(point.lng / quantum)
+
+
+def find_closest_point_pair_routes_quantized(
+        candidates_cache, quantum, routes, to_point, min_search_complex_dist, prev_closest_route_i, break_out_dist,
+        prev_dist, max_travel_dist, precalc=None):
+    """
+    find_closest_point_pair_routes, with the candidate point pairs for each route looked up in candidates_cache by
+    to_point snapped to quantum (in degrees.) Only the projection of to_point onto the candidates is calculated.
+
+    The candidates are the closest simplified point pairs to the snapped point, so the result can differ from
+    find_closest_point_pair_routes where 2 simplified point pairs are about the same distance from to_point.
+    """
+    point_key = quantize_point(to_point, quantum)
+    to_nv = to_point.nv.reshape((1, 3))
+    to_pv = to_point.pv.reshape((1, 3))
+
+    def get_route_precalc(route_i):
+        route_candidates = candidates_cache(route_i, point_key)
+        if route_candidates:
+            return closest_precalc_from_candidates(routes[route_i], route_candidates, to_nv, to_pv)
+
+    # Lazy, as find_closest_point_pair_routes often does not need to look at all the routes.
+    precalc = KeyifyList(range(len(routes)), get_route_precalc)
+    return find_closest_point_pair_routes(
+        routes, to_point, min_search_complex_dist, prev_closest_route_i, break_out_dist, prev_dist, max_travel_dist,
+        precalc=precalc)
+
+
+def find_closest_point_pair_routes_candidates_cache_key(route_i, point_key):
+    return route_i, point_key
+
+
+def find_closest_point_pair_routes_candidates(routes, quantum, route_i, point_key, top_n=8):
+    """
+    The top_n closest simplified point pairs (indexes and dists) of a route to the point at point_key (from
+    quantize_point.) See find_closest_point_pair_routes_quantized.
+    """
+    route = routes[route_i]
+    if not len(route['simplfied_point_pairs_arrays'].dp1p2):
+        return None
+    point = Point(point_key[0] * quantum, point_key[1] * quantum)
+    simplified_top, simplified_top_dist = find_closest_simplified_point_pairs_batch(
+        route, point.nv.reshape((1, 3)), point.pv.reshape((1, 3)), top_n)
+    return simplified_top[0].tolist(), simplified_top_dist[0].tolist()
+
+
+def closest_precalc_from_candidates(route, candidates, to_nv, to_pv):
+    simplified_top = array(candidates[0], dtype=int)
+    simplified_top_dist = array(candidates[1], dtype=float)
+    range_starts, range_ends = point_pair_range(route, simplified_top)
+    range_lens = where(simplified_top_dist < 100000, range_ends - range_starts, 0)
+    offsets = cumsum(range_lens) - range_lens
+    point_pair_indexes = arange(range_lens.sum()) - repeat(offsets - range_starts, range_lens)
+    c_points = find_c_points_from_precalc_arrays(
+        to_nv, to_pv, route['points_pv'], route['point_pairs_arrays'], point_pair_indexes)
+    complete = len(simplified_top) == len(route['simplfied_point_pairs_arrays'].dp1p2)
+    return closest_precalc(simplified_top, simplified_top_dist, complete, offsets, range_lens, point_pair_indexes, c_points)
+
+
+def find_closest_point_pair_routes(routes, to_point, min_search_complex_dist, prev_closest_route_i, break_out_dist, prev_dist, max_travel_dist, precalc=None):
+    """
+    precalc: Optional list of closest_precalc per route, from find_closest_point_pair_routes_batch.
+    """
 
     # print(to_point)
     # import math
@@ -525,9 +1170,12 @@ def find_closest_point_pair_routes(routes, to_point, min_search_complex_dist, pr
     #     print('---------------------')
     #     print(prev_dist, max_travel_dist)
 
+    if precalc is None:
+        precalc = (None, ) * len(routes)
+
     len_routes = len(routes)
     if len_routes == 1:
-        raw_result = find_closest_point_pair_route(routes[0], to_point, prev_dist, max_travel_dist)
+        raw_result = find_closest_point_pair_route(routes[0], to_point, prev_dist, max_travel_dist, precalc[0])
         if raw_result:
             return find_closest_point_pair_routes_result(0, routes[0], *raw_result)
     elif len_routes > 1:
@@ -538,7 +1186,7 @@ def find_closest_point_pair_routes(routes, to_point, min_search_complex_dist, pr
 
         for route_i in reversed(special_routes):
             route = routes[route_i]
-            raw_result = find_closest_point_pair_route(route, to_point, prev_dist, max_travel_dist)
+            raw_result = find_closest_point_pair_route(route, to_point, prev_dist, max_travel_dist, precalc[route_i])
             if raw_result:
                 result = find_closest_point_pair_routes_result(route_i, route, *raw_result)
                 if result.dist < break_out_dist:
@@ -547,7 +1195,7 @@ def find_closest_point_pair_routes(routes, to_point, min_search_complex_dist, pr
 
         for route_i, route in enumerate(routes):
             if route_i not in special_routes:
-                raw_result = find_closest_point_pair_route(route, to_point, prev_dist, max_travel_dist)
+                raw_result = find_closest_point_pair_route(route, to_point, prev_dist, max_travel_dist, precalc[route_i])
                 if raw_result:
                     results.append(find_closest_point_pair_routes_result(route_i, route, *raw_result))
 
@@ -555,74 +1203,337 @@ def find_closest_point_pair_routes(routes, to_point, min_search_complex_dist, pr
             return min(results, key=dist_attr_getter)
 
 
-find_closest_point_pair_result = collections.namedtuple('closest_point_pair', ('point_pair', 'dist', 'point'))
+find_closest_point_pair_result = collections.namedtuple('find_closest_point_pair_result', ('point_pair', 'dist', 'point'))
+
 
+def find_closest_point_pair_route(route, to_point, prev_dist, max_travel_dist, precalc=None):
+    """
+    precalc: Optional closest_precalc for to_point, from find_closest_point_pair_route_batch. Used in place of
+    calculating c points, if it has enough of the closest simplified point pairs.
+    """
+    simplified_arrays = route['simplfied_point_pairs_arrays']
+    point_pairs_arrays = route['point_pairs_arrays']
 
-def find_closest_point_pair_route(route, to_point, prev_dist, max_travel_dist):
     if max_travel_dist:
         min_route_dist = prev_dist - max_travel_dist
         max_route_dist = prev_dist + max_travel_dist
         if route['main']:
-            get_point_distance = lambda point: point.distance
+            get_point_distance = lambda distance: distance
         else:
-            get_point_distance = lambda point: point.distance * route['dist_factor'] + route['start_distance']
+            get_point_distance = lambda distance: distance * route['dist_factor'] + route['start_distance']
 
-        test_point_pair = lambda point_pair: get_point_distance(point_pair[1]) > min_route_dist and get_point_distance(point_pair[0]) <= max_route_dist
+        def filter_point_pairs(arrays, indexes):
+            return (
+                (get_point_distance(arrays.p2_distance[indexes]) > min_route_dist) &
+                (get_point_distance(arrays.p1_distance[indexes]) <= max_route_dist)
+            )
     else:
-        test_point_pair = lambda point_pair: True
-
-    simplified_c_points = (
-        find_closest_point_pair_result(point_pair[:2], *find_c_point_from_precalc(to_point, *point_pair))
-        for point_pair in route['simplfied_point_pairs']
-        if test_point_pair(point_pair)
-    )
-    simplified_c_points_sorted = sorted(simplified_c_points, key=dist_attr_getter)
-    simplified_c_points_top = take(4, simplified_c_points_sorted)
-    simplified_c_points_filtered = filter(lambda closest: closest.dist < 100000, simplified_c_points_top)
-
-    route_point_pairs = route['point_pairs']
-    route_point_pairs_filtered = chain.from_iterable((
-        route_point_pairs[simplified_c_point.point_pair[0].index: simplified_c_point.point_pair[1].index + 1]
-        for simplified_c_point in simplified_c_points_filtered))
-
-    with_c_points = (
-        find_closest_point_pair_result(point_pair[:2], *find_c_point_from_precalc(to_point, *point_pair))
-        for point_pair in route_point_pairs_filtered
-        if test_point_pair(point_pair)
-    )
+        filter_point_pairs = None
+
+    if precalc is not None:
+        # precalc.simplified_top is sorted by dist, so the first 4 that pass the filter are the same as the top 4 of
+        # all simplified point pairs that pass the filter.
+        simplified_ranks = arange(len(precalc.simplified_top))
+        if filter_point_pairs:
+            simplified_ranks = simplified_ranks[filter_point_pairs(simplified_arrays, precalc.simplified_top)]
+        if len(simplified_ranks) >= 4 or precalc.complete:
+            simplified_ranks = simplified_ranks[:4]
+            simplified_ranks = simplified_ranks[precalc.simplified_top_dist[simplified_ranks] < 100000]
+            rows = concatenate([
+                arange(precalc.range_starts[rank], precalc.range_starts[rank] + precalc.range_lens[rank])
+                for rank in simplified_ranks
+            ] + [arange(0)])
+            if filter_point_pairs:
+                rows = rows[filter_point_pairs(point_pairs_arrays, precalc.point_pair_indexes[rows])]
+            return find_closest_point_pair_route_from_c_points(
+                route, prev_dist, precalc.point_pair_indexes[rows], c_points_take(precalc.c_points, rows))
+
+    to_nv = to_point.nv.reshape((1, 3))
+    to_pv = to_point.pv.reshape((1, 3))
+    simplified_top = find_closest_simplified_point_pairs(route, to_nv, to_pv, filter_point_pairs)
+
+    point_pair_indexes = concatenate([
+        arange(*point_pair_range(route, i)) for i in simplified_top
+    ] + [arange(0)])
+    if filter_point_pairs:
+        point_pair_indexes = point_pair_indexes[filter_point_pairs(point_pairs_arrays, point_pair_indexes)]
 
     # debug = to_point == Point(lat=-27.88121972370371, lng=27.919258810579777)
     # if math.isclose(to_point.lat, -28.041518, rel_tol=0.000001) and math.isclose(to_point.lng, 27.911506, rel_tol=0.000001):
-    #     pprint.pprint(with_c_points)
-    #     print(len(point_pairs) , len(with_c_points), max_travel_dist)
-
-    head, with_c_points = spy(with_c_points)
-
-    if head:
-        circular_range = route.get('circular_range')
-        if prev_dist is not None and circular_range:
-            def min_key(closest):
-                if closest.dist > 100000:
-                    # Short cut to avoid unnecessary route_distance calls
-                    return float("inf")
-                rd = route_distance(route, closest)
-                move_distance = rd - prev_dist
-                if move_distance < 0:
-                    move_distance = move_distance * -10
-                try:
-                    move_distance_penalty = pow(3, move_distance / 5000)
-                except FloatingPointError:
-                    move_distance_penalty = float("inf")
-                rank = closest.dist + min(move_distance_penalty, 100000)
-                # if debug:
-                #     print(rank, move_distance, move_distance_penalty, closest, )
-                return rank
-        else:
-            min_key = dist_attr_getter
+    #     print(len(point_pair_indexes), max_travel_dist)
+
+    if len(point_pair_indexes):
+        c_points = find_c_points_from_precalc_arrays(to_nv, to_pv, route['points_pv'], point_pairs_arrays, point_pair_indexes)
+        return find_closest_point_pair_route_from_c_points(route, prev_dist, point_pair_indexes, c_points)
+
+
+def find_closest_simplified_point_pairs(route, to_nv, to_pv, filter_point_pairs, n=4):
+    """
+    Indexes of the n closest simplified point pairs to the to point, that pass filter_point_pairs, and are closer than
+    100km. Closest first.
+
+    Only the simplified point pairs near to the to point are searched, using the route's grid. If not enough are found
+    nearby, all the simplified point pairs are searched.
+    """
+    simplified_arrays = route['simplfied_point_pairs_arrays']
+
+    def closest(indexes):
+        if filter_point_pairs:
+            indexes = indexes[filter_point_pairs(simplified_arrays, indexes)]
+        dist = find_c_points_from_precalc_arrays(to_nv, to_pv, route['points_pv'], simplified_arrays, indexes).dist
+        top = argsort(dist, kind='stable')[:n]
+        return indexes[top], dist[top]
+
+    grid = route.get('simplfied_point_pairs_grid')
+    for radius in grid_search_radii if grid is not None else ():
+        _, indexes = point_pairs_grid_candidates(grid, to_pv, radius)
+        top, top_dist = closest(indexes)
+        covered_dist = radius * grid.cell_size
+        # Every point pair closer than covered_dist is a candidate, so if the n closest candidates are all within
+        # covered_dist, they are the n closest of all.
+        if (len(top) == n and top_dist[-1] <= covered_dist) or covered_dist >= 100000:
+            break
+    else:
+        top, top_dist = closest(arange(len(simplified_arrays.dp1p2)))
+    return top[top_dist < 100000]
+
+
+def point_pair_range(route, simplified_i):
+    """Range of the point pairs that a simplified point pair (or an array of them) covers."""
+    simplified_arrays = route['simplfied_point_pairs_arrays']
+    return (
+        simplified_arrays.p1_index[simplified_i],
+        minimum(simplified_arrays.p2_index[simplified_i] + 1, len(route['point_pairs_arrays'].dp1p2)),
+    )
 
-        r = min(with_c_points, key=min_key)
-        # print(f'return {r}')
-        return r
+
+def find_closest_point_pair_route_from_c_points(route, prev_dist, point_pair_indexes, c_points):
+    if not len(point_pair_indexes):
+        return
+
+    circular_range = route.get('circular_range')
+    if prev_dist is not None and circular_range:
+        # Vectorised version of ranking on route_distance, to penalise jumping along a circular route.
+        point_pairs_arrays = route['point_pairs_arrays']
+        p1_pv = route['points_pv'][point_pairs_arrays.p1_index[point_pair_indexes]]
+        rd = point_pairs_arrays.p1_distance[point_pair_indexes] + rows_norm(p1_pv - c_points.pv)
+        if not route['main']:
+            rd = rd * route['dist_factor'] + route['start_distance']
+        move_distance = rd.round() - prev_dist
+        move_distance = where(move_distance < 0, move_distance * -10, move_distance)
+        with errstate(over='ignore'):
+            move_distance_penalty = power(3, move_distance / 5000)
+        rank = where(c_points.dist > 100000, inf, c_points.dist + minimum(move_distance_penalty, 100000))
+        i = argmin(rank)
+    else:
+        i = argmin(c_points.dist)
+
+    point_pair = route['point_pairs'][point_pair_indexes[i]][:2]
+    return find_closest_point_pair_result(point_pair, c_points.dist[i], c_points_get_point(c_points, i, point_pair))
+
+
+closest_precalc = collections.namedtuple('closest_precalc', (
+    'simplified_top', 'simplified_top_dist', 'complete', 'range_starts', 'range_lens', 'point_pair_indexes', 'c_points'))
+
+
+def find_closest_point_pair_routes_batch(routes, to_points_nv, to_points_pv):
+    """
+    Returns a list, per to point, of closest_precalc per route. See find_closest_point_pair_route_batch.
+    """
+    routes_precalc = [find_closest_point_pair_route_batch(route, to_points_nv, to_points_pv) for route in routes]
+    return list(zip(*routes_precalc)) if routes else [()] * len(to_points_nv)
+
+
+def find_closest_point_pair_route_batch(route, to_points_nv, to_points_pv, top_n=8, max_chunk_size=100000):
+    """
+    Calculate the c points that find_closest_point_pair_route needs for many to points at once, in vectorised form.
+
+    to_points_nv, to_points_pv: (n, 3) arrays.
+
+    As the travel window depends on the previous point, this can't find the closest point pair. Rather, for each to
+    point, the top_n closest simplified point pairs, and the c points for the point pairs they cover are calculated.
+    find_closest_point_pair_route can use these as long as 4 or more of them fall in the travel window.
+    """
+    simplified_arrays = route['simplfied_point_pairs_arrays']
+    n_simplified = len(simplified_arrays.dp1p2)
+    if not n_simplified:
+        return [None] * len(to_points_nv)
+
+    chunk_size = max(max_chunk_size // n_simplified, 1)
+    return list(chain.from_iterable(
+        find_closest_point_pair_route_batch_chunk(route, to_points_nv[i: i + chunk_size], to_points_pv[i: i + chunk_size], top_n)
+        for i in range(0, len(to_points_nv), chunk_size)
+    ))
+
+
+def find_closest_point_pair_route_batch_chunk(route, to_points_nv, to_points_pv, top_n):
+    simplified_arrays = route['simplfied_point_pairs_arrays']
+    points_pv = route['points_pv']
+    n_to_points = len(to_points_nv)
+    n_simplified = len(simplified_arrays.dp1p2)
+
+    simplified_top, simplified_top_dist = find_closest_simplified_point_pairs_batch(route, to_points_nv, to_points_pv, top_n)
+
+    # Expand the top simplified point pairs that are close enough into the point pairs they cover.
+    range_starts, range_ends = point_pair_range(route, simplified_top)
+    range_lens = where(simplified_top_dist < 100000, range_ends - range_starts, 0)
+    range_lens_flat = range_lens.ravel()
+    n_candidates = range_lens_flat.sum()
+    range_offsets_flat = cumsum(range_lens_flat) - range_lens_flat
+    candidate_to_point_i = repeat(arange(n_to_points), range_lens.sum(axis=1))
+    point_pair_indexes = arange(n_candidates) - repeat(range_offsets_flat - range_starts.ravel(), range_lens_flat)
+
+    c_points = find_c_points_from_precalc_arrays(
+        to_points_nv[candidate_to_point_i], to_points_pv[candidate_to_point_i], points_pv, route['point_pairs_arrays'],
+        point_pair_indexes)
+
+    # Split per to point, with range_starts relative to each to point's candidates.
+    range_offsets = range_offsets_flat.reshape(range_lens.shape)
+    to_point_offsets = range_offsets[:, 0]
+    to_point_range_starts = range_offsets - to_point_offsets[:, None]
+    to_point_ends = to_point_offsets + range_lens.sum(axis=1)
+    complete = simplified_top.shape[1] == n_simplified
+    return [
+        closest_precalc(
+            simplified_top[i], simplified_top_dist[i], complete, to_point_range_starts[i], range_lens[i],
+            point_pair_indexes[start:end], c_points_slice(c_points, start, end))
+        for i, (start, end) in enumerate(zip(to_point_offsets, to_point_ends))
+    ]
+
+
+def find_closest_simplified_point_pairs_batch(route, to_points_nv, to_points_pv, top_n):
+    """
+    Indexes and dists of the top_n closest simplified point pairs to each to point, closest first. Returns (n, top_n)
+    arrays, or (n, number of simplified point pairs) arrays if there are fewer than top_n.
+
+    Like find_closest_simplified_point_pairs, the route's grid is used to find the to points' closest point pairs,
+    and for to points that don't have enough nearby, all the simplified point pairs are searched.
+    """
+    simplified_arrays = route['simplfied_point_pairs_arrays']
+    points_pv = route['points_pv']
+    n_to_points = len(to_points_nv)
+    n_simplified = len(simplified_arrays.dp1p2)
+    top_n = min(top_n, n_simplified)
+    simplified_top = zeros((n_to_points, top_n), dtype=int)
+    simplified_top_dist = zeros((n_to_points, top_n))
+    todo = arange(n_to_points)
+
+    grid = route.get('simplfied_point_pairs_grid')
+    for radius in grid_search_radii if grid is not None and top_n < n_simplified else ():
+        if not len(todo):
+            break
+        to_point_i, indexes = point_pairs_grid_candidates(grid, to_points_pv[todo], radius)
+        counts = bincount(to_point_i, minlength=len(todo))
+        has_enough = counts >= top_n
+        if not has_enough.any():
+            continue
+        to_point_i, indexes = to_point_i[has_enough[to_point_i]], indexes[has_enough[to_point_i]]
+        dist = find_c_points_from_precalc_arrays(
+            to_points_nv[todo][to_point_i], to_points_pv[todo][to_point_i], points_pv, simplified_arrays, indexes).dist
+        # Sorted by to point, then dist. lexsort is stable, so equal dists stay in point pair order.
+        order = lexsort((dist, to_point_i))
+        counts = counts[has_enough]
+        rows = order[(cumsum(counts) - counts)[:, None] + arange(top_n)]
+        exact = dist[rows][:, -1] <= radius * grid.cell_size
+        done = todo[has_enough][exact]
+        simplified_top[done] = indexes[rows][exact]
+        simplified_top_dist[done] = dist[rows][exact]
+        todo = setdiff1d(todo, done, assume_unique=True)
+
+    if len(todo):
+        # c points of every simplified point pair, for every remaining to point.
+        to_point_i = repeat(todo, n_simplified)
+        simplified_c_points = find_c_points_from_precalc_arrays(
+            to_points_nv[to_point_i], to_points_pv[to_point_i], points_pv, simplified_arrays,
+            tile(arange(n_simplified), len(todo)))
+        simplified_dist = simplified_c_points.dist.reshape((len(todo), n_simplified))
+        todo_top = argsort(simplified_dist, axis=1, kind='stable')[:, :top_n]
+        simplified_top[todo] = todo_top
+        simplified_top_dist[todo] = take_along_axis(simplified_dist, todo_top, axis=1)
+
+    return simplified_top, simplified_top_dist
+
+
+point_pairs_grid = collections.namedtuple(
+    'point_pairs_grid', ('cell_size', 'n_point_pairs', 'cell_keys', 'cell_starts', 'cell_lens', 'point_pair_indexes'))
+
+# For fewer simplified point pairs than this, searching all of them is faster than searching the grid.
+grid_min_point_pairs = 500
+# Radii, in cells, that the grid is searched with, before falling back to searching all point pairs.
+grid_search_radii = (1, 2, 4, 8)
+grid_key_base = 1 << 20
+
+
+def grid_cell_keys(cells):
+    """Encode (..., 3) arrays of cell coordinates as ints, such that adding keys adds cell coordinates."""
+    return (cells[..., 0] * grid_key_base + cells[..., 1]) * grid_key_base + cells[..., 2]
+
+
+@lru_cache()
+def grid_offset_keys(radius):
+    offsets = indices((radius * 2 + 1, ) * 3).reshape((3, -1)).T - radius
+    return grid_cell_keys(offsets)
+
+
+def get_point_pairs_grid(points_pv, arrays, cell_size=5000):
+    """
+    Uniform grid, on ECEF coordinates, of the point pairs in a point_pairs_arrays, so that the point pairs near to a
+    point can be found without calculating the c points of every point pair. See point_pairs_grid_candidates.
+
+    Each point pair is added to every cell that the arc between its points could pass through.
+    """
+    cell_keys = []
+    point_pair_indexes = []
+    for i, (p1_index, p2_index) in enumerate(zip(arrays.p1_index, arrays.p2_index)):
+        p1_pv = points_pv[p1_index]
+        p2_pv = points_pv[p2_index]
+        chord = sqrt(rows_dot((p2_pv - p1_pv)[None, :], (p2_pv - p1_pv)[None, :])[0])
+        # The arc bulges away from the chord by up to the sagitta. This is padded generously, to allow for the
+        # ellipsoid, and for c points that are just past the end of the arc.
+        pad = chord * chord / (8 * 6300000) * 1.1 + 20
+        # Split into pieces, so that a long diagonal pair does not fill its whole bounding box.
+        n_pieces = int(chord // (cell_size / 2)) + 1
+        piece_points = p1_pv + (p2_pv - p1_pv) * linspace(0, 1, n_pieces + 1)[:, None]
+        lows = floor((minimum(piece_points[:-1], piece_points[1:]) - pad) / cell_size).astype(int)
+        highs = floor((maximum(piece_points[:-1], piece_points[1:]) + pad) / cell_size).astype(int)
+        for low, high in zip(lows, highs):
+            cells = indices(high - low + 1).reshape((3, -1)).T + low
+            cell_keys.append(grid_cell_keys(cells))
+            point_pair_indexes.append(repeat(i, len(cells)))
+
+    cell_keys = concatenate(cell_keys + [zeros(0, dtype=int)])
+    point_pair_indexes = concatenate(point_pair_indexes + [zeros(0, dtype=int)])
+    # Sort by cell, then point pair, and remove duplicates.
+    order = lexsort((point_pair_indexes, cell_keys))
+    cell_keys, point_pair_indexes = cell_keys[order], point_pair_indexes[order]
+    keep = ones(len(cell_keys), dtype=bool)
+    keep[1:] = (cell_keys[1:] != cell_keys[:-1]) | (point_pair_indexes[1:] != point_pair_indexes[:-1])
+    cell_keys, point_pair_indexes = cell_keys[keep], point_pair_indexes[keep]
+    cell_keys, cell_starts, cell_lens = unique(cell_keys, return_index=True, return_counts=True)
+    return point_pairs_grid(cell_size, len(arrays.dp1p2), cell_keys, cell_starts, cell_lens, point_pair_indexes)
+
+
+def point_pairs_grid_candidates(grid, to_pv, radius):
+    """
+    Point pairs in the cells within radius cells of each to point. This includes every point pair that has a c point
+    closer than radius * cell_size to the to point.
+
+    to_pv: (n, 3) array. Returns (to_point_i, point_pair_indexes) arrays, sorted by to point, then point pair.
+    """
+    if not len(grid.cell_keys):
+        return zeros(0, dtype=int), zeros(0, dtype=int)
+    to_point_keys = grid_cell_keys(floor(to_pv / grid.cell_size).astype(int))
+    keys = to_point_keys[:, None] + grid_offset_keys(radius)[None, :]
+    cells = minimum(searchsorted(grid.cell_keys, keys), len(grid.cell_keys) - 1)
+    lens = where(grid.cell_keys[cells] == keys, grid.cell_lens[cells], 0)
+
+    lens_flat = lens.ravel()
+    offsets_flat = cumsum(lens_flat) - lens_flat
+    rows = arange(lens_flat.sum()) - repeat(offsets_flat - grid.cell_starts[cells].ravel(), lens_flat)
+    to_point_i = repeat(arange(len(to_pv)), lens.sum(axis=1))
+    # Sort by to point, then point pair, and remove duplicates.
+    unique_keys = unique(to_point_i * grid.n_point_pairs + grid.point_pair_indexes[rows])
+    return unique_keys // grid.n_point_pairs, unique_keys % grid.n_point_pairs
 
 
 def route_distance(route, closest):
@@ -699,6 +1610,84 @@ def find_c_point_from_precalc(to_point, point1, point2, c12, p1h, p2h, dp1p2):
     return find_c_point_result(c_dist, c_point)
 
 
+find_c_points_result = collections.namedtuple('find_c_points_result', ('dist', 'lat', 'lng', 'pv', 'end_point'))
+
+
+def find_c_points_from_precalc_arrays(to_nv, to_pv, points_pv, arrays, indexes):
+    """
+    Vectorised version of find_c_point_from_precalc, for the point pairs at `indexes` of a `point_pairs_arrays`.
+
+    to_nv, to_pv: the to point's nv and pv, as (1, 3) arrays, or (n, 3) arrays with a to point per index.
+
+    `end_point` is 0 where the c point lies between the 2 points, otherwise 1 or 2 for the point of the pair that is
+    closest.
+    """
+    if not len(indexes):
+        return find_c_points_result(zeros(0), zeros(0), zeros(0), zeros((0, 3)), zeros(0, dtype=int))
+
+    c12 = arrays.c12[indexes]
+    p1h = arrays.p1h[indexes]
+    p2h = arrays.p2h[indexes]
+    dp1p2 = arrays.dp1p2[indexes]
+
+    ctp = cross(to_nv, c12)
+    c = unit(cross(ctp, c12).T).T
+
+    def c_between(co):
+        dp1co = arccos(clip(rows_dot(p1h, co), -1, 1))
+        dp2co = arccos(clip(rows_dot(p2h, co), -1, 1))
+        return abs(dp1co + dp2co - dp1p2) < 0.000001
+
+    c_neg = 0 - c
+    c_pos_between = c_between(c)
+    c_neg_between = ~c_pos_between & c_between(c_neg)
+    c_is_between = c_pos_between | c_neg_between
+    sutable_c = where(c_neg_between[:, None], c_neg, c)
+
+    c_point_lat, c_point_lng = n_E2lat_lon(sutable_c.T)
+    lat = rad2deg(c_point_lat)
+    lng = rad2deg(c_point_lng)
+    # Like Point.pv, this is calculated from the lat, lng in degrees.
+    c_pv = n_EB_E2p_EB_E(lat_lon2n_E(deg2rad(lat), deg2rad(lng))).T
+
+    p1_pv = points_pv[arrays.p1_index[indexes]]
+    p2_pv = points_pv[arrays.p2_index[indexes]]
+    p1_dist = rows_norm(to_pv - p1_pv)
+    p2_dist = rows_norm(to_pv - p2_pv)
+    use_p2 = p2_dist < p1_dist
+
+    end_point = where(c_is_between, 0, where(use_p2, 2, 1))
+    pv = where(c_is_between[:, None], c_pv, where(use_p2[:, None], p2_pv, p1_pv))
+    dist = where(c_is_between, rows_norm(to_pv - c_pv), where(use_p2, p2_dist, p1_dist))
+    return find_c_points_result(dist, lat, lng, pv, end_point)
+
+
+def rows_dot(a, b):
+    # Summed in a fixed order, so that the same vectors give the same result, no matter where they are in the array.
+    return a[:, 0] * b[:, 0] + a[:, 1] * b[:, 1] + a[:, 2] * b[:, 2]
+
+
+def rows_norm(a):
+    return sqrt(rows_dot(a, a))
+
+
+def c_points_take(c_points, indexes):
+    return find_c_points_result._make(item[indexes] for item in c_points)
+
+
+def c_points_slice(c_points, start, end):
+    return find_c_points_result._make(item[start:end] for item in c_points)
+
+
+def c_points_get_point(c_points, i, point_pair):
+    end_point = c_points.end_point[i]
+    if end_point:
+        return point_pair[end_point - 1]
+    point = Point(lat=c_points.lat[i], lng=c_points.lng[i])
+    point._pv = c_points.pv[i].reshape((3, 1))
+    return point
+
+
 def get_point_pair_precalc(point1, point2):
     p1 = point1.nv
     p2 = point2.nv
@@ -709,6 +1698,27 @@ def get_point_pair_precalc(point1, point2):
     return point1, point2, c12, p1h, p2h, dp1p2
 
 
+point_pairs_arrays = collections.namedtuple(
+    'point_pairs_arrays', ('p1_index', 'p2_index', 'p1_distance', 'p2_distance', 'c12', 'p1h', 'p2h', 'dp1p2'))
+
+
+def get_point_pairs_arrays(point_pairs):
+    """
+    Stack the precalc of a list of point pairs into contiguous arrays, so that c points for many point pairs
+    can be found in one vectorised pass. See find_c_points_from_precalc_arrays.
+    """
+    return point_pairs_arrays(
+        p1_index=array([point_pair[0].index for point_pair in point_pairs], dtype=int),
+        p2_index=array([point_pair[1].index for point_pair in point_pairs], dtype=int),
+        p1_distance=array([point_pair[0].distance for point_pair in point_pairs], dtype=float),
+        p2_distance=array([point_pair[1].distance for point_pair in point_pairs], dtype=float),
+        c12=array([point_pair[2].reshape((3, )) for point_pair in point_pairs], dtype=float).reshape((-1, 3)),
+        p1h=array([point_pair[3] for point_pair in point_pairs], dtype=float).reshape((-1, 3)),
+        p2h=array([point_pair[4] for point_pair in point_pairs], dtype=float).reshape((-1, 3)),
+        dp1p2=array([point_pair[5] for point_pair in point_pairs], dtype=float),
+    )
+
+
 def get_equal_spaced_points(points, dist_between_points, start_dist=0, round_digits=6):
     cum_dist = start_dist
     yield (points[0], cum_dist)
@@ -729,6 +1739,59 @@ def get_equal_spaced_points(points, dist_between_points, start_dist=0, round_dig
     yield (points[-1], cum_dist)
 
 
+def move_along_route_batch(route, starts, dists):
+    """
+    Like move_along_route, for many (start point, index of the route point after start point) in starts, along route.
+    Uses route['points_distance'], the distance of each point along the route, to find the point pairs the moved to
+    points are between, rather than walking the route. Returns [lat, lng] positions.
+    """
+    route_points = route['points']
+    points_distance = route['points_distance']
+    # Positions that are interpolated between nv1 and nv2, at ti.
+    interpolate_is = []
+    nv1 = []
+    nv2 = []
+    ti = []
+    positions = [None] * len(starts)
+    # Positions that are past the first route point, and their distance along the route.
+    from_route_is = []
+    from_route_dists = []
+    for i, ((start_point, next_i), dist) in enumerate(zip(starts, dists)):
+        next_point = route_points[next_i]
+        first_dist = distance(start_point, next_point)
+        if dist <= first_dist:
+            interpolate_is.append(i)
+            nv1.append(start_point.nv)
+            nv2.append(next_point.nv)
+            ti.append(dist / first_dist)
+        else:
+            from_route_dists.append(next_point.distance + dist - first_dist)
+            from_route_is.append(i)
+
+    # The first point that is at, or past each distance.
+    point2_indexes = searchsorted(points_distance, from_route_dists, side='left').tolist()
+    for i, route_dist, point2_i in zip(from_route_is, from_route_dists, point2_indexes):
+        if point2_i == len(route_points):
+            last_point = route_points[-1]
+            positions[i] = [last_point.lat, last_point.lng]
+        else:
+            point1 = route_points[point2_i - 1]
+            point2 = route_points[point2_i]
+            nv1.append(point1.nv)
+            nv2.append(point2.nv)
+            ti.append((route_dist - point1.distance) / (point2.distance - point1.distance))
+            interpolate_is.append(i)
+
+    if interpolate_is:
+        nv1 = concatenate(nv1, axis=1)
+        nv2 = concatenate(nv2, axis=1)
+        nv = unit(nv1 + array(ti) * (nv2 - nv1))
+        lat, lng = n_E2lat_lon(nv)
+        for i, point_lat, point_lng in zip(interpolate_is, rad2deg(lat).tolist(), rad2deg(lng).tolist()):
+            positions[i] = [round(point_lat, 6), round(point_lng, 6)]
+    return positions
+
+
 def move_along_route(route, dist):
     for i, (point1, point2) in enumerate(pairs(route)):
         dist_between = point2.distance - point1.distance if isinstance(point1, IndexedPoint) and isinstance(point2, IndexedPoint) else distance(point1, point2)
@@ -740,15 +1803,3 @@ def move_along_route(route, dist):
             return Point.from_nv(nv)
     else:
         return point2
-
-
-class KeyifyList(object):
-    def __init__(self, inner, key):
-        self.inner = inner
-        self.key = key
-
-    def __len__(self):
-        return len(self.inner)
-
-    def __getitem__(self, k):
-        return self.key(self.inner[k])
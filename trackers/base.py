@@ -1,27 +1,35 @@
 import asyncio
 import contextlib
+import copy
 import functools
 import logging
 import pprint
 from collections import deque
+from collections.abc import MutableMapping
 from itertools import chain
 from pathlib import Path
 
 import msgpack
 import msgpack.fallback
 
+from trackers.columnar_points import ColumnarPoints
+
 logger = logging.getLogger(__name__)
 
 
 class Tracker(object):
 
-    def __init__(self, name, completed=None, new_points_callbacks=(), reset_points_callbacks=()):
+    def __init__(self, name, completed=None, new_points_callbacks=(), reset_points_callbacks=(), rewind_points_callbacks=(),
+                 columnar_points=False):
         self.name = name
-        self.points = []
+        # If columnar_points, points are stored in a ColumnarPoints, which uses less memory than a list of dicts.
+        self.columnar_points = columnar_points
+        self.points = self.new_points_list()
         self.status = None
         self.logger = logging.getLogger('trackers.{}'.format(name))
         self.new_points_observable = Observable(f'{self.name}.new_points', callbacks=new_points_callbacks)
         self.reset_points_observable = Observable(f'{self.name}.reset_points', callbacks=reset_points_callbacks)
+        self.rewind_points_observable = Observable(f'{self.name}.rewind_points', callbacks=rewind_points_callbacks)
 
         self.callback_tasks = []
         if completed is None:
@@ -34,15 +42,27 @@ class Tracker(object):
     def __repr__(self):
         return f'<{type(self).__name__}({self.name})>'
 
+    def new_points_list(self):
+        return ColumnarPoints() if self.columnar_points else []
+
     async def new_points(self, new_points):
         self.points.extend(new_points)
         await self.new_points_observable(self, new_points)
 
     async def reset_points(self):
-        self.points = []
+        self.points = self.new_points_list()
         self.finished = False
         await self.reset_points_observable(self)
 
+    async def rewind_points(self, index):
+        """
+        Remove the points from index on. Subscribers only need to redo their work from index, rather than from the
+        start like for reset_points. Normally followed by new_points with the replacement points.
+        """
+        del self.points[index:]
+        self.finished = False
+        await self.rewind_points_observable(self, index)
+
     def stop(self):
         if not self.completed.done():
             self.completed.set_result(None)
@@ -57,6 +77,80 @@ class Tracker(object):
         self.finished = True
 
 
+deleted = object()
+
+
+class DerivedPoint(MutableMapping):
+    """
+    A point derived from a source point. Only the keys that are set (or deleted) on the derived point are stored on it.
+    Other keys are read from the source point, so derived trackers do not need to copy the source points.
+    """
+
+    __slots__ = ('source', 'own')
+
+    def __init__(self, source, own=None):
+        self.source = source
+        # Keys set on this point. Deleted keys have a value of `deleted`.
+        self.own = {} if own is None else own
+
+    def __getitem__(self, key):
+        own = self.own
+        if key in own:
+            value = own[key]
+            if value is deleted:
+                raise KeyError(key)
+            return value
+        return self.source[key]
+
+    def get(self, key, default=None):
+        own = self.own
+        if key in own:
+            value = own[key]
+            return default if value is deleted else value
+        return self.source.get(key, default)
+
+    def __contains__(self, key):
+        own = self.own
+        if key in own:
+            return own[key] is not deleted
+        return key in self.source
+
+    def __setitem__(self, key, value):
+        self.own[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in self.source:
+            self.own[key] = deleted
+        else:
+            del self.own[key]
+
+    def __iter__(self):
+        own = self.own
+        for key in self.source:
+            if own.get(key) is not deleted:
+                yield key
+        for key, value in own.items():
+            if value is not deleted and key not in self.source:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(dict(self), memo)
+
+    def __reduce__(self):
+        return dict, (dict(self), )
+
+
 class Observable(object):
 
     def __init__(self, name, callbacks=(), error_msg='Error calling callback: '):
@@ -129,13 +223,26 @@ def print_tracker(tracker):
         print('{} {}: \n{}'.format(tracker.name, None, pprint.pformat(point)))
 
 
-def get_blocked_list(source, existing, smallest_block_len=8, entire_block=False):
+def get_blocked_list(source, existing, smallest_block_len=8, entire_block=False, big_blocks=None):
+    """
+    big_blocks: Optional list of the biggest blocks, from a previous call with the same source, or the source with
+    only points appended since. It is extended with any new biggest blocks, and the blocks in it are reused, so only
+    the points after them need to be looked at.
+    """
     source_len = len(source)
 
     if not entire_block:
-        block_i = 0
-        blocks = []
-        for mul in (16, 8, 4, 1):
+        if big_blocks is None:
+            big_blocks = []
+        big_block_len = smallest_block_len * 16
+        block_i = len(big_blocks) * big_block_len
+        while block_i + big_block_len < source_len:
+            end_index = block_i + big_block_len - 1
+            big_blocks.append({'start_index': block_i, 'end_index': end_index, 'end_hash': source[end_index]['hash']})
+            block_i += big_block_len
+
+        blocks = list(big_blocks)
+        for mul in (8, 4, 1):
             block_len = smallest_block_len * mul
 
             while block_i + block_len < source_len:
@@ -143,7 +250,9 @@ def get_blocked_list(source, existing, smallest_block_len=8, entire_block=False)
                 blocks.append({'start_index': block_i, 'end_index': end_index, 'end_hash': source[end_index]['hash']})
                 block_i += block_len
 
-        partial_block = list(source[block_i:])
+        # Copied, as the source may reuse its points on a rewind (e.g. ColumnarPoints row views), and the partial block
+        # is compared with the source on the next call.
+        partial_block = [dict(point) for point in source[block_i:]]
     else:
         if source:
             blocks = [{'start_index': 0, 'end_index': source[-1]['index'], 'end_hash': source[-1]['hash'], }]
@@ -153,6 +262,7 @@ def get_blocked_list(source, existing, smallest_block_len=8, entire_block=False)
 
     full = {'blocks': blocks, 'partial_block': partial_block}
 
+    # Fast when the blocks are reused from big_blocks, as list equality checks identity first.
     if existing.get('blocks') != blocks:
         update = full
     else:
@@ -178,7 +288,10 @@ class BlockedList(object):
     def __init__(self, source_name, get_source, new_update_callbacks=(), **kwargs):
         self.get_source = get_source
         self.kwargs = kwargs
-        self.full, _ = get_blocked_list(get_source(), {}, **self.kwargs)
+        # The biggest blocks only change when the source is reset or rewound, so they are kept, and only the blocks
+        # after them are worked out on each update.
+        self.big_blocks = []
+        self.full, _ = get_blocked_list(get_source(), {}, big_blocks=self.big_blocks, **self.kwargs)
         self.last = self.full
         self.new_update_observable = Observable(f'{source_name}.blocked_list_new_update', callbacks=new_update_callbacks)
 
@@ -187,22 +300,51 @@ class BlockedList(object):
         get_source = lambda: tracker.points
         blocked_list = BlockedList(tracker.name, get_source, **kwargs)
 
-        async def tracker_change(tracker, *args):
+        async def tracker_new_points(tracker, new_points):
             return await blocked_list.on_new_items()
 
-        tracker.new_points_observable.subscribe(tracker_change)
-        tracker.reset_points_observable.subscribe(tracker_change)
+        async def tracker_reset_points(tracker):
+            return await blocked_list.on_reset_items()
+
+        async def tracker_rewind_points(tracker, index):
+            return await blocked_list.on_rewind_items(index)
+
+        tracker.new_points_observable.subscribe(tracker_new_points)
+        tracker.reset_points_observable.subscribe(tracker_reset_points)
+        tracker.rewind_points_observable.subscribe(tracker_rewind_points)
         return blocked_list
 
     async def on_new_items(self):
-        self.full, update = get_blocked_list(self.get_source(), self.full, **self.kwargs)
+        self.full, update = get_blocked_list(self.get_source(), self.full, big_blocks=self.big_blocks, **self.kwargs)
         await self.new_update_observable(self, update)
 
+    async def on_reset_items(self):
+        self.big_blocks.clear()
+        await self.on_new_items()
+
+    async def on_rewind_items(self, index):
+        # Keep the biggest blocks that get_blocked_list would make for index points: those with a point after them.
+        big_block_len = self.kwargs.get('smallest_block_len', 8) * 16
+        del self.big_blocks[max(index - 1, 0) // big_block_len:]
+        await self.on_new_items()
+
     def get_update_from_last(self):
-        self.last, update = get_blocked_list(self.get_source(), self.last, **self.kwargs)
+        self.last, update = get_blocked_list(self.get_source(), self.last, big_blocks=self.big_blocks, **self.kwargs)
         return update
 
 
+class KeyifyList(object):
+    def __init__(self, inner, key):
+        self.inner = inner
+        self.key = key
+
+    def __len__(self):
+        return len(self.inner)
+
+    def __getitem__(self, k):
+        return self.key(self.inner[k])
+
+
 # TODO create async version that uses io executor
 @contextlib.contextmanager
 def stream_store(path: Path, logger: logging.Logger):
@@ -35,6 +35,26 @@ from trackers.dulwich_helpers import TreeReader, TreeWriter
 defaults_yaml = f"""
     data_path: {relpath(join(__file__, '../../data'))}
     cache_path: {relpath(join(__file__, '../../cache'))}
+    # Number of worker processes to use for bulk analysis. 0 to analyse in the main process.
+    analyse_processes: 0
+    # If set, the find_closest cache is keyed on positions snapped to this many degrees, so that it hits for points
+    # with different times, e.g. in a replay. null for exact keys.
+    find_closest_quantum: null
+    # Store the indexed and hashed points of riders in typed arrays, rather than a dict per point, to use less memory.
+    columnar_points: false
+    # Seconds between saves of the analyse state of riders, while points are being analysed. The state is also saved
+    # when the event's trackers are stopped.
+    analyse_save_state_interval: 300
+    # Merge points that arrive out of order into the rider's points, and rewind to the first late point, rather than
+    # reseting all the rider's points.
+    insert_late_points: false
+    # Number of encoded and compressed rider point blocks to keep in memory for the riders_points endpoints.
+    blocked_list_blocks_cache_items: 10000
+    # Negotiate permessage-deflate compression of event websocket messages, with clients that support it.
+    event_ws_compress: true
+    # Number of messages that may be waiting to be sent to an event websocket client. Clients that are slower than
+    # this are disconnected.
+    event_ws_send_queue_size: 20
     logging:
         version: 1
         disable_existing_loggers: false
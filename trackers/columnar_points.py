@@ -0,0 +1,345 @@
+"""
+A compact store for tracker points.
+
+Common point values (times, position, dist_route, index and hash) are stored in typed numpy arrays, one per key,
+rather than in a dict per point. Other keys, and values that can not be stored in a column without changing them
+(e.g. a position with an int altitude), are stored in a sparse side table. Points are read and written through
+ColumnarPoint, a dict like view of a row.
+
+Downstream trackers that pass points through unchanged can hold the views, which share the columns of the store,
+rather than copying the points.
+"""
+import copy
+from collections.abc import MutableMapping, Sequence
+from datetime import datetime, timedelta
+from math import isnan
+
+from numpy import (
+    empty,
+    float64,
+    full,
+    int64,
+    isnan as np_isnan,
+)
+
+epoch = datetime(1970, 1, 1)
+one_microsecond = timedelta(microseconds=1)
+int64_missing = -(1 << 63)
+
+
+class DatetimeColumn(object):
+    # Stored as microseconds since epoch, so that naive datetimes round trip exactly, independent of the timezone.
+    dtype = int64
+    shape = ()
+    missing = int64_missing
+
+    @staticmethod
+    def is_missing(column, i):
+        return column[i] == int64_missing
+
+    @staticmethod
+    def missing_mask(column):
+        return column == int64_missing
+
+    @staticmethod
+    def to_column(value):
+        if type(value) is datetime and value.tzinfo is None and not value.fold:
+            return (value - epoch) // one_microsecond
+
+    @staticmethod
+    def from_column(value):
+        return epoch + timedelta(microseconds=int(value))
+
+
+class FloatColumn(object):
+    dtype = float64
+    shape = ()
+    missing = float('nan')
+
+    @staticmethod
+    def is_missing(column, i):
+        return isnan(column[i])
+
+    @staticmethod
+    def missing_mask(column):
+        return np_isnan(column)
+
+    @staticmethod
+    def to_column(value):
+        if type(value) is float and not isnan(value):
+            return value
+
+    @staticmethod
+    def from_column(value):
+        return float(value)
+
+
+class PositionColumn(object):
+    # [lat, lng, alt] of floats, and the kind of sequence the position was, so that it round trips exactly. Sources
+    # make positions as lists or tuples, with or without an alt. alt is NaN for positions without one.
+    dtype = float64
+    shape = (4, )
+    missing = float('nan')
+    kinds = {
+        (tuple, 3): 0.0,
+        (tuple, 2): 1.0,
+        (list, 3): 2.0,
+        (list, 2): 3.0,
+    }
+    kind_types = {kind: type_len for type_len, kind in kinds.items()}
+
+    @staticmethod
+    def is_missing(column, i):
+        return isnan(column[i, 0])
+
+    @staticmethod
+    def missing_mask(column):
+        return np_isnan(column[:, 0])
+
+    @staticmethod
+    def to_column(value):
+        kind = PositionColumn.kinds.get((type(value), len(value))) if isinstance(value, (tuple, list)) else None
+        if kind is not None and all(type(item) is float and not isnan(item) for item in value):
+            if len(value) == 2:
+                return (value[0], value[1], float('nan'), kind)
+            return (value[0], value[1], value[2], kind)
+
+    @staticmethod
+    def from_column(value):
+        lat, lng, alt, kind = value.tolist()
+        type_, len_ = PositionColumn.kind_types[kind]
+        return type_((lat, lng, alt) if len_ == 3 else (lat, lng))
+
+
+class IntColumn(object):
+    dtype = int64
+    shape = ()
+    missing = int64_missing
+
+    @staticmethod
+    def is_missing(column, i):
+        return column[i] == int64_missing
+
+    @staticmethod
+    def missing_mask(column):
+        return column == int64_missing
+
+    @staticmethod
+    def to_column(value):
+        if type(value) is int and int64_missing < value < (1 << 63):
+            return value
+
+    @staticmethod
+    def from_column(value):
+        return int(value)
+
+
+class HashColumn(object):
+    # The 4 character hashes added by index_and_hash_list.
+    dtype = 'S4'
+    shape = ()
+    missing = b''
+
+    @staticmethod
+    def is_missing(column, i):
+        return column[i] == b''
+
+    @staticmethod
+    def missing_mask(column):
+        return column == b''
+
+    @staticmethod
+    def to_column(value):
+        if type(value) is str and len(value) == 4 and value.isascii():
+            return value.encode('ascii')
+
+    @staticmethod
+    def from_column(value):
+        return value.decode('ascii')
+
+
+default_columns = {
+    'time': DatetimeColumn,
+    'server_time': DatetimeColumn,
+    'position': PositionColumn,
+    # Always rounded to an int by AnalyseTracker.
+    'dist_route': IntColumn,
+    'index': IntColumn,
+    'hash': HashColumn,
+}
+
+
+class ColumnarPoints(Sequence):
+    """
+    List like store of points. Items are ColumnarPoint views. Supports the list operations trackers use on points:
+    len, indexing, slicing (which returns a list of views), iteration, append, extend, and deleting to the end.
+    """
+
+    def __init__(self, points=(), columns=default_columns, capacity=64):
+        self.column_types = columns
+        self.columns = {key: full((capacity, ) + column_type.shape, column_type.missing, dtype=column_type.dtype)
+                        for key, column_type in columns.items()}
+        self.capacity = capacity
+        self.length = 0
+        # Row index to dict of the keys that are not stored in columns.
+        self.side = {}
+        self.extend(points)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [ColumnarPoint(self, j) for j in range(*i.indices(self.length))]
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError('ColumnarPoints index out of range')
+        return ColumnarPoint(self, i)
+
+    def __iter__(self):
+        for i in range(self.length):
+            yield ColumnarPoint(self, i)
+
+    def __delitem__(self, i):
+        # Only removing the points from an index to the end, e.g. `del points[index:]` is supported.
+        if not isinstance(i, slice) or i.stop is not None or i.step not in (None, 1):
+            raise TypeError('ColumnarPoints only supports deleting to the end.')
+        start, _, _ = i.indices(self.length)
+        for key, column_type in self.column_types.items():
+            self.columns[key][start:self.length] = column_type.missing
+        for row in [row for row in self.side if row >= start]:
+            del self.side[row]
+        self.length = start
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence) or isinstance(other, (str, bytes)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __repr__(self):
+        return f'{type(self).__name__}({list(self)!r})'
+
+    def column(self, key):
+        """
+        Returns the column for key, for vectorized reads. Rows without a value for key in the column have the column
+        type's missing value (NaN for float columns.) Only valid until the next append.
+        """
+        return self.columns[key][:self.length]
+
+    def present(self, key):
+        """Returns a bool array of which points have a value for key in its column."""
+        return ~self.column_types[key].missing_mask(self.column(key))
+
+    def ensure_capacity(self, length):
+        if length <= self.capacity:
+            return
+        capacity = max(length, self.capacity * 2)
+        for key, column_type in self.column_types.items():
+            column = self.columns[key]
+            new_column = empty((capacity, ) + column_type.shape, dtype=column_type.dtype)
+            new_column[:self.length] = column[:self.length]
+            new_column[self.length:] = column_type.missing
+            self.columns[key] = new_column
+        self.capacity = capacity
+
+    def append(self, point):
+        self.extend((point, ))
+
+    def extend(self, points):
+        points = list(points)
+        self.ensure_capacity(self.length + len(points))
+        columns = self.columns
+        column_types = self.column_types
+        for i, point in enumerate(points, start=self.length):
+            if isinstance(point, ColumnarPoint) and point.store.column_types is column_types:
+                # Copy from another store, without going through dicts.
+                for key, column in columns.items():
+                    column[i] = point.store.columns[key][point.index]
+                side = point.store.side.get(point.index)
+                if side:
+                    self.side[i] = dict(side)
+            else:
+                side = None
+                for key, value in point.items():
+                    column_type = column_types.get(key)
+                    column_value = column_type.to_column(value) if column_type else None
+                    if column_value is None:
+                        if side is None:
+                            side = self.side[i] = {}
+                        side[key] = value
+                    else:
+                        columns[key][i] = column_value
+        self.length += len(points)
+
+    def copy(self):
+        copied = ColumnarPoints(columns=self.column_types, capacity=max(self.length, 1))
+        copied.extend(self)
+        return copied
+
+
+class ColumnarPoint(MutableMapping):
+    """Dict like view of a row in a ColumnarPoints."""
+
+    __slots__ = ('store', 'index')
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    def __getitem__(self, key):
+        store = self.store
+        column_type = store.column_types.get(key)
+        if column_type is not None:
+            column = store.columns[key]
+            if not column_type.is_missing(column, self.index):
+                return column_type.from_column(column[self.index])
+        side = store.side.get(self.index)
+        if side is None:
+            raise KeyError(key)
+        return side[key]
+
+    def __setitem__(self, key, value):
+        store = self.store
+        column_type = store.column_types.get(key)
+        column_value = column_type.to_column(value) if column_type else None
+        if column_value is None:
+            if column_type:
+                store.columns[key][self.index] = column_type.missing
+            store.side.setdefault(self.index, {})[key] = value
+        else:
+            store.columns[key][self.index] = column_value
+            side = store.side.get(self.index)
+            if side:
+                side.pop(key, None)
+
+    def __delitem__(self, key):
+        store = self.store
+        column_type = store.column_types.get(key)
+        if column_type is not None and not column_type.is_missing(store.columns[key], self.index):
+            store.columns[key][self.index] = column_type.missing
+        else:
+            side = store.side.get(self.index, {})
+            del side[key]
+
+    def __iter__(self):
+        store = self.store
+        for key, column_type in store.column_types.items():
+            if not column_type.is_missing(store.columns[key], self.index):
+                yield key
+        yield from store.side.get(self.index, ())
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(dict(self), memo)
+
+    def __reduce__(self):
+        return dict, (dict(self), )
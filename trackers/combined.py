@@ -1,6 +1,8 @@
+import heapq
+from bisect import bisect_right
 from itertools import chain
 
-from trackers.base import Tracker
+from trackers.base import KeyifyList, Tracker
 
 
 def time_key(item):
@@ -10,15 +12,21 @@ def time_key(item):
 class Combined(Tracker):
 
     @classmethod
-    async def start(cls, name, trackers, new_points_callbacks=(), reset_points_callbacks=()):
+    async def start(cls, name, trackers, new_points_callbacks=(), reset_points_callbacks=(), insert_late_points=False):
+        """
+        insert_late_points: If True, points that are older than the last point are merged in, and the points after
+        the first late point are replaced with rewind_points, rather than reseting all the points.
+        """
         tracker = cls(name, new_points_callbacks=new_points_callbacks, reset_points_callbacks=reset_points_callbacks)
         tracker.trackers = list(trackers)
+        tracker.insert_late_points = insert_late_points
         tracker.sub_to_be_completed = len(tracker.trackers)
 
         points = tracker.get_sorted_points()
         for sub_tracker in trackers:
             sub_tracker.new_points_observable.subscribe(tracker.on_sub_new_points)
             sub_tracker.reset_points_observable.subscribe(tracker.on_sub_reset_points)
+            sub_tracker.rewind_points_observable.subscribe(tracker.on_sub_rewind_points)
             sub_tracker.completed.add_done_callback(tracker.on_sub_completed)
         await tracker.new_points(points)
 
@@ -35,6 +43,7 @@ class Combined(Tracker):
 
         tracker.new_points_observable.subscribe(self.on_sub_new_points)
         tracker.reset_points_observable.subscribe(self.on_sub_reset_points)
+        tracker.rewind_points_observable.subscribe(self.on_sub_rewind_points)
         tracker.completed.add_done_callback(self.on_sub_completed)
 
     def get_sorted_points(self):
@@ -46,6 +55,13 @@ class Combined(Tracker):
             is_sorted = not self.points or time_key(self.points[-1]) <= time_key(points[0])
             if is_sorted:
                 await self.new_points(points)
+            elif self.insert_late_points:
+                # Points with the same time as existing points go after them, as they would with a stable sort.
+                index = bisect_right(KeyifyList(self.points, time_key), time_key(points[0]))
+                self.logger.debug(f'Points not sorted. Rewinding to {index}.')
+                replacement_points = list(heapq.merge(self.points[index:], points, key=time_key))
+                await self.rewind_points(index)
+                await self.new_points(replacement_points)
             else:
                 self.logger.debug('Points not sorted. Resting.')
                 all_points_sorted = list(sorted(chain(self.points, points), key=time_key))
@@ -58,6 +74,9 @@ class Combined(Tracker):
             await self.reset_points()
             await self.new_points(new_points)
 
+    async def on_sub_rewind_points(self, sub_tracker, index):
+        await self.on_sub_reset_points(sub_tracker)
+
     def stop(self):
         for sub_tracker in self.trackers:
             sub_tracker.stop()
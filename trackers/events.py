@@ -2,12 +2,12 @@ import asyncio
 import copy
 import logging
 import os
-from bisect import bisect
 from collections import defaultdict
-from contextlib import closing, suppress
+from contextlib import closing, contextmanager, suppress
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from functools import partial
+from heapq import merge
 from itertools import chain
 from typing import List
 
@@ -15,18 +15,103 @@ import aionotify
 import msgpack
 import yaml
 from more_itertools import spy
-
-from trackers.analyse import AnalyseTracker, get_analyse_routes
+from numpy import (
+    array,
+    empty,
+    float64,
+    full,
+    isnan,
+    nan,
+    searchsorted,
+    where,
+)
+
+from trackers.analyse import AnalyseProcessPool, AnalyseTracker, get_analyse_routes_cached, get_predicted_positions
 from trackers.base import BlockedList, cancel_and_wait_task, general_fut_done_callback, Observable, Tracker
 from trackers.combined import Combined
 from trackers.dulwich_helpers import TreeReader, TreeWriter
 from trackers.general import hash_bytes, index_and_hash_tracker, json_encode, start_replay_tracker
-from trackers.persisted_func_cache import PersistedFuncCache
+from trackers.persisted_func_cache import SqlitePersistedFuncCache
 
 logger = logging.getLogger(__name__)
 
 min_time = datetime.fromtimestamp(0)
 
+
+class LeaderCurve(object):
+    """
+    The (dist_route, time) of a rider's analysed points, where the rider went forward, starting at (0, start), for
+    working out when the rider was at a distance. Kept in arrays that are appended to as new points come in, so that
+    they don't need to be rebuilt, and can be interpolated for many distances at once. Times are stored as seconds
+    since ref_time.
+    """
+
+    def __init__(self, start=None):
+        self.dist = empty(64, dtype=float64)
+        self.time = empty(64, dtype=float64)
+        self.len = 0
+        self.ref_time = start
+        self.points_processed = 0
+        self.points_added = False
+        if start is not None:
+            self.append(0, start)
+
+    def append(self, dist, time):
+        if self.ref_time is None:
+            self.ref_time = time
+        if self.len == len(self.dist):
+            for attr in ('dist', 'time'):
+                old = getattr(self, attr)
+                new = empty(len(old) * 2, dtype=float64)
+                new[:self.len] = old[:self.len]
+                setattr(self, attr, new)
+        self.dist[self.len] = dist
+        self.time[self.len] = (time - self.ref_time).total_seconds()
+        self.len += 1
+
+    def add_point(self, dist, time):
+        if not self.len or dist > self.dist[self.len - 1]:
+            self.append(dist, time)
+        elif not self.points_added and dist == self.dist[0]:
+            # First point is at the start line. Use its time, rather than the start time.
+            self.time[0] = (time - self.ref_time).total_seconds()
+        else:
+            return
+        self.points_added = True
+
+    def update(self, points):
+        if len(points) < self.points_processed:
+            raise ValueError('Points have been removed. Make a new LeaderCurve.')
+        for point in points[self.points_processed:]:
+            if 'dist_route' in point:
+                self.add_point(point['dist_route'], point['time'])
+        self.points_processed = len(points)
+
+    def interpolate(self, dists, end_point=None):
+        """
+        Returns the times (as seconds since ref_time) that the rider was at dists, or NaN for the dists that are
+        not covered. end_point: Optional (dist, time) that is used as the last point, e.g. the rider's predicted
+        position, without being added.
+        """
+        length = self.len
+        if end_point is not None and (not length or end_point[0] > self.dist[length - 1]):
+            # Temporarily use the space after the end of the arrays.
+            self.append(*end_point)
+            length = self.len
+            self.len -= 1
+        if length < 2:
+            return full(len(dists), nan)
+        curve_dist = self.dist[:length]
+        curve_time = self.time[:length]
+        i = searchsorted(curve_dist, dists, side='left')
+        valid = (i > 0) & (i < length)
+        i2 = where(valid, i, 1)
+        i1 = i2 - 1
+        dist1 = curve_dist[i1]
+        time1 = curve_time[i1]
+        interpolate = (dists - dist1) / (curve_dist[i2] - dist1)
+        return where(valid, time1 + (curve_time[i2] - time1) * interpolate, nan)
+
 # TODO: this is no longer specific to events. Move to somewhere
 
 
@@ -116,6 +201,9 @@ class Event(object):
         self.starting_fut = None
         self.batch_update_task = None
         self.not_live_complete_trackers_task = None
+        self.analyse_pool = None
+        self.find_closest_cache = None
+        self.analyse_state_dir = None
 
         self.config_routes_change_observable = Observable(f'event.{name}.config_routes_change')
         self.rider_new_values_observable = Observable(f'event.{name}.rider_new_values')
@@ -125,6 +213,10 @@ class Event(object):
         self.rider_pre_post_blocked_list_update_observable = Observable(f'event.{name}.rider_pre_post_blocked_list_update')
         self.batch_update_observable = Observable(f'event.{name}.batch_update')
         self.new_points = asyncio.Event()
+        # Batch updates, and the predictions they need, are only worked out while there are subscribers, e.g. websocket
+        # clients.
+        self.subscribers = 0
+        self.has_subscribers = asyncio.Event()
 
         self.path = os.path.join('events', name)
         self.git_hash = None
@@ -249,6 +341,9 @@ class Event(object):
         self.riders_updated = set()
         self.riders_off_route_updated = set()
         self.riders_pre_post_updated = set()
+        # Standings from the last batch update, which is mostly still in order for the next.
+        self.rider_names_sorted = []
+        self.leader_curves = {}
 
         tree_reader = TreeReader(self.app['trackers.data_repo'], treeish=self.git_hash) if self.git_hash else None
         has_static = tree_reader.exists(os.path.join('static')) if tree_reader else False
@@ -256,16 +351,37 @@ class Event(object):
 
         if analyse and not has_static_analyse:
             loop = asyncio.get_event_loop()
-            analyse_routes = await loop.run_in_executor(None, get_analyse_routes, self.routes)
+            if self.routes:
+                routes_arrays_dir = os.path.join(self.app['trackers.settings']['cache_path'], 'routes_arrays')
+                os.makedirs(routes_arrays_dir, exist_ok=True)
+                routes_arrays_path = os.path.join(routes_arrays_dir, f'1-{self.routes_hash}')
+                analyse_routes = await loop.run_in_executor(None, get_analyse_routes_cached, self.routes, routes_arrays_path)
+            else:
+                analyse_routes = []
 
             find_closest_cache_dir = os.path.join(self.app['trackers.settings']['cache_path'], 'find_closest')
             os.makedirs(find_closest_cache_dir, exist_ok=True)
+            find_closest_quantum = self.app['trackers.settings'].get('find_closest_quantum')
             if self.routes:
-                find_closest_cache = PersistedFuncCache(os.path.join(find_closest_cache_dir, f'2-{self.routes_hash}'))
+                find_closest_cache_name = f'3-{self.routes_hash}-q{find_closest_quantum}' if find_closest_quantum else f'3-{self.routes_hash}'
+                self.find_closest_cache = find_closest_cache = SqlitePersistedFuncCache(
+                    os.path.join(find_closest_cache_dir, f'{find_closest_cache_name}.sqlite'), write_in_background=True)
                 logger.info(f'find_closest_cache: {find_closest_cache.path}')
             else:
                 find_closest_cache = None
 
+            if self.routes and not replay:
+                self.analyse_state_dir = os.path.join(self.app['trackers.settings']['cache_path'], 'analyse_state', self.name)
+                os.makedirs(self.analyse_state_dir, exist_ok=True)
+
+            analyse_processes = self.app['trackers.settings'].get('analyse_processes')
+            if analyse_processes and analyse_routes:
+                self.analyse_pool = AnalyseProcessPool(routes_arrays_path, analyse_processes)
+
+        columnar_points = self.app['trackers.settings'].get('columnar_points', False)
+        insert_late_points = self.app['trackers.settings'].get('insert_late_points', False)
+        save_state_interval = timedelta(seconds=self.app['trackers.settings'].get('analyse_save_state_interval', 300))
+
         if replay:
             replay_config = replay if isinstance(replay, dict) else {}
             replay_kwargs = {
@@ -317,7 +433,9 @@ class Event(object):
             self.riders_current_values[rider['name']] = {}
             self.riders_pre_post_values[rider['name']] = {}
 
-            objects.combined_tracker = tracker = await Combined.start(f'combined.{rider_name}', tuple(chain((objects.data_tracker, ), objects.source_trackers)))
+            objects.combined_tracker = tracker = await Combined.start(
+                f'combined.{rider_name}', tuple(chain((objects.data_tracker, ), objects.source_trackers)),
+                insert_late_points=insert_late_points)
             if replay:
                 tracker = await start_replay_tracker(tracker, **replay_kwargs)
 
@@ -334,11 +452,14 @@ class Event(object):
                 else:
                     objects.analyse_tracker = tracker = await AnalyseTracker.start(
                         tracker, self.event_start, analyse_routes, find_closest_cache=find_closest_cache,
-                        processing_lock=self.app['analyse_processing_lock'])
-                    objects.off_route_tracker = await index_and_hash_tracker(tracker.off_route_tracker)
-                    objects.pre_post_tracker = await index_and_hash_tracker(tracker.pre_post_tracker)
+                        processing_lock=self.app['analyse_processing_lock'], analyse_pool=self.analyse_pool,
+                        find_closest_quantum=find_closest_quantum, state_path=self.analyse_state_path(rider_name),
+                        save_state_interval=save_state_interval)
+                    objects.off_route_tracker = await index_and_hash_tracker(tracker.off_route_tracker, columnar_points=columnar_points)
+                    objects.pre_post_tracker = await index_and_hash_tracker(tracker.pre_post_tracker, columnar_points=columnar_points)
                     await self.on_rider_pre_post_new_points(rider['name'], objects.pre_post_tracker, objects.pre_post_tracker.points)
                     objects.pre_post_tracker.new_points_observable.subscribe(partial(self.on_rider_pre_post_new_points, rider['name']))
+                    objects.pre_post_tracker.rewind_points_observable.subscribe(partial(self.on_rider_rewind_points, rider['name']))
                     tracker.not_pre_post_observable.subscribe(partial(self.on_rider_not_pre_post, rider['name']))
 
                 objects.off_route_blocked_list = BlockedList.from_tracker(
@@ -349,10 +470,11 @@ class Event(object):
                     objects.pre_post_tracker, entire_block=not is_live,
                     new_update_callbacks=(partial(self.rider_pre_post_blocked_list_update_observable, self, rider['name']), ))
 
-            tracker = await index_and_hash_tracker(tracker)
+            tracker = await index_and_hash_tracker(tracker, columnar_points=columnar_points)
             await self.on_rider_new_points(rider['name'], tracker, tracker.points)
             tracker.new_points_observable.subscribe(partial(self.on_rider_new_points, rider['name']))
             tracker.reset_points_observable.subscribe(partial(self.on_rider_reset_points, rider['name']))
+            tracker.rewind_points_observable.subscribe(partial(self.on_rider_rewind_points, rider['name']))
 
             objects.tracker = tracker
             objects.blocked_list = BlockedList.from_tracker(
@@ -377,6 +499,13 @@ class Event(object):
                 await cancel_and_wait_task(self.batch_update_task)
                 self.batch_update_task = None
 
+            if self.analyse_state_dir:
+                await asyncio.gather(*(
+                    riders_objects.analyse_tracker.save_state() for riders_objects in self.riders_objects.values()
+                    if isinstance(riders_objects.analyse_tracker, AnalyseTracker)
+                ))
+                self.analyse_state_dir = None
+
             for riders_objects in self.riders_objects.values():
                 if riders_objects.tracker:
                     riders_objects.tracker.stop()
@@ -391,6 +520,14 @@ class Event(object):
                     self.logger.exception('Unhandled tracker error: ')
             if self.not_live_complete_trackers_task:
                 await self.not_live_complete_trackers_task
+            if self.analyse_pool:
+                # Joining the worker processes can take a while, so do it off the event loop.
+                await asyncio.get_event_loop().run_in_executor(None, self.analyse_pool.shutdown)
+                self.analyse_pool = None
+            if self.find_closest_cache:
+                # Waits for the background writer, and does the final writes, so do it off the event loop.
+                await asyncio.get_event_loop().run_in_executor(None, self.find_closest_cache.close)
+                self.find_closest_cache = None
 
             del self.riders_objects
             del self.riders_current_values
@@ -398,21 +535,31 @@ class Event(object):
             del self.riders_updated
             del self.riders_off_route_updated
             del self.riders_pre_post_updated
+            del self.rider_names_sorted
+            del self.leader_curves
 
             self.trackers_started = False
 
+    def analyse_state_path(self, rider_name):
+        if self.analyse_state_dir:
+            return os.path.join(self.analyse_state_dir, f'1-{hash_bytes(rider_name.encode())}-{self.routes_hash}.pickle')
+
     async def not_live_complete_trackers(self):
         await asyncio.wait([rider_objs.tracker.completed for rider_objs in self.riders_objects.values()])
         riders = set(self.riders_objects.keys())
         await self.batch_update(riders, riders, riders)
 
+    def update_rider_values(self, rider_name, new_points):
+        values = self.riders_current_values[rider_name]
+        for point in new_points:
+            values.update(point)
+            if 'position' in point:
+                values['position_time'] = point['time']
+        return values
+
     async def on_rider_new_points(self, rider_name, tracker, new_points):
         if new_points:
-            values = self.riders_current_values[rider_name]
-            for point in new_points:
-                values.update(point)
-                if 'position' in point:
-                    values['position_time'] = point['time']
+            values = self.update_rider_values(rider_name, new_points)
             # if 'rider_status' in values:
             #     with suppress(KeyError):
             #         del values['position']
@@ -427,37 +574,40 @@ class Event(object):
 
     pre_post_update_main_keys = {'time', 'battery', 'tk_status', 'tk_config'}
 
+    def update_rider_pre_post_values(self, rider_name, new_points):
+        """Returns if the rider's current values were updated, with the pre_post_update_main_keys of newer points."""
+        values_updated = False
+
+        pre_post_values = self.riders_pre_post_values[rider_name]
+        values = self.riders_current_values[rider_name]
+        for point in new_points:
+            pre_post_values.update(point)
+
+            # TODO, rather than do this check, we should make sure the values come in in the right order.
+            point_is_newer = point['time'] > values.get('time', min_time)
+
+            if point_is_newer:
+                has_values_update, values_update = spy(((k, v) for k, v in point.items() if k in self.pre_post_update_main_keys))
+                if has_values_update:
+                    values_update = list(values_update)
+                    values.update(values_update)
+                    values_updated = True
+            if 'position' in point:
+                pre_post_values['position_time'] = point['time']
+                if point_is_newer:
+                    values['position_time'] = point['time']
+                    values_updated = True
+        return values_updated
+
     async def on_rider_pre_post_new_points(self, rider_name, tracker, new_points):
         if new_points:
-            values_updated = False
-
-            pre_post_values = self.riders_pre_post_values[rider_name]
-            values = self.riders_current_values[rider_name]
-            for point in new_points:
-                pre_post_values.update(point)
-
-                # TODO, rather than do this check, we should make sure the values come in in the right order.
-                point_is_newer = point['time'] > values.get('time', min_time)
-
-                if point_is_newer:
-                    has_values_update, values_update = spy(((k, v) for k, v in point.items() if k in self.pre_post_update_main_keys))
-                    if has_values_update:
-                        values_update = list(values_update)
-                        values.update(values_update)
-                        values_updated = True
-                if 'position' in point:
-                    pre_post_values['position_time'] = point['time']
-                    if point_is_newer:
-                        values['position_time'] = point['time']
-                        values_updated = True
-
-            if values_updated:
+            if self.update_rider_pre_post_values(rider_name, new_points):
                 self.riders_updated.add(rider_name)
-                await self.rider_new_values_observable(self, rider_name, values)
+                await self.rider_new_values_observable(self, rider_name, self.riders_current_values[rider_name])
 
             self.riders_pre_post_updated.add(rider_name)
             self.new_points.set()
-            await self.rider_pre_post_new_values_observable(self, rider_name, pre_post_values)
+            await self.rider_pre_post_new_values_observable(self, rider_name, self.riders_pre_post_values[rider_name])
 
     async def on_rider_not_pre_post(self, rider_name):
         self.riders_pre_post_values[rider_name] = values = {}
@@ -466,6 +616,7 @@ class Event(object):
         self.new_points.set()
 
     async def on_rider_reset_points(self, rider_name, tracker):
+        self.leader_curves.pop(rider_name, None)
         self.riders_current_values[rider_name].clear()
         self.riders_pre_post_values[rider_name].clear()
         if rider_name in self.riders_predicted_points:
@@ -479,6 +630,39 @@ class Event(object):
         await self.rider_new_values_observable(self, rider_name, {})
         await self.rider_pre_post_new_values_observable(self, rider_name, {})
 
+    async def on_rider_rewind_points(self, rider_name, tracker, index):
+        # The current and pre/post values are built up from the points of both the main and pre/post trackers, so
+        # rebuild them from the points that are left. AnalyseTracker may rewind either, or both.
+        objects = self.riders_objects[rider_name]
+        self.leader_curves.pop(rider_name, None)
+        self.riders_current_values[rider_name].clear()
+        self.riders_pre_post_values[rider_name].clear()
+        if rider_name in self.riders_predicted_points:
+            self.riders_predicted_points[rider_name].clear()
+
+        # Replayed in time order, as they were received, so that pre/post points update the current values as before.
+        points = merge(
+            ((False, point) for point in (objects.tracker.points if objects.tracker else ())),
+            ((True, point) for point in (objects.pre_post_tracker.points if objects.pre_post_tracker else ())),
+            key=lambda item: item[1].get('time', min_time),
+        )
+        prev_is_pre_post = False
+        for is_pre_post, point in points:
+            if is_pre_post:
+                self.update_rider_pre_post_values(rider_name, (point, ))
+            else:
+                if prev_is_pre_post:
+                    # As on_rider_not_pre_post.
+                    self.riders_pre_post_values[rider_name].clear()
+                self.update_rider_values(rider_name, (point, ))
+            prev_is_pre_post = is_pre_post
+
+        self.riders_updated.add(rider_name)
+        self.riders_pre_post_updated.add(rider_name)
+        self.new_points.set()
+        await self.rider_new_values_observable(self, rider_name, self.riders_current_values[rider_name])
+        await self.rider_pre_post_new_values_observable(self, rider_name, self.riders_pre_post_values[rider_name])
+
     def rider_sort_key_func(self, riders_predicted_points, rider_name):
         rider_values = self.riders_current_values.get(rider_name, {})
         finished = 'finished_time' in rider_values
@@ -487,13 +671,30 @@ class Event(object):
         dist_on_route = riders_predicted_points.get(rider_name, {}).get('dist_route') or rider_values.get('dist_route', 0)
         return not finished, time_to_finish, not has_dist_on_route, 0 - dist_on_route
 
+    @contextmanager
+    def subscriber(self):
+        """Register a subscriber to batch updates, for the duration of the context."""
+        self.subscribers += 1
+        self.has_subscribers.set()
+        try:
+            yield
+        finally:
+            self.subscribers -= 1
+            if not self.subscribers:
+                self.has_subscribers.clear()
+
     async def batch_update_loop(self):
         batch_update_interval = self.config.get('batch_update_interval') or 2
         predicted_update_interval = self.config.get('predicted_update_interval') or 10
         while True:
-            await asyncio.sleep(batch_update_interval)
-            with suppress(asyncio.TimeoutError):
-                await asyncio.wait_for(self.new_points.wait(), predicted_update_interval - batch_update_interval)
+            if not self.has_subscribers.is_set():
+                # Suspended until there are subscribers. The riders updated in the mean time are collected in
+                # riders_updated, etc., and are all sent, with new predictions, as soon as there is a subscriber.
+                await self.has_subscribers.wait()
+            else:
+                await asyncio.sleep(batch_update_interval)
+                with suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self.new_points.wait(), predicted_update_interval - batch_update_interval)
             try:
                 await self.batch_update(self.riders_updated, self.riders_off_route_updated, self.riders_pre_post_updated)
             except asyncio.CancelledError:
@@ -509,75 +710,91 @@ class Event(object):
         if not self.riders_objects:
             return
         time = datetime.now()
+        analyse_riders_objects = [
+            rider_objects for rider_objects in self.riders_objects.values()
+            if isinstance(rider_objects.analyse_tracker, AnalyseTracker)]
+        predicted_points = get_predicted_positions(
+            [rider_objects.analyse_tracker for rider_objects in analyse_riders_objects], time)
         riders_predicted_points = {
-            rider_objects.rider_name: rider_objects.analyse_tracker.get_predicted_position(time) or {}
-            for rider_objects in self.riders_objects.values() if isinstance(rider_objects.analyse_tracker, AnalyseTracker)}
+            rider_objects.rider_name: predicted_point or {}
+            for rider_objects, predicted_point in zip(analyse_riders_objects, predicted_points)}
 
         sort_key_func = partial(self.rider_sort_key_func, riders_predicted_points)
-        rider_names_sorted = list(sorted(self.riders_objects.keys(), key=sort_key_func))
+        if len(self.rider_names_sorted) != len(self.riders_objects):
+            self.rider_names_sorted = list(self.riders_objects.keys())
+        # Sorting the order from the last update, which is mostly still in order, is close to linear.
+        self.rider_names_sorted = rider_names_sorted = sorted(self.rider_names_sorted, key=sort_key_func)
 
         leader = rider_names_sorted[0]
-        leader_objects = self.riders_objects[leader]
-        leader_points = [(0, self.event_start)]
-        last_point = None
-        if leader_objects.analyse_tracker:
-            for point in leader_objects.analyse_tracker.points:
-                if 'dist_route' in point:
-                    going_forward = point['dist_route'] > last_point['dist_route'] if last_point else True
-                    if going_forward:
-                        leader_points.append((point['dist_route'], point['time']))
-                        last_point = point
-        if 'dist_route' in riders_predicted_points.get(leader, ()):
-            leader_points.append((riders_predicted_points[leader]['dist_route'], time))
-
-        if leader_points:
-            self.riders_current_values[leader]['leader_time_diff'] = timedelta(0)
-            for rider_name in rider_names_sorted[1:]:
-                leader_time_diff = self.get_leader_time_diff(rider_name, riders_predicted_points,
-                                                             leader, leader_points, time)
-                if leader_time_diff is not None:
-                    if rider_name in riders_predicted_points:
-                        riders_predicted_points[rider_name]['leader_time_diff'] = leader_time_diff
-                    self.riders_current_values[rider_name]['leader_time_diff'] = leader_time_diff
-                else:
-                    with suppress(KeyError):
-                        del self.riders_current_values[rider_name]['leader_time_diff']
+        leader_curve = self.get_leader_curve(leader)
+        leader_predicted_point = riders_predicted_points.get(leader, {})
+        if 'dist_route' in leader_predicted_point:
+            leader_end_point = (leader_predicted_point['dist_route'], time)
+        else:
+            leader_end_point = None
+
+        self.riders_current_values[leader]['leader_time_diff'] = timedelta(0)
+        other_rider_names = rider_names_sorted[1:]
+        leader_time_diffs = self.get_leader_time_diffs(other_rider_names, riders_predicted_points, leader, leader_curve,
+                                                       leader_end_point)
+        for rider_name, leader_time_diff in zip(other_rider_names, leader_time_diffs):
+            if leader_time_diff is not None:
+                if rider_name in riders_predicted_points:
+                    riders_predicted_points[rider_name]['leader_time_diff'] = leader_time_diff
+                self.riders_current_values[rider_name]['leader_time_diff'] = leader_time_diff
+            else:
+                with suppress(KeyError):
+                    del self.riders_current_values[rider_name]['leader_time_diff']
 
         self.riders_predicted_points = {key: value for key, value in riders_predicted_points.items() if value}
         await self.batch_update_observable(self, time, riders_updated, riders_off_route_updated, riders_pre_post_updated)
 
-    def get_leader_time_diff(self, rider_name, riders_predicted_points, leader, leader_points, time):
-        rider_predicted_points = riders_predicted_points.get(rider_name)
-        rider_values = self.riders_current_values.get(rider_name)
-        if rider_values and 'finished_time' in rider_values:
-            leader_values = self.riders_current_values.get(leader)
-            if 'finished_time' in leader_values:
-                return rider_values['finished_time'] - leader_values['finished_time']
-
-        if rider_values and 'position_time' in rider_values:
-            rider_dist_route = None
-            rider_time = None
-            if rider_predicted_points and 'dist_route' in rider_predicted_points:
-                rider_dist_route = rider_predicted_points['dist_route']
-                rider_time = rider_predicted_points['time']
-            elif rider_values and 'dist_route' in rider_values:
-                rider_dist_route = rider_values['dist_route']
-                rider_time = rider_values['position_time']
-            if rider_dist_route:
-                i = bisect(leader_points, (rider_dist_route,))
-                if i < len(leader_points):
-                    point2 = leader_points[i]
-                    for back in range(i - 1, -1, -1):
-                        point1 = leader_points[back]
-                        if point1[0] < point2[0]:
-                            break
-                    try:
-                        interpolate = (rider_dist_route - point1[0]) / (point2[0] - point1[0])
-                    except FloatingPointError:
-                        pass
-                    else:
-                        interpolated_time = ((point2[1] - point1[1]) * interpolate) + point1[1]
-                        return rider_time - interpolated_time
+    def get_leader_curve(self, rider_name):
+        leader_curve = self.leader_curves.get(rider_name)
+        if leader_curve is None:
+            leader_curve = self.leader_curves[rider_name] = LeaderCurve(self.event_start)
+        analyse_tracker = self.riders_objects[rider_name].analyse_tracker
+        if analyse_tracker:
+            leader_curve.update(analyse_tracker.points)
+        return leader_curve
+
+    def get_leader_time_diffs(self, rider_names, riders_predicted_points, leader, leader_curve, leader_end_point):
+        """
+        Returns how far behind the leader each of rider_names is. Riders that are on the route are compared to when
+        the leader was at the same distance, which is interpolated for all the riders at once.
+        """
+        leader_values = self.riders_current_values.get(leader)
+        leader_time_diffs = [None] * len(rider_names)
+        interpolate_indexes = []
+        interpolate_dists = []
+        interpolate_times = []
+        for i, rider_name in enumerate(rider_names):
+            rider_values = self.riders_current_values.get(rider_name)
+            if rider_values and 'finished_time' in rider_values and leader_values and 'finished_time' in leader_values:
+                leader_time_diffs[i] = rider_values['finished_time'] - leader_values['finished_time']
+                continue
+
+            if rider_values and 'position_time' in rider_values:
+                rider_predicted_points = riders_predicted_points.get(rider_name)
+                if rider_predicted_points and 'dist_route' in rider_predicted_points:
+                    rider_dist_route = rider_predicted_points['dist_route']
+                    rider_time = rider_predicted_points['time']
+                elif 'dist_route' in rider_values:
+                    rider_dist_route = rider_values['dist_route']
+                    rider_time = rider_values['position_time']
+                else:
+                    continue
+                if rider_dist_route:
+                    interpolate_indexes.append(i)
+                    interpolate_dists.append(rider_dist_route)
+                    interpolate_times.append(rider_time)
+
+        if interpolate_indexes:
+            leader_times = leader_curve.interpolate(array(interpolate_dists, dtype=float64), leader_end_point)
+            for i, rider_time, leader_time in zip(interpolate_indexes, interpolate_times, leader_times.tolist()):
+                if not isnan(leader_time):
+                    leader_time_diffs[i] = rider_time - (leader_curve.ref_time + timedelta(seconds=leader_time))
+        return leader_time_diffs
 
     async def convert_to_static(self, tree_writer):
         try:
@@ -4,13 +4,13 @@ import hashlib
 import json
 import os
 from base64 import urlsafe_b64encode
-from copy import copy
+from collections.abc import Mapping, Sequence
 from dataclasses import asdict, is_dataclass
 from datetime import datetime, timedelta
 
 import msgpack
 
-from trackers.base import Tracker
+from trackers.base import DerivedPoint, Tracker
 from trackers.dulwich_helpers import TreeReader
 
 
@@ -21,6 +21,12 @@ def json_encode(obj):
         return obj.total_seconds()
     if is_dataclass(obj):
         return asdict(obj)
+    if isinstance(obj, Mapping):
+        # e.g. ColumnarPoint, DerivedPoint
+        return dict(obj)
+    if isinstance(obj, Sequence):
+        # e.g. ColumnarPoints
+        return list(obj)
 
 
 json_dumps = functools.partial(json.dumps, default=json_encode, sort_keys=True)
@@ -110,41 +116,80 @@ async def cropped_tracker_newpoints(cropped_tracker, start, end, org_tracker, ne
         await cropped_tracker.new_points(points)
 
 
-async def index_and_hash_tracker(org_tracker, hasher=None):
-    ih_tracker = Tracker('indexed_and_hashed.{}'.format(org_tracker.name), org_tracker.completed)
+async def index_and_hash_tracker(org_tracker, hasher=None, columnar_points=False):
+    ih_tracker = Tracker('indexed_and_hashed.{}'.format(org_tracker.name), org_tracker.completed,
+                         columnar_points=columnar_points)
     ih_tracker.stop = org_tracker.stop
     ih_tracker.org_tracker = org_tracker
     if hasher is None:
         hasher = hashlib.sha1()
     ih_tracker.hasher = hasher
+    # Copies of the hasher, every hasher_snapshot_every points, so that on a rewind, the hasher can be restored to
+    # its state at the rewind index, by only hashing the points from the snapshot before it.
+    ih_tracker.hasher_snapshots = [hasher.copy()]
 
     await index_and_hash_tracker_org_newpoints(ih_tracker, org_tracker, org_tracker.points)
     org_tracker.new_points_observable.subscribe(
         functools.partial(index_and_hash_tracker_org_newpoints, ih_tracker))
     org_tracker.reset_points_observable.subscribe(
         functools.partial(index_and_hash_tracker_org_reset_points, ih_tracker))
+    org_tracker.rewind_points_observable.subscribe(
+        functools.partial(index_and_hash_tracker_org_rewind_points, ih_tracker))
 
     return ih_tracker
 
 
+def hash_packer():
+    # Points are packed as a list of (key, value) pairs, sorted by key, so that the encoding does not depend on the order
+    # the keys were added in.
+    return msgpack.Packer(default=json_encode, use_bin_type=True)
+
+
 def index_and_hash_list(points, start, hasher):
-    ih_points = [copy(point) for point in points]
-    for i, (ih_point, org_point) in enumerate(zip(ih_points, points), start=start):
-        ih_point['index'] = i
-        hasher.update(json_dumps(org_point).encode())
-        ih_point['hash'] = urlsafe_b64encode(hasher.digest()[:3]).decode('ascii')
+    pack = hash_packer().pack
+    ih_points = []
+    for i, org_point in enumerate(points, start=start):
+        hasher.update(pack(sorted(org_point.items())))
+        ih_points.append(DerivedPoint(org_point, {'index': i, 'hash': urlsafe_b64encode(hasher.digest()[:3]).decode('ascii')}))
     return ih_points
 
 
+hasher_snapshot_every = 256
+
+
 async def index_and_hash_tracker_org_newpoints(ih_tracker, org_tracker, new_points):
-    ih_new_points = index_and_hash_list(new_points, len(ih_tracker.points), ih_tracker.hasher)
+    start = len(ih_tracker.points)
+    ih_new_points = []
+    chunk_start = 0
+    while chunk_start < len(new_points):
+        # Chunks end at the snapshot boundaries.
+        chunk_end = chunk_start + hasher_snapshot_every - (start + chunk_start) % hasher_snapshot_every
+        ih_new_points.extend(index_and_hash_list(new_points[chunk_start:chunk_end], start + chunk_start, ih_tracker.hasher))
+        chunk_start = min(chunk_end, len(new_points))
+        if (start + chunk_start) % hasher_snapshot_every == 0:
+            ih_tracker.hasher_snapshots.append(ih_tracker.hasher.copy())
     await ih_tracker.new_points(ih_new_points)
 
 
 async def index_and_hash_tracker_org_reset_points(ih_tracker, org_tracker):
+    # The hasher is not reset, so that the new points' hashes differ from the old points'.
+    ih_tracker.hasher_snapshots = [ih_tracker.hasher.copy()]
     await ih_tracker.reset_points()
 
 
+async def index_and_hash_tracker_org_rewind_points(ih_tracker, org_tracker, index):
+    # Points are indexed one to one, so rewind to the same index. The hasher is restored to its state after the
+    # points before index, so that the replacement points get the same hashes as they would have if they were never
+    # rewound (e.g. after a restart.) The org tracker has already been rewound, and its points before index are the
+    # same.
+    snapshot_i = index // hasher_snapshot_every
+    del ih_tracker.hasher_snapshots[snapshot_i + 1:]
+    ih_tracker.hasher = ih_tracker.hasher_snapshots[snapshot_i].copy()
+    snapshot_index = snapshot_i * hasher_snapshot_every
+    index_and_hash_list(org_tracker.points[snapshot_index:index], snapshot_index, ih_tracker.hasher)
+    await ih_tracker.rewind_points(index)
+
+
 async def filter_inaccurate_tracker_start(org_tracker, tracker_data):
     filtered_tracker = Tracker('filter_inaccurate.{}'.format(org_tracker.name), org_tracker.completed)
     filtered_tracker.stop = org_tracker.stop
@@ -160,7 +205,7 @@ async def filter_inaccurate_tracker_newpoints(filtered_tracker, org_tracker, new
     points = []
     for point in new_points:
         if point.get('accuracy', 0) >= 500:
-            point = copy(point)
+            point = DerivedPoint(point)
             del point['position']
         points.append(point)
     if points:
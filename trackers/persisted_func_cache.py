@@ -1,16 +1,67 @@
 import logging
+import queue
+import sqlite3
+import threading
+import time
+from itertools import chain
 
 import msgpack
 
 
+class BackgroundWriter(object):
+    """
+    Calls write with the items passed to submit, in a background thread, so that writing does not block the event
+    loop. Items submitted within interval seconds of each other are coalesced into one call to write.
+    """
+
+    def __init__(self, name, write, interval=1, on_stop=None):
+        self.write = write
+        self.interval = interval
+        self.on_stop = on_stop
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name=f'background_writer.{name}', daemon=True)
+        self.thread.start()
+
+    def submit(self, items):
+        self.queue.put(items)
+
+    def run(self):
+        stop = False
+        while not stop:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.interval
+            while batch[-1] is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                stop = True
+                batch.pop()
+            if batch:
+                self.write(batch)
+        if self.on_stop:
+            self.on_stop()
+
+    def close(self):
+        """Write everything submitted, and stop the thread."""
+        self.queue.put(None)
+        self.thread.join()
+
+
 class PersistedFuncCache(object):
 
-    def __init__(self, path, func=None):
+    def __init__(self, path, func=None, write_in_background=False, write_every=10):
         self.func = func
         self.path = path
+        self.write_every = write_every
         self.load()
         self.unwritten_cache_items = []
         self.logger = logging.getLogger(f'persisted_func_cache.{path}')
+        self.writer = BackgroundWriter(path, self.write_batch) if write_in_background else None
 
     def load(self):
         self.cache = {}
@@ -36,21 +87,34 @@ class PersistedFuncCache(object):
             packed = self.pack(value)
             self.cache[key] = packed
             self.unwritten_cache_items.append((key, packed))
-            if len(self.unwritten_cache_items) >= 10:
+            if len(self.unwritten_cache_items) >= self.write_every:
                 self.write_unwritten()
             return value
         else:
             return self.unpack(packed)
 
     def write_unwritten(self):
+        items = self.unwritten_cache_items
+        if not items:
+            return
+        self.unwritten_cache_items = []
+        if self.writer:
+            self.writer.submit(items)
+        else:
+            self.write_batch([items])
+
+    def write_batch(self, batch):
         try:
-            items = self.unwritten_cache_items
-            self.unwritten_cache_items = []
             with open(self.path, 'ab') as f:
-                msgpack.pack(items, f)
+                msgpack.pack(list(chain.from_iterable(batch)), f)
         except Exception:
             self.logger.exception('Error writing unwritten: ')
 
+    def close(self):
+        self.write_unwritten()
+        if self.writer:
+            self.writer.close()
+
     def key(self, *args, **kwargs):
         return args, tuple(sorted(kwargs.items()))
 
@@ -59,3 +123,123 @@ class PersistedFuncCache(object):
 
     def unpack(self, packed):
         return packed
+
+
+class SqlitePersistedFuncCache(PersistedFuncCache):
+    """
+    Like PersistedFuncCache, but stored in an sqlite database, indexed by key. Items are looked up when they are
+    needed, rather than all being loaded at start up. When there are more than max_items, the least recently used
+    items are removed, and the file is compacted.
+    """
+
+    def __init__(self, path, func=None, max_items=1000000, write_every=10, write_in_background=False):
+        self.func = func
+        self.path = path
+        self.max_items = max_items
+        self.write_every = write_every
+        self.logger = logging.getLogger(f'persisted_func_cache.{path}')
+        self.load()
+        # Items submitted to the background writer, that it has not written yet.
+        self.writing_cache_items = {}
+        # The background writer uses its own connection, as sqlite connections can only be used by one thread.
+        self.writer_db = None
+        self.writer = BackgroundWriter(path, self.write_batch, on_stop=self.close_writer_db) if write_in_background else None
+
+    def load(self):
+        # close may be called from another thread (e.g. an executor), so that it does not block the event loop.
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        # auto_vacuum has to be set before the table is created.
+        self.db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS cache (key BLOB PRIMARY KEY, value BLOB, last_used INTEGER)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS cache_last_used ON cache (last_used)')
+        self.items_count, last_used = self.db.execute('SELECT count(*), max(last_used) FROM cache').fetchone()
+        self.use_counter = last_used or 0
+        # Keys to packed values not yet written.
+        self.unwritten_cache_items = {}
+        # Keys to use_counter, of the items used since the last write.
+        self.used_keys = {}
+
+    def __call__(self, *args, **kwargs):
+        key = msgpack.dumps(self.key(*args, **kwargs))
+        self.use_counter += 1
+        self.used_keys[key] = self.use_counter
+        try:
+            packed = self.unwritten_cache_items[key]
+        except KeyError:
+            try:
+                packed = self.writing_cache_items[key]
+            except KeyError:
+                row = self.db.execute('SELECT value FROM cache WHERE key = ?', (key, )).fetchone()
+                if row is None:
+                    value = self.func(*args, **kwargs)
+                    self.unwritten_cache_items[key] = self.pack(value)
+                    if len(self.unwritten_cache_items) >= self.write_every:
+                        self.write_unwritten()
+                    return value
+                packed = msgpack.loads(row[0], use_list=False, raw=False)
+        if len(self.used_keys) >= self.write_every * 100:
+            self.write_unwritten()
+        return self.unpack(packed)
+
+    def write_unwritten(self):
+        items = self.unwritten_cache_items
+        used_keys = self.used_keys
+        if not items and not used_keys:
+            return
+        self.unwritten_cache_items = {}
+        self.used_keys = {}
+        if self.writer:
+            self.writing_cache_items.update(items)
+            self.writer.submit((items, used_keys))
+        else:
+            self.write_batch([(items, used_keys)])
+
+    def write_batch(self, batch):
+        if self.writer:
+            if self.writer_db is None:
+                self.writer_db = sqlite3.connect(self.path)
+            db = self.writer_db
+        else:
+            db = self.db
+
+        items = {}
+        used_keys = {}
+        for batch_items, batch_used_keys in batch:
+            items.update(batch_items)
+            used_keys.update(batch_used_keys)
+        try:
+            with db:
+                db.executemany(
+                    'INSERT OR REPLACE INTO cache (key, value, last_used) VALUES (?, ?, ?)',
+                    [(key, msgpack.dumps(packed), used_keys.pop(key, self.use_counter)) for key, packed in items.items()])
+                db.executemany('UPDATE cache SET last_used = ? WHERE key = ?', [(last_used, key) for key, last_used in used_keys.items()])
+            self.items_count += len(items)
+            if self.items_count > self.max_items:
+                self.remove_least_recently_used(db)
+        except Exception:
+            self.logger.exception('Error writing unwritten: ')
+        finally:
+            for key in items:
+                self.writing_cache_items.pop(key, None)
+
+    def remove_least_recently_used(self, db):
+        # Remove 10% more than needed, so that this does not need to happen on every write.
+        remove_count = self.items_count - int(self.max_items * 0.9)
+        with db:
+            db.execute('DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY last_used LIMIT ?)', (remove_count, ))
+        # executescript, as execute only steps the pragma once, which frees one page.
+        db.executescript('PRAGMA incremental_vacuum;')
+        self.items_count = db.execute('SELECT count(*) FROM cache').fetchone()[0]
+        self.logger.info(f'Removed {remove_count} least recently used items.')
+
+    def close_writer_db(self):
+        if self.writer_db:
+            self.writer_db.close()
+            self.writer_db = None
+
+    def close(self):
+        super().close()
+        self.db.close()
@@ -350,9 +350,24 @@ function subscriptions_updated() {
     });
 }
 
+function get_known_for_list_container(list_container){
+    // The last point we have of each rider, so that the server only sends what we are missing.
+    var known = {};
+    Object.entries(list_container).forEach(function (entry){
+        var list = entry[1];
+        if (list.length) known[entry[0]] = {'index': list.length - 1, 'hash': list[list.length - 1].hash};
+    });
+    return known;
+}
+
 function send_subscriptions_to_ws(){
     var subscriptions_for_server = Object.keys(subscriptions).filter(function (name) {return subscriptions[name] > 0});
-    var data = JSON.stringify({'subscriptions': subscriptions_for_server});
+    var known = {
+        'riders_points': get_known_for_list_container(riders_points),
+        'riders_off_route': get_known_for_list_container(riders_off_route),
+        'riders_pre_post': get_known_for_list_container(riders_pre_post),
+    };
+    var data = JSON.stringify({'subscriptions': subscriptions_for_server, 'known': known});
     // console.log(data);
     ws.send(data);
 }
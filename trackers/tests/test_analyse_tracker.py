@@ -1,13 +1,28 @@
 import asyncio
+import os
 import pprint
+import tempfile
 import unittest
 from datetime import datetime, timedelta
 
 import asynctest
-
-from trackers.analyse import AnalyseTracker, get_analyse_routes, route_elevation
+from numpy import array, array_equal
+
+from trackers.analyse import (
+    AnalyseProcessPool,
+    AnalyseTracker,
+    find_closest_point_pair_routes_batch,
+    get_analyse_routes,
+    get_analyse_routes_cached,
+    load_routes_arrays,
+    Point,
+    route_elevation,
+    route_from_arrays,
+    save_routes_arrays,
+)
 from trackers.base import Tracker
 from trackers.bin_utils import process_secondary_route_details
+from trackers.persisted_func_cache import SqlitePersistedFuncCache
 
 
 def d(date_string):
@@ -239,6 +254,263 @@ class TestAnalyseTracker(asynctest.TestCase):
             {'dist_route': 166916.0},
         ])
 
+    async def analyse_circular_route(self, **kwargs):
+        tracker = Tracker('test')
+        routes = [
+            {
+                'main': True,
+                'points': [
+                    [-27.88125, 27.91984],
+                    [-27.86221, 27.91700],
+                    [-27.74355, 27.94248],
+                    [-27.84379, 28.16451],
+                    [-27.94558, 28.04493],
+                    [-27.88049, 27.91745],
+                    [-27.86044, 27.91808],
+                    [-27.77983, 27.74638],
+                    [-27.90019, 27.66862],
+                    [-28.04381, 27.96971],
+                    [-27.93335, 28.02870],
+                    [-27.88125, 27.91984],
+                ],
+                'split_at_dist': [35000, 115000],
+                'split_point_range': 10000,
+                'circular_range': 50000,
+            },
+        ]
+        event_routes = get_analyse_routes(routes)
+
+        await tracker.new_points((
+            {'time': d('2017/01/01 01:05:00'), 'position': (-27.88049, 27.91745, 1800)},
+            {'time': d('2017/01/01 02:00:00'), 'position': (-27.84379, 28.16451, 1800)},
+            {'time': d('2017/01/01 03:00:00'), 'position': (-27.94558, 28.04493, 1800)},
+            {'time': d('2017/01/01 04:00:00'), 'position': (-27.88125, 27.91984, 1800)},
+            {'time': d('2017/01/01 05:00:00'), 'position': (-27.77983, 27.74638, 1800)},
+            {'time': d('2017/01/01 06:00:00'), 'position': (-28.04381, 27.96971, 1800)},
+            {'time': d('2017/01/01 07:00:00'), 'position': (-27.88049, 27.91745, 1800)},
+        ))
+        tracker.completed.set_result(None)
+        with tempfile.TemporaryDirectory() as routes_arrays_dir:
+            analyse_pool = kwargs.pop('analyse_pool', None)
+            if analyse_pool:
+                routes_arrays_path = os.path.join(routes_arrays_dir, 'routes')
+                save_routes_arrays(routes_arrays_path, event_routes)
+                kwargs['analyse_pool'] = analyse_pool = analyse_pool(routes_arrays_path)
+            try:
+                analyse_tracker = await AnalyseTracker.start(tracker, d('2017/01/01 01:00:00'), event_routes, **kwargs)
+                await analyse_tracker.complete()
+            finally:
+                if analyse_pool:
+                    analyse_pool.shutdown()
+
+        points = filter_keys(analyse_tracker.points, ('dist_route', ))
+        print_points(points)
+        # Same results as the per point analyse in test_with_circular_route
+        self.assertSequenceEqual(points, [
+            {'dist_route': 114.0},
+            {'dist_route': 40054.0},
+            {'dist_route': 56359.0},
+            {'dist_route': 70588.0},
+            {'dist_route': 92187.0},
+            {'dist_route': 141196.0},
+            {'dist_route': 166916.0},
+        ])
+
+    async def test_with_circular_route_rewind(self):
+        tracker = Tracker('test')
+        routes = [
+            {
+                'main': True,
+                'points': [
+                    [-27.88125, 27.91984],
+                    [-27.86221, 27.91700],
+                    [-27.74355, 27.94248],
+                    [-27.84379, 28.16451],
+                    [-27.94558, 28.04493],
+                    [-27.88049, 27.91745],
+                    [-27.86044, 27.91808],
+                    [-27.77983, 27.74638],
+                    [-27.90019, 27.66862],
+                    [-28.04381, 27.96971],
+                    [-27.93335, 28.02870],
+                    [-27.88125, 27.91984],
+                ],
+                'split_at_dist': [35000, 115000],
+                'split_point_range': 10000,
+                'circular_range': 50000,
+            },
+        ]
+        event_routes = get_analyse_routes(routes)
+        points = [
+            {'time': d('2017/01/01 01:05:00'), 'position': (-27.88049, 27.91745, 1800)},
+            {'time': d('2017/01/01 02:00:00'), 'position': (-27.84379, 28.16451, 1800)},
+            {'time': d('2017/01/01 03:00:00'), 'position': (-27.94558, 28.04493, 1800)},
+            {'time': d('2017/01/01 04:00:00'), 'position': (-27.88125, 27.91984, 1800)},
+            {'time': d('2017/01/01 05:00:00'), 'position': (-27.77983, 27.74638, 1800)},
+            {'time': d('2017/01/01 06:00:00'), 'position': (-28.04381, 27.96971, 1800)},
+            {'time': d('2017/01/01 07:00:00'), 'position': (-27.88049, 27.91745, 1800)},
+        ]
+        await tracker.new_points(points)
+        analyse_tracker = await AnalyseTracker.start(tracker, d('2017/01/01 01:00:00'), event_routes, checkpoint_every=2)
+        await analyse_tracker.process_initial_points_fut
+        first_points = analyse_tracker.points[:4]
+
+        reset_points_callback = asynctest.CoroutineMock()
+        analyse_tracker.reset_points_observable.subscribe(reset_points_callback)
+        rewind_points_callback = asynctest.CoroutineMock()
+        analyse_tracker.rewind_points_observable.subscribe(rewind_points_callback)
+
+        # Rewind to 5 resumes from the checkpoint after 4 points.
+        await tracker.rewind_points(5)
+        rewind_points_callback.assert_called_once_with(analyse_tracker, 4)
+        reset_points_callback.assert_not_called()
+        self.assertEqual(len(analyse_tracker.points), 5)
+        self.assertEqual(analyse_tracker.points[:4], first_points)
+        self.assertIs(analyse_tracker.points[0], first_points[0])
+
+        await tracker.new_points(points[5:])
+        tracker.completed.set_result(None)
+        await analyse_tracker.complete()
+
+        points = filter_keys(analyse_tracker.points, ('dist_route', ))
+        print_points(points)
+        # Same results as without the rewind.
+        self.assertSequenceEqual(points, [
+            {'dist_route': 114.0},
+            {'dist_route': 40054.0},
+            {'dist_route': 56359.0},
+            {'dist_route': 70588.0},
+            {'dist_route': 92187.0},
+            {'dist_route': 141196.0},
+            {'dist_route': 166916.0},
+        ])
+
+    async def test_with_circular_route_save_load_state(self):
+        routes = [
+            {
+                'main': True,
+                'points': [
+                    [-27.88125, 27.91984],
+                    [-27.86221, 27.91700],
+                    [-27.74355, 27.94248],
+                    [-27.84379, 28.16451],
+                    [-27.94558, 28.04493],
+                    [-27.88049, 27.91745],
+                    [-27.86044, 27.91808],
+                    [-27.77983, 27.74638],
+                    [-27.90019, 27.66862],
+                    [-28.04381, 27.96971],
+                    [-27.93335, 28.02870],
+                    [-27.88125, 27.91984],
+                ],
+                'split_at_dist': [35000, 115000],
+                'split_point_range': 10000,
+                'circular_range': 50000,
+            },
+        ]
+        points = [
+            {'time': d('2017/01/01 01:05:00'), 'position': (-27.88049, 27.91745, 1800)},
+            {'time': d('2017/01/01 02:00:00'), 'position': (-27.84379, 28.16451, 1800)},
+            {'time': d('2017/01/01 03:00:00'), 'position': (-27.94558, 28.04493, 1800)},
+            {'time': d('2017/01/01 04:00:00'), 'position': (-27.88125, 27.91984, 1800)},
+            {'time': d('2017/01/01 05:00:00'), 'position': (-27.77983, 27.74638, 1800)},
+            {'time': d('2017/01/01 06:00:00'), 'position': (-28.04381, 27.96971, 1800)},
+            {'time': d('2017/01/01 07:00:00'), 'position': (-27.88049, 27.91745, 1800)},
+        ]
+
+        with tempfile.TemporaryDirectory() as state_dir:
+            state_path = os.path.join(state_dir, 'state')
+
+            tracker = Tracker('test')
+            await tracker.new_points(points[:4])
+            analyse_tracker = await AnalyseTracker.start(tracker, d('2017/01/01 01:00:00'), get_analyse_routes(routes))
+            await analyse_tracker.process_initial_points_fut
+            await analyse_tracker.save_state(state_path)
+            tracker.completed.set_result(None)
+            await analyse_tracker.complete()
+
+            # Start again, with more points. Only the new points get analysed.
+            tracker = Tracker('test')
+            await tracker.new_points(points)
+            tracker.completed.set_result(None)
+            analyse_tracker = await AnalyseTracker.start(
+                tracker, d('2017/01/01 01:00:00'), get_analyse_routes(routes), state_path=state_path)
+            self.assertEqual(len(analyse_tracker.points), 4)
+            await analyse_tracker.complete()
+            self.assertEqual(analyse_tracker.analysed_count, 7)
+
+            analysed_points = filter_keys(analyse_tracker.points, ('dist_route', ))
+            print_points(analysed_points)
+            # Same results as analysing all the points at once.
+            self.assertSequenceEqual(analysed_points, [
+                {'dist_route': 114.0},
+                {'dist_route': 40054.0},
+                {'dist_route': 56359.0},
+                {'dist_route': 70588.0},
+                {'dist_route': 92187.0},
+                {'dist_route': 141196.0},
+                {'dist_route': 166916.0},
+            ])
+
+            # Different points, so the state is not used.
+            tracker = Tracker('test')
+            await tracker.new_points(points[1:])
+            tracker.completed.set_result(None)
+            analyse_tracker = await AnalyseTracker.start(
+                tracker, d('2017/01/01 01:00:00'), get_analyse_routes(routes), state_path=state_path)
+            self.assertEqual(len(analyse_tracker.points), 0)
+            await analyse_tracker.complete()
+
+    async def test_save_state_periodically(self):
+        points = [
+            {'time': d('2017/01/01 05:00:00'), 'position': (-26.300822, 28.049444, 1800)},
+            {'time': d('2017/01/01 05:01:00'), 'position': (-26.302245, 28.051139, 1800)},
+        ]
+        with tempfile.TemporaryDirectory() as state_dir:
+            state_path = os.path.join(state_dir, 'state')
+
+            tracker = Tracker('test')
+            await tracker.new_points(points[:1])
+            analyse_tracker = await AnalyseTracker.start(
+                tracker, d('2017/01/01 05:00:00'), [], state_path=state_path, save_state_interval=timedelta(0))
+            await analyse_tracker.process_initial_points_fut
+            # Saved in the background, without stopping the tracker.
+            await analyse_tracker.save_state_fut
+            self.assertTrue(os.path.exists(state_path))
+
+            await tracker.new_points(points[1:])
+            await analyse_tracker.save_state_fut
+            tracker.completed.set_result(None)
+            await analyse_tracker.complete()
+
+            tracker = Tracker('test')
+            await tracker.new_points(points)
+            tracker.completed.set_result(None)
+            analyse_tracker = await AnalyseTracker.start(tracker, d('2017/01/01 05:00:00'), [], state_path=state_path)
+            self.assertEqual(len(analyse_tracker.points), 2)
+            self.assertEqual(analyse_tracker.analysed_count, 2)
+            await analyse_tracker.complete()
+
+    async def test_with_circular_route_bulk(self):
+        await self.analyse_circular_route(bulk_min_points=1)
+
+    async def test_with_circular_route_analyse_pool(self):
+        await self.analyse_circular_route(
+            bulk_min_points=1, analyse_pool=lambda path: AnalyseProcessPool(path, max_workers=2, chunk_size=3))
+
+    async def test_with_circular_route_quantized_find_closest_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            find_closest_cache = SqlitePersistedFuncCache(os.path.join(cache_dir, 'find_closest'))
+            await self.analyse_circular_route(find_closest_cache=find_closest_cache, find_closest_quantum=0.00003)
+            find_closest_cache.write_unwritten()
+            items_count = find_closest_cache.items_count
+
+            # Second time, all from the cache
+            await self.analyse_circular_route(find_closest_cache=find_closest_cache, find_closest_quantum=0.00003)
+            find_closest_cache.write_unwritten()
+            self.assertEqual(find_closest_cache.items_count, items_count)
+            find_closest_cache.close()
+
     async def test_get_predicted_position(self):
         tracker = Tracker('test')
         routes = [
@@ -354,3 +626,76 @@ class TestRouteElevation(unittest.TestCase):
         self.assertEqual(route_elevation(routes[0], 1113), 200)
         self.assertEqual(route_elevation(routes[0], 1669.5), 250)
         self.assertEqual(route_elevation(routes[0], 2226), 300)
+
+
+class TestRoutesArrays(unittest.TestCase):
+
+    def test_save_load(self):
+        routes = [
+            {
+                'main': True,
+                'points': [
+                    [-26.300420, 28.049410],
+                    [-26.315685, 28.062377],
+                    [-26.381378, 28.067689],
+                    [-26.417153, 28.072707],
+                ],
+            },
+            {
+                'points': [
+                    [-26.315685, 28.062377],
+                    [-26.324918, 27.985781],
+                    [-26.381378, 28.067689],
+                ],
+            },
+        ]
+        process_secondary_route_details(routes)
+        event_routes = get_analyse_routes(routes)
+
+        with tempfile.TemporaryDirectory() as routes_arrays_dir:
+            routes_arrays_path = os.path.join(routes_arrays_dir, 'routes')
+            save_routes_arrays(routes_arrays_path, event_routes)
+            array_routes = [route_from_arrays(arrays) for arrays in load_routes_arrays(routes_arrays_path)]
+
+            self.assertEqual(len(array_routes), 2)
+            self.assertEqual(array_routes[0]['main'], True)
+            self.assertEqual(array_routes[1]['main'], False)
+            self.assertEqual(array_routes[1]['start_distance'], event_routes[1]['start_distance'])
+
+            points = [Point(-26.300824, 28.050185), Point(-26.325051, 27.985600), Point(-26.417149, 28.073087)]
+            to_points_nv = array([point.nv.reshape((3, )) for point in points])
+            to_points_pv = array([point.pv.reshape((3, )) for point in points])
+            expected = find_closest_point_pair_routes_batch(event_routes, to_points_nv, to_points_pv)
+            result = find_closest_point_pair_routes_batch(array_routes, to_points_nv, to_points_pv)
+            for expected_point, result_point in zip(expected, result):
+                for expected_route, result_route in zip(expected_point, result_point):
+                    self.assertTrue(array_equal(expected_route.simplified_top, result_route.simplified_top))
+                    self.assertTrue(array_equal(expected_route.point_pair_indexes, result_route.point_pair_indexes))
+                    self.assertTrue(array_equal(expected_route.c_points.dist, result_route.c_points.dist))
+
+    def test_get_analyse_routes_cached(self):
+        routes = [
+            {
+                'main': True,
+                'points': [
+                    [-26.300420, 28.049410],
+                    [-26.315691, 28.062354],
+                    [-26.322250, 28.042440],
+                ]
+            },
+        ]
+        with tempfile.TemporaryDirectory() as routes_arrays_dir:
+            routes_arrays_path = os.path.join(routes_arrays_dir, 'routes')
+            event_routes = get_analyse_routes_cached(routes, routes_arrays_path)
+            self.assertTrue(os.path.exists(routes_arrays_path))
+
+            cached_event_routes = get_analyse_routes_cached(routes, routes_arrays_path)
+            self.assertEqual(cached_event_routes[0].keys(), event_routes[0].keys())
+            self.assertEqual(cached_event_routes[0]['points'], event_routes[0]['points'])
+            self.assertEqual(
+                [point.distance for point in cached_event_routes[0]['points']],
+                [point.distance for point in event_routes[0]['points']])
+            self.assertEqual(
+                [point_pair[:2] for point_pair in cached_event_routes[0]['simplfied_point_pairs']],
+                [point_pair[:2] for point_pair in event_routes[0]['simplfied_point_pairs']])
+            self.assertTrue(array_equal(cached_event_routes[0]['points_pv'], event_routes[0]['points_pv']))
@@ -1,19 +1,23 @@
 import asyncio
 import json
 import logging
+import os
 import sys
-from datetime import datetime
+import tempfile
+import time
+from datetime import datetime, timedelta
 
-from trackers.analyse import AnalyseTracker, get_analyse_routes
+from trackers.analyse import AnalyseProcessPool, AnalyseTracker, get_analyse_routes, save_routes_arrays
 from trackers.base import Tracker
 
 
 tracker = None
 event_routes = None
+analyse_start_time = None
 
 
 async def setup():
-    global tracker, event_routes
+    global tracker, event_routes, analyse_start_time
 
     with open('test_analyse_tracker_routes.json') as f:
         routes = json.load(f)
@@ -26,15 +30,38 @@ async def setup():
     for point in points:
         point['time'] = datetime.fromtimestamp(point['time'])
     await tracker.new_points(points)
+    tracker.completed.set_result(None)
+    analyse_start_time = points[0]['time'] - timedelta(hours=1)
 
 
-async def test():
-    await AnalyseTracker.start(tracker, None, event_routes)
+async def analyse(bulk_min_points, analyse_pool=None):
+    start = time.perf_counter()
+    analyse_tracker = await AnalyseTracker.start(tracker, analyse_start_time, event_routes, bulk_min_points=bulk_min_points,
+                                                 analyse_pool=analyse_pool)
+    await analyse_tracker.complete()
+    return time.perf_counter() - start, [point for point in analyse_tracker.points if 'position' in point]
 
 
 if __name__ == '__main__':
-    logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 
     loop = asyncio.get_event_loop()
     loop.run_until_complete(setup())
-    loop.run_until_complete(test())
+    per_point_time, per_point_points = loop.run_until_complete(analyse(bulk_min_points=sys.maxsize))
+    bulk_time, bulk_points = loop.run_until_complete(analyse(bulk_min_points=1))
+    assert per_point_points == bulk_points, 'Bulk analyse output differs from per point analyse.'
+    print(f'{len(tracker.points)} points. Per point: {per_point_time:.3f} sec. Bulk: {bulk_time:.3f} sec. '
+          f'Speedup: {per_point_time / bulk_time:.1f}x')
+
+    with tempfile.TemporaryDirectory() as routes_arrays_dir:
+        routes_arrays_path = os.path.join(routes_arrays_dir, 'routes')
+        save_routes_arrays(routes_arrays_path, event_routes)
+        analyse_pool = AnalyseProcessPool(routes_arrays_path, chunk_size=100)
+        try:
+            # First run warms up the worker processes.
+            loop.run_until_complete(analyse(bulk_min_points=1, analyse_pool=analyse_pool))
+            pool_time, pool_points = loop.run_until_complete(analyse(bulk_min_points=1, analyse_pool=analyse_pool))
+        finally:
+            analyse_pool.shutdown()
+    assert per_point_points == pool_points, 'Bulk analyse with analyse pool output differs from per point analyse.'
+    print(f'Bulk with analyse pool: {pool_time:.3f} sec. Speedup: {per_point_time / pool_time:.1f}x')
@@ -1,4 +1,5 @@
 import asyncio
+import copy
 import logging
 import unittest
 import unittest.mock
@@ -7,6 +8,7 @@ import asynctest
 
 from trackers.base import (
     cancel_and_wait_task,
+    DerivedPoint,
     list_register,
     Observable,
     Tracker,
@@ -88,3 +90,38 @@ class TestTracker(asynctest.TestCase):
         tracker.stop()
         await tracker.complete()
         self.assertTrue(tracker.completed.done())
+
+
+class TestDerivedPoint(unittest.TestCase):
+
+    def test(self):
+        source = {'time': 1, 'position': (1, 2, 3)}
+        point = DerivedPoint(source)
+        point['dist_route'] = 10
+        point['position'] = (1, 2)
+        del point['time']
+
+        self.assertEqual(point, {'position': (1, 2), 'dist_route': 10})
+        self.assertEqual(len(point), 2)
+        self.assertNotIn('time', point)
+        self.assertIsNone(point.get('time'))
+        with self.assertRaises(KeyError):
+            point['time']
+        # The source is not changed.
+        self.assertEqual(source, {'time': 1, 'position': (1, 2, 3)})
+
+        point['time'] = 2
+        self.assertEqual(point['time'], 2)
+        del point['dist_route']
+        self.assertEqual(point.own, {'time': 2, 'position': (1, 2)})
+
+    def test_reads_source(self):
+        source = {'time': 1}
+        point = DerivedPoint(source, {'index': 0})
+        source['time'] = 2
+        self.assertEqual(point, {'time': 2, 'index': 0})
+
+    def test_copy(self):
+        point = DerivedPoint({'time': 1}, {'index': 0})
+        self.assertEqual(type(copy.copy(point)), dict)
+        self.assertEqual(copy.deepcopy(point), {'time': 1, 'index': 0})
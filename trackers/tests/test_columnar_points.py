@@ -0,0 +1,125 @@
+import copy
+import hashlib
+import unittest
+from datetime import datetime
+
+import asynctest
+
+from trackers.base import Tracker
+from trackers.columnar_points import ColumnarPoints
+from trackers.general import index_and_hash_list, index_and_hash_tracker, json_dumps
+
+
+points = [
+    {'time': datetime(2017, 1, 1, 6, 0, 0, 123456), 'position': (-26.300822, 28.049444, 1800.0), 'accuracy': 5},
+    {'time': datetime(2017, 1, 1, 6, 1), 'position': (-26.302245, 28.051139, 1800), 'dist_route': 12},
+    {'server_time': datetime(2017, 1, 1, 6, 2), 'status': 'Online'},
+]
+
+
+class TestColumnarPoints(unittest.TestCase):
+
+    def test_round_trip(self):
+        store = ColumnarPoints(points, capacity=1)
+        self.assertEqual(len(store), 3)
+        self.assertEqual(store, points)
+        self.assertEqual(list(store), points)
+        self.assertEqual(store[-1], points[-1])
+        self.assertEqual(store[1:], points[1:])
+        for point, org_point in zip(store, points):
+            self.assertEqual(set(point), set(org_point))
+            for key, value in org_point.items():
+                self.assertEqual(type(point[key]), type(value))
+        with self.assertRaises(IndexError):
+            store[3]
+
+    def test_side_table(self):
+        store = ColumnarPoints(points)
+        # Only the keys that are not columns, or values that can't be stored in a column exactly are in the side table.
+        self.assertEqual(store.side, {
+            0: {'accuracy': 5},
+            1: {'position': (-26.302245, 28.051139, 1800)},
+            2: {'status': 'Online'},
+        })
+        self.assertEqual(store.present('position').tolist(), [True, False, False])
+        self.assertEqual(store.column('dist_route')[1], 12)
+
+    def test_position_kinds(self):
+        # Sources make positions as lists and tuples, with and without an alt.
+        position_points = [
+            {'position': (-26.300822, 28.049444, 1800.0)},
+            {'position': (-26.300822, 28.049444)},
+            {'position': [-26.300822, 28.049444, 1800.0]},
+            {'position': [-26.300822, 28.049444]},
+            {'position': [-26.300822, 28.049444, 1800]},
+            {'dist_route': 12.5},
+        ]
+        store = ColumnarPoints(position_points)
+        self.assertEqual(store.present('position').tolist(), [True, True, True, True, False, False])
+        self.assertEqual(store.side, {4: {'position': [-26.300822, 28.049444, 1800]}, 5: {'dist_route': 12.5}})
+        for point, org_point in zip(store, position_points):
+            for key, value in org_point.items():
+                self.assertEqual(point[key], value)
+                self.assertEqual(type(point[key]), type(value))
+
+    def test_set_and_del(self):
+        store = ColumnarPoints(points)
+        point = store[1]
+        point['position'] = (-27.0, 28.0, 1700.0)
+        point['foo'] = 'bar'
+        self.assertEqual(store.side[1], {'foo': 'bar'})
+        del point['dist_route']
+        del point['foo']
+        self.assertEqual(dict(store[1]), {'time': datetime(2017, 1, 1, 6, 1), 'position': (-27.0, 28.0, 1700.0)})
+        with self.assertRaises(KeyError):
+            del point['foo']
+
+    def test_copy(self):
+        store = ColumnarPoints(points)
+        point_copy = copy.copy(store[0])
+        self.assertIs(type(point_copy), dict)
+        self.assertEqual(point_copy, points[0])
+        self.assertEqual(copy.deepcopy(store[2]), points[2])
+        self.assertEqual(store.copy(), points)
+
+    def test_extend_from_store(self):
+        store = ColumnarPoints(points)
+        other_store = ColumnarPoints(store[1:])
+        self.assertEqual(other_store, points[1:])
+        # The side table dicts are copied, not shared.
+        other_store[1]['status'] = 'Offline'
+        self.assertEqual(store[2]['status'], 'Online')
+
+    def test_del_to_end(self):
+        store = ColumnarPoints(points)
+        del store[1:]
+        self.assertEqual(store, points[:1])
+        self.assertEqual(store.side, {0: {'accuracy': 5}})
+        store.extend(points[1:])
+        self.assertEqual(store, points)
+        with self.assertRaises(TypeError):
+            del store[0]
+
+    def test_json_dumps(self):
+        self.assertEqual(json_dumps(list(ColumnarPoints(points))), json_dumps(points))
+
+    def test_index_and_hash_list(self):
+        self.assertEqual(
+            index_and_hash_list(ColumnarPoints(points), 0, hashlib.sha1()),
+            index_and_hash_list(points, 0, hashlib.sha1()),
+        )
+
+
+class TestColumnarPointsTracker(asynctest.TestCase):
+
+    async def test_index_and_hash_tracker(self):
+        tracker = Tracker('test')
+        await tracker.new_points(points)
+        ih_tracker = await index_and_hash_tracker(tracker, columnar_points=True)
+        self.assertIsInstance(ih_tracker.points, ColumnarPoints)
+        self.assertEqual(ih_tracker.points, index_and_hash_list(points, 0, hashlib.sha1()))
+        self.assertEqual(ih_tracker.points.side[0], {'accuracy': 5})
+
+        await tracker.reset_points()
+        self.assertIsInstance(ih_tracker.points, ColumnarPoints)
+        self.assertEqual(len(ih_tracker.points), 0)
@@ -46,3 +46,40 @@ class TestCombinedTracker(asynctest.TestCase):
 
         combined.stop()
         await asyncio.wait_for(combined.complete(), timeout=0.5)
+
+    async def test_insert_late_points(self):
+        tracker1 = Tracker('tracker1')
+        tracker2 = Tracker('tracker2')
+        await tracker1.new_points([
+            {'time': d('2017/01/01 05:00:00'), 'item': 1},
+            {'time': d('2017/01/01 05:10:00'), 'item': 2},
+            {'time': d('2017/01/01 05:20:00'), 'item': 3},
+        ])
+
+        new_points_callback = asynctest.CoroutineMock()
+        reset_points_callback = asynctest.CoroutineMock()
+        rewind_points_callback = asynctest.CoroutineMock()
+
+        combined = await Combined.start(
+            'combined', (tracker1, tracker2),
+            reset_points_callbacks=(reset_points_callback, ),
+            insert_late_points=True,
+        )
+        combined.new_points_observable.subscribe(new_points_callback)
+        combined.rewind_points_observable.subscribe(rewind_points_callback)
+
+        await tracker2.new_points([
+            {'time': d('2017/01/01 05:10:00'), 'item': 4},
+            {'time': d('2017/01/01 05:15:00'), 'item': 5},
+        ])
+        reset_points_callback.assert_not_called()
+        rewind_points_callback.assert_called_once_with(combined, 2)
+        new_points_callback.assert_called_once_with(combined, [
+            {'time': d('2017/01/01 05:10:00'), 'item': 4},
+            {'time': d('2017/01/01 05:15:00'), 'item': 5},
+            {'time': d('2017/01/01 05:20:00'), 'item': 3},
+        ])
+        self.assertEqual([point['item'] for point in combined.points], [1, 2, 4, 5, 3])
+
+        combined.stop()
+        await asyncio.wait_for(combined.complete(), timeout=0.5)
@@ -1,13 +1,17 @@
+import asyncio
+import unittest
+from datetime import datetime, timedelta
 from textwrap import dedent
 
 import asynctest
 import fixtures
 import msgpack
 from dulwich.repo import MemoryRepo
+from numpy import array, isnan
 
 from trackers.base import Tracker
 from trackers.dulwich_helpers import TreeWriter
-from trackers.events import Event, load_events
+from trackers.events import Event, LeaderCurve, load_events
 from trackers.general import json_encode
 from trackers.tests import get_test_app_and_settings
 
@@ -195,6 +199,81 @@ class TestEventsStartStopTracker(asynctest.TestCase, TestEventWithMockTracker):
 
         await event.stop_and_complete_trackers()
 
+    async def test_batch_update_only_with_subscribers(self):
+        app, settings, writer = self.do_setup('''
+            live: True
+            batch_update_interval: 0.01
+            predicted_update_interval: 0.02
+            riders:
+              - name: foo
+                tracker: {type: mock}
+        ''')
+
+        event = await Event.load(app, 'test_event', writer)
+        batch_update = asynctest.CoroutineMock()
+        event.batch_update_observable.subscribe(batch_update)
+        await event.start_trackers(analyse=False)
+
+        await asyncio.sleep(0.05)
+        batch_update.assert_not_called()
+
+        with event.subscriber():
+            await asyncio.sleep(0)
+            # The first batch update is done as soon as there is a subscriber.
+            batch_update.assert_called_once()
+            await asyncio.sleep(0.05)
+            self.assertGreater(batch_update.call_count, 1)
+
+        await asyncio.sleep(0.05)
+        call_count = batch_update.call_count
+        await asyncio.sleep(0.05)
+        self.assertEqual(batch_update.call_count, call_count)
+
+        await event.stop_and_complete_trackers()
+
+    async def test_rewind_keeps_pre_post_values(self):
+        app, settings, writer = self.do_setup('''
+            event_start: 2017-01-01 05:00:00
+            tracker_end: 2019-01-01 00:00:00
+            analyse: True
+            riders:
+              - name: foo
+                tracker: {type: mock}
+        ''')
+        settings['insert_late_points'] = True
+        source_tracker = Tracker('mock_tracker')
+
+        async def start_mock_event_tracker(app, event, rider_name, tracker_data, start, end):
+            return source_tracker
+
+        app['start_event_trackers']['mock'] = start_mock_event_tracker
+
+        event = await Event.load(app, 'test_event', writer)
+        await event.start_trackers()
+        # So that the late point only rewinds the analysed points after it, and not the pre event points.
+        event.riders_objects['foo'].analyse_tracker.checkpoint_every = 1
+        position = (-26.300822, 28.049444, 1800)
+
+        await source_tracker.new_points(({'time': datetime(2017, 1, 1, 4, 0), 'position': position, 'battery': 50}, ))
+        await source_tracker.new_points((
+            {'time': datetime(2017, 1, 1, 5, 0), 'position': position},
+            {'time': datetime(2017, 1, 1, 5, 2), 'position': position},
+        ))
+        self.assertEqual(event.riders_current_values['foo']['battery'], 50)
+        event.riders_updated.clear()
+        event.riders_pre_post_updated.clear()
+
+        # Late point.
+        await source_tracker.new_points(({'time': datetime(2017, 1, 1, 5, 1), 'position': position}, ))
+        self.assertEqual(event.riders_current_values['foo']['time'], datetime(2017, 1, 1, 5, 2))
+        self.assertEqual(event.riders_current_values['foo']['battery'], 50)
+        self.assertEqual(event.riders_pre_post_values['foo'], {})
+        self.assertEqual(event.riders_updated, {'foo'})
+        self.assertEqual(event.riders_pre_post_updated, {'foo'})
+
+        source_tracker.completed.set_result(None)
+        await event.stop_and_complete_trackers()
+
     async def test_static(self):
         data = '''
             tracker_end: 2019-01-01 00:00:00
@@ -223,3 +302,32 @@ class TestEventsStartStopTracker(asynctest.TestCase, TestEventWithMockTracker):
         self.assertEqual(rider_objects.analyse_tracker.points, [{'foo': 'bar', 'speed': 1}])
 
         await event.stop_and_complete_trackers()
+
+
+class TestLeaderCurve(unittest.TestCase):
+
+    def test_interpolate(self):
+        start = datetime(2019, 1, 1)
+        curve = LeaderCurve(start)
+        curve.update([
+            {'time': start + timedelta(seconds=10), 'dist_route': 0},
+            {'time': start + timedelta(seconds=20), 'dist_route': 0},
+            {'time': start + timedelta(seconds=30), 'dist_route': 100},
+        ])
+        curve.update([
+            {'time': start + timedelta(seconds=10), 'dist_route': 0},
+            {'time': start + timedelta(seconds=20), 'dist_route': 0},
+            {'time': start + timedelta(seconds=30), 'dist_route': 100},
+            {'time': start + timedelta(seconds=40), 'dist_route': 90},
+            {'time': start + timedelta(seconds=50)},
+            {'time': start + timedelta(seconds=60), 'dist_route': 200},
+        ])
+        # Only the points going forward are used, and the first point at the start line replaces the start.
+        self.assertEqual(curve.dist[:curve.len].tolist(), [0, 100, 200])
+        self.assertEqual(curve.time[:curve.len].tolist(), [10, 30, 60])
+
+        self.assertEqual(curve.interpolate(array([50, 150, 250, 0])).tolist()[:2], [20, 45])
+        self.assertTrue(all(isnan(curve.interpolate(array([250, 0])))))
+        # With an end point, e.g. the predicted position.
+        self.assertEqual(curve.interpolate(array([250]), (300, start + timedelta(seconds=100))).tolist(), [80])
+        self.assertEqual(curve.len, 3)
@@ -1,11 +1,20 @@
 import unittest
 
+from numpy import arange, array
+
 from trackers.analyse import (
+    c_points_get_point,
     distance,
     find_c_point,
+    find_c_points_from_precalc_arrays,
     get_equal_spaced_points,
+    get_point_pair_precalc,
+    get_point_pairs_arrays,
+    get_point_pairs_grid,
     move_along_route,
+    move_along_route_batch,
     Point,
+    point_pairs_grid_candidates,
     ramer_douglas_peucker,
     route_with_distance_and_index,
 )
@@ -27,6 +36,50 @@ class TestFindCPoint(unittest.TestCase):
         self.assertEqual(result.point, Point(lat=0, lng=0))
 
 
+class TestFindCPointsFromPrecalcArrays(unittest.TestCase):
+
+    def test_same_as_find_c_point(self):
+        route_points = route_with_distance_and_index([(0, 0), (0, 30), (0, 30), (15, 45)])
+        point_pairs = [get_point_pair_precalc(route_points[i], route_points[i + 1]) for i in (0, 2)]
+        arrays = get_point_pairs_arrays(point_pairs)
+        points_pv = array([point.pv.reshape((3, )) for point in route_points])
+
+        for to_point in (Point(0.0001, 15), Point(0.0001, 40), Point(0, 0), Point(10, 42)):
+            c_points = find_c_points_from_precalc_arrays(
+                to_point.nv.reshape((1, 3)), to_point.pv.reshape((1, 3)), points_pv, arrays, arange(2))
+            for i, point_pair in enumerate(point_pairs):
+                expected = find_c_point(to_point, *point_pair[:2])
+                self.assertAlmostEqual(c_points.dist[i], expected.dist, places=6)
+                point = c_points_get_point(c_points, i, point_pair)
+                self.assertAlmostEqual(point.lat, expected.point.lat)
+                self.assertAlmostEqual(point.lng, expected.point.lng)
+
+
+class TestPointPairsGrid(unittest.TestCase):
+
+    def test_candidates(self):
+        # A zig zag route, with point pairs of about 1.1km.
+        route_points = route_with_distance_and_index([(0.01 * (i % 2), 0.01 * i) for i in range(100)])
+        point_pairs = [get_point_pair_precalc(*point_pair) for point_pair in zip(route_points, route_points[1:])]
+        arrays = get_point_pairs_arrays(point_pairs)
+        points_pv = array([point.pv.reshape((3, )) for point in route_points])
+        grid = get_point_pairs_grid(points_pv, arrays, cell_size=2000)
+
+        to_points = [Point(0.005, 0.305), Point(0.03, 0.5), Point(-0.02, 0.9), Point(0.2, 0.5)]
+        to_pv = array([to_point.pv.reshape((3, )) for to_point in to_points])
+        for radius in (1, 2, 4):
+            to_point_i, indexes = point_pairs_grid_candidates(grid, to_pv, radius)
+            for i, to_point in enumerate(to_points):
+                c_points = find_c_points_from_precalc_arrays(
+                    to_point.nv.reshape((1, 3)), to_point.pv.reshape((1, 3)), points_pv, arrays, arange(len(point_pairs)))
+                expected = set(arange(len(point_pairs))[c_points.dist <= radius * 2000])
+                # Must include every point pair within the radius, and no more than the point pairs in the cells
+                # around the to point.
+                candidates = set(indexes[to_point_i == i])
+                self.assertLessEqual(expected, candidates)
+                self.assertTrue(all(c_points.dist[list(candidates)] < (radius + 1) * 2000 * 3 ** 0.5 + 2000))
+
+
 class TestRamerDouglasPeucker(unittest.TestCase):
 
     def test_ramer_douglas_peucker(self):
@@ -84,3 +137,18 @@ class TestMoveAlongRoute(unittest.TestCase):
     def test_indexed(self):
         point = move_along_route(route_with_distance_and_index([(0, 0), (0, 0.2), (0, 1)]), 100000)
         self.assertEqual(point, Point(lat=0.0, lng=0.898323))
+
+    def test_batch(self):
+        route_points = route_with_distance_and_index([(0, 0), (0, 0.2), (0, 1)])
+        route = {'points': route_points, 'points_distance': array([point.distance for point in route_points])}
+        start = Point(0, 0.1)
+        starts = [(start, 1)] * 4
+        dists = [5000, 100000, 1000000, 0]
+        expected = [
+            move_along_route([start] + route_points[1:], dist)
+            for dist in dists
+        ]
+        self.assertEqual(
+            move_along_route_batch(route, starts, dists),
+            [[point.lat, point.lng] for point in expected],
+        )
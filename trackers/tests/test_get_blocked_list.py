@@ -11,14 +11,14 @@ source = index_and_hash_list([{'x': text} for text in 'Lorem ipsum dolor sit ame
 # pprint.pprint(source)
 
 expected_full = {
-    'blocks': [{'end_hash': 'qRd1', 'end_index': 19, 'start_index': 0},
-               {'end_hash': 'juYX', 'end_index': 24, 'start_index': 20},
-               {'end_hash': 'k9VG', 'end_index': 29, 'start_index': 25}],
-    'partial_block': [{'hash': 'LaqB', 'index': 30, 'x': 'u'},
-                      {'hash': '7is4', 'index': 31, 'x': 'e'},
-                      {'hash': 'yG0W', 'index': 32, 'x': 'r'},
-                      {'hash': 'qmpi', 'index': 33, 'x': 'e'},
-                      {'hash': 'opj8', 'index': 34, 'x': '.'}]
+    'blocks': [{'end_hash': 'qexD', 'end_index': 19, 'start_index': 0},
+               {'end_hash': '-UEq', 'end_index': 24, 'start_index': 20},
+               {'end_hash': 'v2vV', 'end_index': 29, 'start_index': 25}],
+    'partial_block': [{'hash': 'TSyp', 'index': 30, 'x': 'u'},
+                      {'hash': 'D6o_', 'index': 31, 'x': 'e'},
+                      {'hash': 'Wryo', 'index': 32, 'x': 'r'},
+                      {'hash': 'qTJl', 'index': 33, 'x': 'e'},
+                      {'hash': 'M_6s', 'index': 34, 'x': '.'}]
 }
 
 
@@ -52,7 +52,7 @@ class Test(unittest.TestCase):
 
     def test_some_full_block(self):
         existing = {
-            'blocks': [{'start_index': 0, 'end_index': 24, 'end_hash': 'juYX'}],
+            'blocks': [{'start_index': 0, 'end_index': 24, 'end_hash': '-UEq'}],
             'partial_block': []
         }
         expected_update = expected_full
@@ -60,96 +60,96 @@ class Test(unittest.TestCase):
 
     def test_all_full_block(self):
         existing = {
-            'blocks': [{'end_hash': 'qRd1', 'end_index': 19, 'start_index': 0},
-                       {'end_hash': 'juYX', 'end_index': 24, 'start_index': 20},
-                       {'end_hash': 'k9VG', 'end_index': 29, 'start_index': 25}],
+            'blocks': [{'end_hash': 'qexD', 'end_index': 19, 'start_index': 0},
+                       {'end_hash': '-UEq', 'end_index': 24, 'start_index': 20},
+                       {'end_hash': 'v2vV', 'end_index': 29, 'start_index': 25}],
             'partial_block': []
         }
         expected_update = {
-            'add_block': [{'hash': 'LaqB', 'index': 30, 'x': 'u'},
-                          {'hash': '7is4', 'index': 31, 'x': 'e'},
-                          {'hash': 'yG0W', 'index': 32, 'x': 'r'},
-                          {'hash': 'qmpi', 'index': 33, 'x': 'e'},
-                          {'hash': 'opj8', 'index': 34, 'x': '.'}]
+            'add_block': [{'hash': 'TSyp', 'index': 30, 'x': 'u'},
+                          {'hash': 'D6o_', 'index': 31, 'x': 'e'},
+                          {'hash': 'Wryo', 'index': 32, 'x': 'r'},
+                          {'hash': 'qTJl', 'index': 33, 'x': 'e'},
+                          {'hash': 'M_6s', 'index': 34, 'x': '.'}]
         }
         self.check(source, existing, expected_full, expected_update)
 
     def test_prev_partial_block(self):
         existing = {
-            'blocks': [{'end_hash': 'juYX', 'end_index': 24, 'start_index': 0}],
-            'partial_block': [{'hash': 'wARg', 'index': 25, 'x': 't'},
-                              {'hash': 'Zwue', 'index': 26, 'x': ' '},
-                              {'hash': 'QFbp', 'index': 27, 'x': 'p'}]
+            'blocks': [{'end_hash': '-UEq', 'end_index': 24, 'start_index': 0}],
+            'partial_block': [{'hash': 'E9tq', 'index': 25, 'x': 't'},
+                              {'hash': 'b97k', 'index': 26, 'x': ' '},
+                              {'hash': '9_TH', 'index': 27, 'x': 'p'}]
         }
         expected_update = expected_full
         self.check(source, existing, expected_full, expected_update)
 
     def test_partial_block(self):
         existing = {
-            'blocks': [{'end_hash': 'qRd1', 'end_index': 19, 'start_index': 0},
-                       {'end_hash': 'juYX', 'end_index': 24, 'start_index': 20},
-                       {'end_hash': 'k9VG', 'end_index': 29, 'start_index': 25}],
-            'partial_block': [{'hash': 'LaqB', 'index': 30, 'x': 'u'},
-                              {'hash': '7is4', 'index': 31, 'x': 'e'},
-                              {'hash': 'yG0W', 'index': 32, 'x': 'r'}]
+            'blocks': [{'end_hash': 'qexD', 'end_index': 19, 'start_index': 0},
+                       {'end_hash': '-UEq', 'end_index': 24, 'start_index': 20},
+                       {'end_hash': 'v2vV', 'end_index': 29, 'start_index': 25}],
+            'partial_block': [{'hash': 'TSyp', 'index': 30, 'x': 'u'},
+                              {'hash': 'D6o_', 'index': 31, 'x': 'e'},
+                              {'hash': 'Wryo', 'index': 32, 'x': 'r'}]
         }
         expected_update = {
-            'add_block': [{'hash': 'qmpi', 'index': 33, 'x': 'e'},
-                          {'hash': 'opj8', 'index': 34, 'x': '.'}]
+            'add_block': [{'hash': 'qTJl', 'index': 33, 'x': 'e'},
+                          {'hash': 'M_6s', 'index': 34, 'x': '.'}]
         }
         self.check(source, existing, expected_full, expected_update)
 
     def test_block_wrong_hash(self):
         existing = {
             'blocks': [{'start_index': 0, 'end_index': 24, 'end_hash': 'WRONG'},
-                       {'start_index': 25, 'end_index': 29, 'end_hash': 'k9VG'}],
-            'partial_block': [{'hash': 'LaqB', 'index': 30, 'x': 'u'},
-                              {'hash': '7is4', 'index': 31, 'x': 'e'},
-                              {'hash': 'yG0W', 'index': 32, 'x': 'r'},
-                              {'hash': 'qmpi', 'index': 33, 'x': 'e'},
-                              {'hash': 'opj8', 'index': 34, 'x': '.'}]
+                       {'start_index': 25, 'end_index': 29, 'end_hash': 'v2vV'}],
+            'partial_block': [{'hash': 'TSyp', 'index': 30, 'x': 'u'},
+                              {'hash': 'D6o_', 'index': 31, 'x': 'e'},
+                              {'hash': 'Wryo', 'index': 32, 'x': 'r'},
+                              {'hash': 'qTJl', 'index': 33, 'x': 'e'},
+                              {'hash': 'M_6s', 'index': 34, 'x': '.'}]
         }
         expected_update = expected_full
         self.check(source, existing, expected_full, expected_update)
 
     def test_partial_wrong_hash(self):
         existing = {
-            'blocks': [{'end_hash': 'qRd1', 'end_index': 19, 'start_index': 0},
-                       {'end_hash': 'juYX', 'end_index': 24, 'start_index': 20},
-                       {'end_hash': 'k9VG', 'end_index': 29, 'start_index': 25}],
-            'partial_block': [{'hash': 'LaqB', 'index': 30, 'x': 'u'},
-                              {'hash': '7is4', 'index': 31, 'x': 'e'},
+            'blocks': [{'end_hash': 'qexD', 'end_index': 19, 'start_index': 0},
+                       {'end_hash': '-UEq', 'end_index': 24, 'start_index': 20},
+                       {'end_hash': 'v2vV', 'end_index': 29, 'start_index': 25}],
+            'partial_block': [{'hash': 'TSyp', 'index': 30, 'x': 'u'},
+                              {'hash': 'D6o_', 'index': 31, 'x': 'e'},
                               {'hash': 'WRONG', 'index': 32, 'x': 'r'},
-                              {'hash': 'qmpi', 'index': 33, 'x': 'e'},
-                              {'hash': 'opj8', 'index': 34, 'x': '.'}]
+                              {'hash': 'qTJl', 'index': 33, 'x': 'e'},
+                              {'hash': 'M_6s', 'index': 34, 'x': '.'}]
         }
         expected_update = {
-            'partial_block': [{'hash': 'LaqB', 'index': 30, 'x': 'u'},
-                              {'hash': '7is4', 'index': 31, 'x': 'e'},
-                              {'hash': 'yG0W', 'index': 32, 'x': 'r'},
-                              {'hash': 'qmpi', 'index': 33, 'x': 'e'},
-                              {'hash': 'opj8', 'index': 34, 'x': '.'}]
+            'partial_block': [{'hash': 'TSyp', 'index': 30, 'x': 'u'},
+                              {'hash': 'D6o_', 'index': 31, 'x': 'e'},
+                              {'hash': 'Wryo', 'index': 32, 'x': 'r'},
+                              {'hash': 'qTJl', 'index': 33, 'x': 'e'},
+                              {'hash': 'M_6s', 'index': 34, 'x': '.'}]
         }
         self.check(source, existing, expected_full, expected_update)
 
     def test_existing_index_too_far(self):
         existing = {
-            'blocks': [{'end_hash': 'qRd1', 'end_index': 19, 'start_index': 0},
-                       {'end_hash': 'juYX', 'end_index': 24, 'start_index': 20},
-                       {'end_hash': 'k9VG', 'end_index': 29, 'start_index': 25}],
-            'partial_block': [{'hash': 'LaqB', 'index': 30, 'x': 'u'},
-                              {'hash': '7is4', 'index': 31, 'x': 'e'},
-                              {'hash': 'yG0W', 'index': 32, 'x': 'r'},
-                              {'hash': 'qmpi', 'index': 33, 'x': 'e'},
-                              {'hash': 'opj8', 'index': 34, 'x': '.'},
+            'blocks': [{'end_hash': 'qexD', 'end_index': 19, 'start_index': 0},
+                       {'end_hash': '-UEq', 'end_index': 24, 'start_index': 20},
+                       {'end_hash': 'v2vV', 'end_index': 29, 'start_index': 25}],
+            'partial_block': [{'hash': 'TSyp', 'index': 30, 'x': 'u'},
+                              {'hash': 'D6o_', 'index': 31, 'x': 'e'},
+                              {'hash': 'Wryo', 'index': 32, 'x': 'r'},
+                              {'hash': 'qTJl', 'index': 33, 'x': 'e'},
+                              {'hash': 'M_6s', 'index': 34, 'x': '.'},
                               {'hash': 'fooo', 'index': 35, 'x': 'b'}]
         }
         expected_update = {
-            'partial_block': [{'hash': 'LaqB', 'index': 30, 'x': 'u'},
-                              {'hash': '7is4', 'index': 31, 'x': 'e'},
-                              {'hash': 'yG0W', 'index': 32, 'x': 'r'},
-                              {'hash': 'qmpi', 'index': 33, 'x': 'e'},
-                              {'hash': 'opj8', 'index': 34, 'x': '.'}]
+            'partial_block': [{'hash': 'TSyp', 'index': 30, 'x': 'u'},
+                              {'hash': 'D6o_', 'index': 31, 'x': 'e'},
+                              {'hash': 'Wryo', 'index': 32, 'x': 'r'},
+                              {'hash': 'qTJl', 'index': 33, 'x': 'e'},
+                              {'hash': 'M_6s', 'index': 34, 'x': '.'}]
         }
 
         self.check(source, existing, expected_full, expected_update)
@@ -157,7 +157,7 @@ class Test(unittest.TestCase):
     def test_entire_block(self):
         existing = {}
         expected = {
-            'blocks': [{'end_hash': 'opj8', 'end_index': 34, 'start_index': 0}],
+            'blocks': [{'end_hash': 'M_6s', 'end_index': 34, 'start_index': 0}],
             'partial_block': []
         }
         self.check(source, existing, expected, expected, entire_block=True)
@@ -182,12 +182,12 @@ class TestBlockedList(asynctest.TestCase):
 
         await tracker.new_points(source[:9])
         self.assertEqual(blocked_list.full, {
-            'blocks': [{'end_hash': 'cTTc', 'end_index': 7, 'start_index': 0}],
-            'partial_block': [{'hash': 'xtbb', 'index': 8, 'x': 's'}]
+            'blocks': [{'end_hash': 'khZP', 'end_index': 7, 'start_index': 0}],
+            'partial_block': [{'hash': 'kgva', 'index': 8, 'x': 's'}]
         })
         new_update_callback.assert_called_once_with(blocked_list, {
-            'blocks': [{'end_hash': 'cTTc', 'end_index': 7, 'start_index': 0}],
-            'partial_block': [{'hash': 'xtbb', 'index': 8, 'x': 's'}]
+            'blocks': [{'end_hash': 'khZP', 'end_index': 7, 'start_index': 0}],
+            'partial_block': [{'hash': 'kgva', 'index': 8, 'x': 's'}]
         })
         new_update_callback.reset_mock()
 
@@ -197,8 +197,57 @@ class TestBlockedList(asynctest.TestCase):
         new_update_callback.reset_mock()
 
         await tracker.new_points(source[10:11])
-        self.assertEqual(blocked_list.full, {'blocks': [], 'partial_block': [{'x': 'm', 'index': 10, 'hash': 'KCgI'}]})
-        new_update_callback.assert_called_once_with(blocked_list, {'add_block': [{'x': 'm', 'index': 10, 'hash': 'KCgI'}]})
+        self.assertEqual(blocked_list.full, {'blocks': [], 'partial_block': [{'x': 'm', 'index': 10, 'hash': '-4UX'}]})
+        new_update_callback.assert_called_once_with(blocked_list, {'add_block': [{'x': 'm', 'index': 10, 'hash': '-4UX'}]})
+
+        tracker.completed.set_result(None)
+        await tracker.complete()
+
+    async def test_incremental(self):
+        long_source = index_and_hash_list([{'x': i} for i in range(300)], 0, hashlib.sha1())
+        tracker = Tracker('test')
+        blocked_list = BlockedList.from_tracker(tracker, smallest_block_len=4)
+
+        for i in range(0, 300, 7):
+            await tracker.new_points(long_source[i:i + 7])
+            expected, _ = get_blocked_list(long_source[:i + 7], {}, smallest_block_len=4)
+            self.assertEqual(blocked_list.full, expected)
+
+        await tracker.rewind_points(150)
+        expected, _ = get_blocked_list(long_source[:150], {}, smallest_block_len=4)
+        self.assertEqual(blocked_list.full, expected)
+
+        await tracker.new_points(long_source[150:200])
+        expected, _ = get_blocked_list(long_source[:200], {}, smallest_block_len=4)
+        self.assertEqual(blocked_list.full, expected)
+        self.assertEqual(blocked_list.get_update_from_last(), {'blocks': expected['blocks'], 'partial_block': expected['partial_block']})
+
+        # Rewind to the end of a big block.
+        await tracker.rewind_points(128)
+        expected, _ = get_blocked_list(long_source[:128], {}, smallest_block_len=4)
+        self.assertEqual(blocked_list.full, expected)
+
+        await tracker.new_points(long_source[128:300])
+        expected, _ = get_blocked_list(long_source[:300], {}, smallest_block_len=4)
+        self.assertEqual(blocked_list.full, expected)
+
+        tracker.completed.set_result(None)
+        await tracker.complete()
+
+    async def test_columnar_rewind(self):
+        # ColumnarPoints reuses its rows on a rewind, so the points in the last partial block must not change with them.
+        long_source = index_and_hash_list([{'x': i} for i in range(20)], 0, hashlib.sha1())
+        replaced_source = index_and_hash_list([{'x': i} for i in range(17)] + [{'x': 'new'}] * 3, 0, hashlib.sha1())
+        tracker = Tracker('test', columnar_points=True)
+        blocked_list = BlockedList.from_tracker(tracker)
+
+        await tracker.new_points(long_source)
+        blocked_list.get_update_from_last()
+
+        await tracker.rewind_points(17)
+        await tracker.new_points(replaced_source[17:])
+        expected, _ = get_blocked_list(replaced_source, {})
+        self.assertEqual(blocked_list.get_update_from_last(), {'partial_block': expected['partial_block']})
 
         tracker.completed.set_result(None)
         await tracker.complete()
@@ -1,9 +1,11 @@
+import hashlib
 import pprint
+from datetime import datetime
 
 import asynctest
 
 from trackers.base import Tracker
-from trackers.general import index_and_hash_tracker
+from trackers.general import index_and_hash_list, index_and_hash_tracker
 
 
 class Test(asynctest.TestCase):
@@ -25,10 +27,10 @@ class Test(asynctest.TestCase):
 
         pprint.pprint(ih_tracker.points)
         self.assertSequenceEqual(ih_tracker.points, [
-            {'position': (-26.300822, 28.049444, 1800), 'index': 0, 'hash': 'sISs'},
-            {'position': (-26.302245, 28.051139, 1800), 'index': 1, 'hash': '9VOm'},
-            {'position': (-27.280315, 27.969365, 1800), 'index': 2, 'hash': 'X60A'},
-            {'position': (-27.282870, 27.970620, 1800), 'index': 3, 'hash': 'W9tZ'},
+            {'position': (-26.300822, 28.049444, 1800), 'index': 0, 'hash': 'tTf7'},
+            {'position': (-26.302245, 28.051139, 1800), 'index': 1, 'hash': 'Gv_p'},
+            {'position': (-27.280315, 27.969365, 1800), 'index': 2, 'hash': '7y5c'},
+            {'position': (-27.282870, 27.970620, 1800), 'index': 3, 'hash': 'YXqO'},
         ])
 
     async def test_reset_and_change(self):
@@ -42,8 +44,8 @@ class Test(asynctest.TestCase):
 
         pprint.pprint(ih_tracker.points)
         self.assertSequenceEqual(ih_tracker.points, [
-            {'position': (-26.300822, 28.049444, 1800), 'index': 0, 'hash': 'sISs'},
-            {'position': (-26.302245, 28.051139, 1800), 'index': 1, 'hash': '9VOm'},
+            {'position': (-26.300822, 28.049444, 1800), 'index': 0, 'hash': 'tTf7'},
+            {'position': (-26.302245, 28.051139, 1800), 'index': 1, 'hash': 'Gv_p'},
         ])
 
         await tracker.reset_points()
@@ -56,9 +58,53 @@ class Test(asynctest.TestCase):
 
         pprint.pprint(ih_tracker.points)
         self.assertSequenceEqual(ih_tracker.points, [
-            {'hash': 'X60A', 'index': 0, 'position': (-27.280315, 27.969365, 1800)},
-            {'hash': 'W9tZ', 'index': 1, 'position': (-27.28287, 27.97062, 1800)}
+            {'hash': '7y5c', 'index': 0, 'position': (-27.280315, 27.969365, 1800)},
+            {'hash': 'YXqO', 'index': 1, 'position': (-27.28287, 27.97062, 1800)}
         ])
 
         tracker.completed.set_result(None)
         await ih_tracker.complete()
+
+    async def test_rewind(self):
+        tracker = Tracker('test')
+        ih_tracker = await index_and_hash_tracker(tracker)
+        await tracker.new_points((
+            {'position': (-26.300822, 28.049444, 1800)},
+            {'position': (-26.302245, 28.051139, 1800)},
+        ))
+        org_hashes = [point['hash'] for point in ih_tracker.points]
+
+        await tracker.rewind_points(1)
+        self.assertEqual(len(ih_tracker.points), 1)
+        await tracker.new_points(({'position': (-27.280315, 27.969365, 1800)}, ))
+        self.assertEqual([point['index'] for point in ih_tracker.points], [0, 1])
+        self.assertEqual(ih_tracker.points[0]['hash'], org_hashes[0])
+        self.assertNotEqual(ih_tracker.points[1]['hash'], org_hashes[1])
+
+        tracker.completed.set_result(None)
+        await ih_tracker.complete()
+
+    async def test_rewind_hashes_same_as_fresh(self):
+        points = [{'x': i} for i in range(600)]
+        tracker = Tracker('test')
+        ih_tracker = await index_and_hash_tracker(tracker)
+        await tracker.new_points(points)
+
+        # Rewind to part way through a snapshot, and to a snapshot boundary.
+        for index in (300, 512):
+            await tracker.rewind_points(index)
+            points = points[:index] + [{'x': i, 'replaced': True} for i in range(index, 600)]
+            await tracker.new_points(points[index:])
+            self.assertEqual(
+                [point['hash'] for point in ih_tracker.points],
+                [point['hash'] for point in index_and_hash_list(points, 0, hashlib.sha1())],
+            )
+
+        tracker.completed.set_result(None)
+        await ih_tracker.complete()
+
+    def test_key_order_independent(self):
+        points = [{'position': (-26.300822, 28.049444, 1800), 'time': datetime(2017, 1, 1)}]
+        reordered_points = [{'time': datetime(2017, 1, 1), 'position': (-26.300822, 28.049444, 1800)}]
+        self.assertEqual(index_and_hash_list(points, 0, hashlib.sha1())[0]['hash'],
+                         index_and_hash_list(reordered_points, 0, hashlib.sha1())[0]['hash'])
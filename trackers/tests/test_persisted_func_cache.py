@@ -1,9 +1,10 @@
+import concurrent.futures
 import os.path
 import tempfile
 import unittest
 import unittest.mock
 
-from trackers.persisted_func_cache import PersistedFuncCache
+from trackers.persisted_func_cache import PersistedFuncCache, SqlitePersistedFuncCache
 
 
 class TestPersistedFuncCache(unittest.TestCase):
@@ -35,3 +36,113 @@ class TestPersistedFuncCache(unittest.TestCase):
 
             self.assertEqual(loaded_cache(1), 2)
             loaded_func.assert_not_called()
+
+    def test_write_in_background(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'cache')
+            cache = PersistedFuncCache(path, func=lambda x: x + 1, write_every=1, write_in_background=True)
+            for i in range(20):
+                cache(i)
+            cache.close()
+
+            loaded_cache = PersistedFuncCache(path)
+            self.assertEqual(loaded_cache.cache, {((i, ), ()): i + 1 for i in range(20)})
+
+
+class TestSqlitePersistedFuncCache(unittest.TestCase):
+
+    def get_cache(self, path, **kwargs):
+        cache = SqlitePersistedFuncCache(path, **kwargs)
+        cache.func = unittest.mock.Mock(side_effect=lambda x: x + 1)
+        cache.key = lambda x: x
+        cache.pack = lambda x: str(x)
+        cache.unpack = lambda packed: int(packed)
+        return cache
+
+    def test(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'cache')
+            cache = self.get_cache(path)
+
+            self.assertEqual(cache(1), 2)
+            cache.func.assert_called_once_with(1)
+
+            self.assertEqual(cache(1), 2)
+            cache.func.assert_called_once_with(1)  # second time should not be called again.
+
+            cache.close()
+
+            loaded_cache = self.get_cache(path)
+            self.assertEqual(loaded_cache(1), 2)
+            loaded_cache.func.assert_not_called()
+            loaded_cache.close()
+
+    def test_remove_least_recently_used(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'cache')
+            cache = self.get_cache(path, max_items=10, write_every=1)
+            for i in range(10):
+                cache(i)
+            # Use 0 again, so that it is not the least recently used.
+            cache(0)
+            cache(10)
+            cache.close()
+
+            loaded_cache = self.get_cache(path)
+            self.assertEqual(loaded_cache.items_count, 9)
+            for i in (0, 3, 10):
+                loaded_cache(i)
+            loaded_cache.func.assert_not_called()
+            # 1 and 2 were removed.
+            loaded_cache(1)
+            loaded_cache.func.assert_called_once_with(1)
+            loaded_cache.close()
+
+    def test_remove_least_recently_used_compacts(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'cache')
+            cache = self.get_cache(path, max_items=100, write_every=10)
+            cache.pack = lambda x: str(x) * 1000
+            for i in range(100):
+                cache(i)
+            cache.write_unwritten()
+            full_page_count = cache.db.execute('PRAGMA page_count').fetchone()[0]
+
+            # Goes over max_items, so that the least recently used are removed, and their pages freed.
+            cache(100)
+            cache.write_unwritten()
+            self.assertEqual(cache.db.execute('PRAGMA freelist_count').fetchone()[0], 0)
+            self.assertLess(cache.db.execute('PRAGMA page_count').fetchone()[0], full_page_count)
+            cache.close()
+
+    def test_write_in_background(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'cache')
+            cache = self.get_cache(path, write_every=1, write_in_background=True)
+            for i in range(20):
+                self.assertEqual(cache(i), i + 1)
+            # Items submitted to the writer, but not yet written, are still found.
+            self.assertEqual(cache(0), 1)
+            cache.func.assert_has_calls([unittest.mock.call(i) for i in range(20)])
+            self.assertEqual(cache.func.call_count, 20)
+            cache.close()
+
+            loaded_cache = self.get_cache(path)
+            self.assertEqual(loaded_cache.items_count, 20)
+            for i in range(20):
+                self.assertEqual(loaded_cache(i), i + 1)
+            loaded_cache.func.assert_not_called()
+            loaded_cache.close()
+
+    def test_close_from_other_thread(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'cache')
+            cache = self.get_cache(path, write_every=10, write_in_background=True)
+            for i in range(5):
+                cache(i)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+                executor.submit(cache.close).result()
+
+            loaded_cache = self.get_cache(path)
+            self.assertEqual(loaded_cache.items_count, 5)
+            loaded_cache.close()
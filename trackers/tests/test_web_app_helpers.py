@@ -1,12 +1,19 @@
+import asyncio
+import gzip
+import hashlib
 import logging
 import unittest
 import unittest.mock
+from datetime import datetime, timezone
 
 import asynctest
+import msgpack
 from aiohttp.test_utils import make_mocked_request
 from aiohttp.web import HTTPException, HTTPOk, Response
 
-from trackers import web_app
+from trackers import web_app, web_helpers
+from trackers.base import BlockedList, Tracker
+from trackers.general import index_and_hash_list
 
 
 class TestETagHelpers(unittest.TestCase):
@@ -87,6 +94,58 @@ class TestETagHelpers(unittest.TestCase):
         self.assertEqual(new_response.status, 200)
 
 
+class TestEncodedBody(asynctest.TestCase):
+
+    async def test_encoded_body_etag_response(self):
+        encoded = web_helpers.EncodedBody(b'[{"x": 1}]')
+
+        response = await web_helpers.encoded_body_etag_response(make_mocked_request('GET', '/'), encoded, 'abcd')
+        self.assertEqual(response.body, b'[{"x": 1}]')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(response.headers['ETag'], 'abcd')
+        # Only compressed when an encoding is requested.
+        self.assertEqual(list(encoded.bodies), ['identity'])
+
+        request = make_mocked_request('GET', '/', headers={'Accept-Encoding': 'gzip, deflate, br;q=0'})
+        response = await web_helpers.encoded_body_etag_response(request, encoded, 'abcd')
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['ETag'], 'abcd-gzip')
+        self.assertEqual(gzip.decompress(response.body), b'[{"x": 1}]')
+
+        # Not modified, so not compressed.
+        request = make_mocked_request('GET', '/', headers={'Accept-Encoding': 'gzip', 'If-None-Match': 'abcd-gzip'})
+        encoded = web_helpers.EncodedBody(b'[{"x": 1}]')
+        response = await web_helpers.encoded_body_etag_response(request, encoded, 'abcd')
+        self.assertEqual(response.status, 304)
+        self.assertEqual(list(encoded.bodies), ['identity'])
+
+    async def test_encoded_body_etag_response_br(self):
+        encoded = web_helpers.EncodedBody(b'[{"x": 1}]')
+        encoded.bodies['br'] = b'mock_br'
+        request = make_mocked_request('GET', '/', headers={'Accept-Encoding': 'gzip, deflate, br'})
+        with unittest.mock.patch.object(web_helpers, 'brotli', True):
+            response = await web_helpers.encoded_body_etag_response(request, encoded, 'abcd')
+        self.assertEqual(response.headers['Content-Encoding'], 'br')
+        self.assertEqual(response.headers['ETag'], 'abcd-br')
+        self.assertEqual(response.body, b'mock_br')
+
+    def test_encoded_body_cache(self):
+        cache = web_helpers.EncodedBodyCache(max_items=2)
+        get_body = unittest.mock.Mock(side_effect=lambda: b'body')
+
+        self.assertEqual(cache.get('a', get_body).identity, b'body')
+        cache.get('a', get_body)
+        self.assertEqual(get_body.call_count, 1)
+
+        cache.get('b', get_body)
+        cache.get('a', get_body)
+        cache.get('c', get_body)
+        # b was least recently used, so was removed.
+        self.assertEqual(list(cache.cache), ['a', 'c'])
+        self.assertEqual(get_body.call_count, 3)
+
+
 class TestSayErrorHandler(asynctest.TestCase):
 
     async def test_no_error(self):
@@ -126,3 +185,197 @@ class TestSayErrorHandler(asynctest.TestCase):
             await error(request)
         except HTTPException as response:
             self.assertEqual(response.status, 200)
+
+
+def mock_event_ws(app, use_msgpack=False, max_size=20):
+    ws = asynctest.Mock()
+    ws.closed = False
+    ws.msgpack = use_msgpack
+    ws.send_str = asynctest.CoroutineMock()
+    ws.send_bytes = asynctest.CoroutineMock()
+    ws.close = asynctest.CoroutineMock()
+    ws.send_queue = web_app.WSSendQueue(app, ws, max_size)
+    return ws
+
+
+class TestBatchUpdate(asynctest.TestCase):
+
+    def test_json_join_object(self):
+        value = {'b': [1, {'z': 'é', 'a': None}], 'a': {'c': 1.5}}
+        self.assertEqual(
+            web_app.json_join_object((key, web_app.json_dumps(item)) for key, item in value.items()),
+            web_app.json_dumps(value),
+        )
+
+    async def test_on_event_batch_update(self):
+        app = {'exception_recorder': unittest.mock.Mock()}
+
+        def mock_ws(subscriptions, use_msgpack=False):
+            ws = mock_event_ws(app, use_msgpack)
+            ws.subscriptions = set(subscriptions)
+            return ws
+
+        all_points_ws = mock_ws(('riders_points', 'riders_predicted'))
+        rider_points_ws = mock_ws(('riders_points.a', ))
+        msgpack_ws = mock_ws(('riders_points.a', ), use_msgpack=True)
+
+        def mock_rider_objects(update):
+            blocked_list = unittest.mock.Mock()
+            blocked_list.get_update_from_last.return_value = update
+            return unittest.mock.Mock(blocked_list=blocked_list)
+
+        event = unittest.mock.Mock()
+        event.name = 'test'
+        event.app = app
+        subscription_index = web_app.WSSubscriptionIndex()
+        for ws in (all_points_ws, rider_points_ws, msgpack_ws):
+            subscription_index.add(ws)
+        app['trackers.event_ws_subscription_index'] = {'test': subscription_index}
+        event.riders_current_values = {'a': {'dist': 1}, 'b': {'dist': 2}}
+        event.riders_pre_post_values = {}
+        event.riders_predicted_points = {'a': [1, 2]}
+        event.riders_objects = {
+            'a': mock_rider_objects({'add_block': [{'index': 0, 'hash': 'abcd'}]}),
+            'b': mock_rider_objects({'add_block': [{'index': 5, 'hash': 'efgh'}]}),
+        }
+
+        await web_app.on_event_batch_update(event, None, {'a', 'b'}, set(), set())
+        for ws in (all_points_ws, rider_points_ws, msgpack_ws):
+            await ws.send_queue.flush()
+            await ws.send_queue.stop()
+
+        all_points_ws.send_str.assert_called_once_with(web_app.json_dumps({
+            'riders_values': {'a': {'dist': 1}, 'b': {'dist': 2}},
+            'riders_points': {'a': {'add_block': [{'index': 0, 'hash': 'abcd'}]}, 'b': {'add_block': [{'index': 5, 'hash': 'efgh'}]}},
+            'riders_predicted': {'a': [1, 2]},
+        }))
+        rider_points_ws.send_str.assert_called_once_with(web_app.json_dumps({
+            'riders_values': {'a': {'dist': 1}, 'b': {'dist': 2}},
+            'riders_points': {'a': {'add_block': [{'index': 0, 'hash': 'abcd'}]}},
+        }))
+        msgpack_ws.send_str.assert_not_called()
+        self.assertEqual(msgpack.loads(msgpack_ws.send_bytes.call_args[0][0], raw=False), {
+            'riders_values': {'a': {'dist': 1}, 'b': {'dist': 2}},
+            'riders_points': {'a': {'add_block': [{'x': 0, 'h': 'abcd'}]}},
+        })
+
+    def test_msgpack_join_map(self):
+        value = {'b': [1, {'z': 'é', 'a': None}], 'a': {'c': 1.5}}
+        self.assertEqual(
+            msgpack.loads(web_app.msgpack_join_map((key, web_app.msgpack_dumps(item)) for key, item in value.items()), raw=False),
+            value,
+        )
+
+    def test_encode_ws_msg(self):
+        msg = {
+            'riders_off_route': {'a': {'blocks': [{'start_index': 0}], 'partial_block': [{'index': 1, 'dist_route': 5}]}},
+            'server_time': datetime(2020, 1, 1, tzinfo=timezone.utc),
+        }
+        self.assertEqual(msgpack.loads(web_app.encode_ws_msg(msg, use_msgpack=True), raw=False), {
+            'riders_off_route': {'a': {'blocks': [{'start_index': 0}], 'partial_block': [{'x': 1, 'o': 5}]}},
+            'server_time': 1577836800.0,
+        })
+        self.assertEqual(web_app.encode_ws_msg(msg, use_msgpack=False), web_app.json_dumps(msg))
+
+
+class TestWSSubscriptionIndex(unittest.TestCase):
+
+    def test_index(self):
+        def mock_ws(subscriptions):
+            return unittest.mock.Mock(subscriptions=set(subscriptions), msgpack=False)
+
+        index = web_app.WSSubscriptionIndex()
+        ws1 = mock_ws(('riders_points.a', 'riders_predicted'))
+        ws2 = mock_ws(('riders_predicted', 'riders_points.a'))
+        ws3 = mock_ws(('riders_points', ))
+        with index.register(ws1), index.register(ws2), index.register(ws3):
+            key_a = (frozenset(('riders_points.a', 'riders_predicted')), False)
+            key_all = (frozenset(('riders_points', )), False)
+            self.assertEqual({key: list(wss) for key, wss in index.groups.items()}, {key_a: [ws1, ws2], key_all: [ws3]})
+            self.assertEqual(index.rider_groups, {'a': {key_a}})
+
+            index.update_subscriptions(ws1, ['riders_points.b'])
+            key_b = (frozenset(('riders_points.b', )), False)
+            self.assertEqual(ws1.subscriptions, {'riders_points.b'})
+            self.assertEqual({key: list(wss) for key, wss in index.groups.items()},
+                             {key_a: [ws2], key_all: [ws3], key_b: [ws1]})
+            self.assertEqual(index.rider_groups, {'a': {key_a}, 'b': {key_b}})
+
+        self.assertEqual(index.groups, {})
+        self.assertEqual(index.rider_groups, {})
+
+
+class TestWSSendQueue(asynctest.TestCase):
+
+    def batch_msg(self, parts):
+        return web_app.WSBatchMsg(parts, use_msgpack=False)
+
+    async def test_merge_waiting_batch_updates(self):
+        ws = mock_event_ws({})
+        send_continue = asyncio.Event()
+
+        async def send_str(msg):
+            await send_continue.wait()
+        ws.send_str.side_effect = send_str
+
+        ws.send_queue.put('{"first": 1}')
+        await asyncio.sleep(0)
+        # The first message is being sent. These wait, and are merged.
+        ws.send_queue.put(self.batch_msg({'riders_values': {'a': '1', 'b': '1'}, 'riders_points': '{"a": 1}'}))
+        ws.send_queue.put(self.batch_msg({'riders_values': {'a': '2'}, 'riders_predicted': '{"a": 2}'}))
+        ws.send_queue.put(self.batch_msg({'riders_values': {'b': '3'}, 'riders_predicted': '{"a": 3}'}))
+        # This can't be merged, as the waiting message has points.
+        ws.send_queue.put(self.batch_msg({'riders_values': {'a': '4'}, 'riders_points': '{"a": 4}'}))
+        self.assertEqual(len(ws.send_queue.queue), 2)
+
+        send_continue.set()
+        await ws.send_queue.flush()
+        self.assertEqual([call[0][0] for call in ws.send_str.call_args_list], [
+            '{"first": 1}',
+            '{"riders_points": {"a": 1}, "riders_predicted": {"a": 3}, "riders_values": {"a": 2, "b": 3}}',
+            '{"riders_points": {"a": 4}, "riders_values": {"a": 4}}',
+        ])
+        await ws.send_queue.stop()
+
+    async def test_evict_slow_client(self):
+        app = {'exception_recorder': unittest.mock.Mock()}
+        ws = mock_event_ws(app, max_size=2)
+        ws.send_str.side_effect = lambda msg: asyncio.Event().wait()
+
+        with self.assertLogs('trackers.web_app', level=logging.INFO):
+            for i in range(4):
+                ws.send_queue.put(f'{i}')
+                await asyncio.sleep(0)
+
+        self.assertTrue(ws.send_queue.evicted)
+        self.assertEqual(len(ws.send_queue.queue), 0)
+        await asyncio.sleep(0)
+        ws.close.assert_called_once()
+        await ws.send_queue.flush()
+        await ws.send_queue.stop()
+
+
+class TestBlockedListUpdateFromKnown(asynctest.TestCase):
+
+    async def test_blocked_list_update_from_known(self):
+        source = index_and_hash_list([{'x': i} for i in range(300)], 0, hashlib.sha1())
+        tracker = Tracker('test')
+        blocked_list = BlockedList.from_tracker(tracker)
+        await tracker.new_points(source[:200])
+        blocked_list.get_update_from_last()
+        # Points after the last batch update are not included, as the next batch update will send them.
+        await tracker.new_points(source[200:210])
+
+        def update_from_known(known):
+            return web_app.blocked_list_update_from_known(blocked_list, known, max_add_block_len=50)
+
+        self.assertEqual(update_from_known({'index': 199, 'hash': source[199]['hash']}), {})
+        self.assertEqual(update_from_known({'index': 180, 'hash': source[180]['hash']}), {'add_block': source[181:200]})
+        # Too far behind, wrong hash, or no known points get the full list.
+        self.assertEqual(update_from_known({'index': 100, 'hash': source[100]['hash']}), blocked_list.last)
+        self.assertEqual(update_from_known({'index': 180, 'hash': 'abcd'}), blocked_list.last)
+        self.assertEqual(update_from_known({'index': 205, 'hash': source[205]['hash']}), blocked_list.last)
+        self.assertEqual(update_from_known(None), blocked_list.last)
+
+        tracker.completed.set_result(None)
+        await tracker.complete()
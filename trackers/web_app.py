@@ -10,13 +10,12 @@ import logging
 import os
 import re
 from base64 import urlsafe_b64encode
-from collections import defaultdict
+from collections import defaultdict, deque
 from contextlib import asynccontextmanager, suppress
 from datetime import datetime, timezone
 from functools import partial, wraps
-from itertools import groupby
-from operator import itemgetter
 
+import msgpack
 import pkg_resources
 import yaml
 from aiohttp import web, WSCloseCode, WSMsgType
@@ -31,10 +30,12 @@ from trackers.analyse import AnalyseTracker
 from trackers.auth import ensure_authorized_event, get_git_author, get_identity, show_identity
 from trackers.base import cancel_and_wait_task, list_register, Observable
 from trackers.dulwich_helpers import TreeReader, TreeWriter
-from trackers.general import hash_bytes, json_dumps
+from trackers.general import hash_bytes, json_dumps, json_encode
 from trackers.persisted_func_cache import PersistedFuncCache
 from trackers.web_helpers import (
     coro_partial,
+    encoded_body_etag_response,
+    EncodedBodyCache,
     etag_query_hash_response,
     etag_response,
     immutable_cache_control,
@@ -71,6 +72,7 @@ async def make_aio_app(settings,
 
     app['trackers.ws_sessions'] = []
     app['trackers.event_ws_sessions'] = defaultdict(list)
+    app['trackers.event_ws_subscription_index'] = defaultdict(WSSubscriptionIndex)
     app['trackers.individual_trackers'] = {}
     app['exception_recorder'] = exception_recorder
 
@@ -129,8 +131,10 @@ async def make_aio_app(settings,
 
     cache_path = settings['cache_path']
     os.makedirs(cache_path, exist_ok=True)
-    app['svg_marker_cached'] = PersistedFuncCache(os.path.join(cache_path, '1-svg_markers'), trackers.svg_marker.svg_marker)
+    app['svg_marker_cached'] = PersistedFuncCache(
+        os.path.join(cache_path, '1-svg_markers'), trackers.svg_marker.svg_marker, write_in_background=True)
     app['svg_marker_cached'].load()
+    app['trackers.blocked_list_blocks_cache'] = EncodedBodyCache(settings.get('blocked_list_blocks_cache_items', 10000))
 
     app['trackers.app_setup_cm'] = app_setup_cm = await app_setup(app, settings)
     await app_setup_cm.__aenter__()
@@ -164,7 +168,7 @@ async def shutdown(app):
 
     logger.info('Module cleanup')
     await app['trackers.app_setup_cm'].__aexit__(None, None, None)
-    app['svg_marker_cached'].write_unwritten()
+    app['svg_marker_cached'].close()
 
 
 def json_response(data, **kwargs):
@@ -361,6 +365,14 @@ def compress_point(point):
     return {point_keys.get(key, key): value for key, value in point.items()}
 
 
+def compress_blocked_list_update(update):
+    compressed = dict(update)
+    for key in ('partial_block', 'add_block'):
+        if key in update:
+            compressed[key] = [compress_point(point) for point in update[key]]
+    return compressed
+
+
 @say_error_handler
 @event_handler
 async def blocked_lists(request, event, list_attr_name):
@@ -384,13 +396,21 @@ async def blocked_lists(request, event, list_attr_name):
 
         rider_objects = event.riders_objects[rider_name]
         list = getattr(rider_objects, list_attr_name)
-        source = list.get_source()
-        points = source[start_index:end_index + 1]
-        if points and points[-1]['hash'] != end_hash:
-            raise web.HTTPInternalServerError(text='Wrong end_hash')
 
-        return etag_response(request, json_response(points), end_hash,
-                             cache_control=immutable_cache_control)
+        def get_body():
+            source = list.get_source()
+            points = source[start_index:end_index + 1]
+            if not points or points[-1]['hash'] != end_hash:
+                raise web.HTTPInternalServerError(text='Wrong end_hash')
+            return json_dumps(points).encode()
+
+        # A block with an end_hash never changes, so it's encoded once, and served from the cache after that.
+        # start_index is part of the key, as a smaller block, and the bigger block it became part of have the same end.
+        key = (event.name, rider_name, list_attr_name, start_index, end_hash)
+        encoded = request.app['trackers.blocked_list_blocks_cache'].get(key, get_body)
+
+        return await encoded_body_etag_response(request, encoded, end_hash, cache_control=immutable_cache_control,
+                                                content_type='application/json', charset='utf-8')
 
 
 @say_error_handler
@@ -536,11 +556,210 @@ async def on_event_rider_blocked_list_update(key, event, rider_name, blocked_lis
     )
 
 
-def group_wss_by_subscriptions(wss):
-    with_hashable = ((tuple(sorted(ws.subscriptions)), ws) for ws in wss)
-    key = itemgetter(0)
-    for subscriptions, group in groupby(sorted(with_hashable, key=key), key=key):
-        yield subscriptions, tuple(ws for _, ws in group)
+def json_join_object(encoded_items):
+    """
+    Returns the json of an object, from (key, encoded json value) pairs. Same as json_dumps of the object with the
+    values not encoded.
+    """
+    return '{' + ', '.join(f'{json_dumps(key)}: {encoded}' for key, encoded in sorted(encoded_items)) + '}'
+
+
+msgpack_dumps = partial(msgpack.packb, default=json_encode, use_bin_type=True)
+
+
+def msgpack_join_map(encoded_items):
+    """Returns the msgpack of a map, from (key, encoded msgpack value) pairs."""
+    encoded_items = sorted(encoded_items)
+    packer = msgpack.Packer(use_bin_type=True)
+    return b''.join([packer.pack_map_header(len(encoded_items))] +
+                    [packer.pack(key) + encoded for key, encoded in encoded_items])
+
+
+# Clients that use the msgpack websocket protocol get binary msgpack messages, with the keys of points shortened, as
+# with compress_point. Other clients get json text messages.
+ws_msgpack_protocol = 'trackers.msgpack'
+blocked_list_msg_keys = ('riders_points', 'riders_off_route', 'riders_pre_post')
+ws_dumps = {False: json_dumps, True: msgpack_dumps}
+ws_join = {False: json_join_object, True: msgpack_join_map}
+
+
+def msgpack_ws_msg(msg):
+    return {
+        key: {rider_name: compress_blocked_list_update(update) for rider_name, update in value.items()}
+        if key in blocked_list_msg_keys else value
+        for key, value in msg.items()
+    }
+
+
+def encode_ws_msg(msg, use_msgpack):
+    if use_msgpack:
+        return msgpack_dumps(msgpack_ws_msg(msg))
+    return json_dumps(msg)
+
+
+class WSBatchMsg(object):
+    """
+    An encoded batch update, that, while it is waiting to be sent, can be merged with a later batch update, so that
+    only the latest values are sent.
+    """
+
+    # Parts that are a value per rider, encoded per rider, where later values replace earlier values.
+    riders_values_keys = ('riders_values', 'riders_pre_post_values')
+    # Parts that are replaced by later parts.
+    replace_keys = ('riders_predicted', )
+
+    def __init__(self, parts, use_msgpack):
+        self.parts = parts
+        self.use_msgpack = use_msgpack
+        self._encoded = None
+
+    def merge(self, later):
+        """Returns the merge of this, and a later batch update, or None if they can't be merged."""
+        mergeable_keys = self.riders_values_keys + self.replace_keys
+        if (
+            later.use_msgpack != self.use_msgpack or
+            any(key not in mergeable_keys for key in self.parts) and any(key not in mergeable_keys for key in later.parts)
+        ):
+            # Both have blocked list updates, which need to be sent in order.
+            return None
+        parts = dict(self.parts)
+        for key, value in later.parts.items():
+            if key in self.riders_values_keys and key in parts:
+                parts[key] = {**parts[key], **value}
+            else:
+                parts[key] = value
+        return WSBatchMsg(parts, self.use_msgpack)
+
+    def encoded(self):
+        # Cached, as the same message is sent to all websockets with the same subscriptions.
+        if self._encoded is None:
+            join = ws_join[self.use_msgpack]
+            self._encoded = join(
+                (key, join(value.items()) if key in self.riders_values_keys else value)
+                for key, value in self.parts.items()
+            )
+        return self._encoded
+
+
+class WSSendQueue(object):
+    """
+    Messages waiting to be sent to a websocket. They are sent by a task per websocket, so that a slow client does not
+    hold up sending to other clients. If a client is so slow that max_size messages are waiting, it is disconnected.
+    """
+
+    def __init__(self, app, ws, max_size=20):
+        self.app = app
+        self.ws = ws
+        self.max_size = max_size
+        self.queue = deque()
+        self.queue_changed = asyncio.Event()
+        self.all_sent = asyncio.Event()
+        self.all_sent.set()
+        self.evicted = False
+        self.task = asyncio.ensure_future(self.send_loop())
+
+    def put(self, msg):
+        """Queue msg to be sent. msg is encoded, or a WSBatchMsg."""
+        if self.evicted:
+            return
+        if isinstance(msg, WSBatchMsg) and self.queue and isinstance(self.queue[-1], WSBatchMsg):
+            merged = self.queue[-1].merge(msg)
+            if merged is not None:
+                self.queue[-1] = merged
+                return
+        if len(self.queue) >= self.max_size:
+            self.evict()
+            return
+        self.queue.append(msg)
+        self.queue_changed.set()
+        self.all_sent.clear()
+
+    async def send_loop(self):
+        ws = self.ws
+        while True:
+            await self.queue_changed.wait()
+            self.queue_changed.clear()
+            while self.queue and not ws.closed:
+                msg = self.queue.popleft()
+                encoded = msg.encoded() if isinstance(msg, WSBatchMsg) else msg
+                try:
+                    if ws.msgpack:
+                        await ws.send_bytes(encoded)
+                    else:
+                        await ws.send_str(encoded)
+                except Exception:
+                    self.app['exception_recorder']()
+                    logger.exception('Error sending msg to ws:')
+            self.all_sent.set()
+
+    async def flush(self):
+        """Wait for the messages that are queued to be sent."""
+        if not self.evicted:
+            await self.all_sent.wait()
+
+    def evict(self):
+        logger.info(f'Disconnecting slow websocket client, with {len(self.queue)} messages waiting.')
+        self.evicted = True
+        self.queue.clear()
+        self.all_sent.set()
+        self.task.cancel()
+        asyncio.ensure_future(self.ws.close(code=WSCloseCode.TRY_AGAIN_LATER, message=b'Too slow receiving messages.'))
+
+    async def stop(self):
+        await cancel_and_wait_task(self.task)
+
+
+class WSSubscriptionIndex(object):
+    """
+    An event's websockets, grouped by their subscriptions and protocol, kept up to date as clients connect, disconnect
+    and change their subscriptions, so that batch updates don't have to group all the websockets each time.
+    """
+
+    def __init__(self):
+        # (frozenset of subscriptions, msgpack) to the websockets in the group. (dict used as an ordered set.)
+        self.groups = {}
+        # Rider name to the keys of the groups subscribed to riders_points.{rider_name}.
+        self.rider_groups = defaultdict(set)
+
+    def add(self, ws):
+        key = ws.subscription_group_key = (frozenset(ws.subscriptions), ws.msgpack)
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = {}
+            for rider_name in self.subscribed_rider_names(key):
+                self.rider_groups[rider_name].add(key)
+        group[ws] = None
+
+    def remove(self, ws):
+        key = ws.subscription_group_key
+        group = self.groups[key]
+        del group[ws]
+        if not group:
+            del self.groups[key]
+            for rider_name in self.subscribed_rider_names(key):
+                rider_groups = self.rider_groups[rider_name]
+                rider_groups.discard(key)
+                if not rider_groups:
+                    del self.rider_groups[rider_name]
+
+    def update_subscriptions(self, ws, subscriptions):
+        self.remove(ws)
+        ws.subscriptions = set(subscriptions)
+        self.add(ws)
+
+    @contextlib.contextmanager
+    def register(self, ws):
+        self.add(ws)
+        try:
+            yield
+        finally:
+            self.remove(ws)
+
+    @staticmethod
+    def subscribed_rider_names(key):
+        subscriptions, _ = key
+        return [subscription[len('riders_points.'):] for subscription in subscriptions
+                if subscription.startswith('riders_points.')]
 
 
 async def on_event_batch_update(event, time, riders_updated, riders_off_route_updated, riders_pre_post_updated):
@@ -564,52 +783,125 @@ async def on_event_batch_update(event, time, riders_updated, riders_off_route_up
     if logger.isEnabledFor(logging.DEBUG):
         logger.debug(f'send bulk_update: {json_dumps(update)[:1000]}')
 
-    for subscriptions, wss in group_wss_by_subscriptions(event.app['trackers.event_ws_sessions'][event.name]):
-        filtered_update = {
-            'riders_values': update['riders_values'],
+    # Each part of the update is encoded at most once per protocol, and the message for each group of subscriptions
+    # is made from the encoded parts.
+    encoded_parts = {}
+
+    def encoded_part(key, use_msgpack):
+        try:
+            return encoded_parts[key, use_msgpack]
+        except KeyError:
+            if key == 'riders_points':
+                # Joined from the riders' encoded points, which are also used for subscriptions to single riders.
+                encoded = ws_join[use_msgpack](encoded_riders(key, update[key], use_msgpack))
+                encoded_parts[key, use_msgpack] = encoded
+                return encoded
+            value = update[key]
+            if use_msgpack and key in blocked_list_msg_keys:
+                value = {rider_name: compress_blocked_list_update(rider_update) for rider_name, rider_update in value.items()}
+            encoded = encoded_parts[key, use_msgpack] = ws_dumps[use_msgpack](value)
+            return encoded
+
+    encoded_rider_parts = {}
+
+    def encoded_riders(key, rider_names, use_msgpack):
+        for rider_name in rider_names:
+            try:
+                yield rider_name, encoded_rider_parts[key, rider_name, use_msgpack]
+            except KeyError:
+                value = update[key][rider_name]
+                if use_msgpack and key in blocked_list_msg_keys:
+                    value = compress_blocked_list_update(value)
+                encoded = encoded_rider_parts[key, rider_name, use_msgpack] = ws_dumps[use_msgpack](value)
+                yield rider_name, encoded
+
+    subscription_index = event.app['trackers.event_ws_subscription_index'][event.name]
+    for group_key, wss in subscription_index.groups.items():
+        subscriptions, use_msgpack = group_key
+        part = partial(encoded_part, use_msgpack=use_msgpack)
+        riders_part = partial(encoded_riders, use_msgpack=use_msgpack)
+        # riders_values, and riders_pre_post_values are kept encoded per rider, so that they can be merged with a later
+        # update, if this has not been sent yet, see WSBatchMsg.
+        parts = {
+            'riders_values': dict(riders_part('riders_values', update['riders_values'])),
         }
         if update.get('riders_points'):
             if 'riders_points' in subscriptions:
-                filtered_update['riders_points'] = update['riders_points']
+                parts['riders_points'] = part('riders_points')
             else:
-                filtered_rider_points = {rider_name: points for rider_name, points in update['riders_points'].items()
-                                         if f'riders_points.{rider_name}' in subscriptions}
-                if filtered_rider_points:
-                    filtered_update['riders_points'] = filtered_rider_points
+                filtered_rider_names = [rider_name for rider_name in update['riders_points']
+                                        if group_key in subscription_index.rider_groups.get(rider_name, ())]
+                if filtered_rider_names:
+                    parts['riders_points'] = ws_join[use_msgpack](riders_part('riders_points', filtered_rider_names))
 
         if 'riders_predicted' in subscriptions:
-            filtered_update['riders_predicted'] = update['riders_predicted']
+            parts['riders_predicted'] = part('riders_predicted')
 
         if 'riders_pre_post' in subscriptions:
-            filtered_update['riders_pre_post_values'] = update['riders_pre_post_values']
+            parts['riders_pre_post_values'] = dict(riders_part('riders_pre_post_values', update['riders_pre_post_values']))
             if update.get('riders_pre_post'):
-                filtered_update['riders_pre_post'] = update['riders_pre_post']
+                parts['riders_pre_post'] = part('riders_pre_post')
 
         if update.get('riders_off_route') and 'riders_off_route' in subscriptions:
-            filtered_update['riders_off_route'] = update['riders_off_route']
-
-        msg = json_dumps(filtered_update)
-        futures = [asyncio.ensure_future(ws.send_str(msg)) for ws in wss]
-        await asyncio.wait(futures)
-        for fut in futures:
-            try:
-                fut.result()
-            except Exception:
-                event.app['exception_recorder']()
-                logger.exception('Error sending msg to ws:')
-
-
-def get_rider_blocked_list(event, list_name):
-    unfiltered = (
-        (rider_objects.rider_name, getattr(rider_objects, list_name))
-        for rider_objects in event.riders_objects.values())
-    return ((rider_name, list.full) for rider_name, list in unfiltered if list)
+            parts['riders_off_route'] = part('riders_off_route')
+
+        msg = WSBatchMsg(parts, use_msgpack)
+        for ws in wss:
+            if not ws.closed:
+                ws.send_queue.put(msg)
+
+
+def blocked_list_len(blocked_list_full):
+    blocks = blocked_list_full['blocks']
+    return (blocks[-1]['end_index'] + 1 if blocks else 0) + len(blocked_list_full['partial_block'])
+
+
+def blocked_list_update_from_known(blocked_list, known, max_add_block_len=128):
+    """
+    Returns the update that brings a client that has the points of blocked_list up to known['index'], the last with
+    hash known['hash'], e.g. from before it reconnected, up to blocked_list.last. The next batch update carries on
+    from there.
+
+    If the client's points don't match, or it is missing a lot of points, this is the full list, for which the client
+    only needs to fetch the blocks it does not have.
+    """
+    last = blocked_list.last
+    if isinstance(known, dict):
+        index = known.get('index')
+        last_len = blocked_list_len(last)
+        if isinstance(index, int) and 0 <= index < last_len and last_len - index - 1 <= max_add_block_len:
+            source = blocked_list.get_source()
+            if index < len(source) and source[index]['hash'] == known.get('hash'):
+                add_block = list(source[index + 1:last_len])
+                return {'add_block': add_block} if add_block else {}
+    return last
+
+
+def get_rider_blocked_list(event, list_name, known=None, filter_rider=None):
+    """
+    Yields the update for the blocked list of each rider, for a client that has just subscribed. known is
+    {rider_name: {'index': ..., 'hash': ...}} of the last point the client has of each rider.
+    """
+    if not isinstance(known, dict):
+        known = {}
+    for rider_objects in event.riders_objects.values():
+        rider_name = rider_objects.rider_name
+        blocked_list = getattr(rider_objects, list_name)
+        if blocked_list and (filter_rider is None or filter_rider(rider_name)):
+            update = blocked_list_update_from_known(blocked_list, known.get(rider_name))
+            if update:
+                yield rider_name, update
 
 
 async def event_ws(request):
-    ws = web.WebSocketResponse()
+    ws = web.WebSocketResponse(
+        protocols=(ws_msgpack_protocol, ),
+        compress=request.app['trackers.settings'].get('event_ws_compress', True),
+    )
     ws.subscriptions = set()
     await ws.prepare(request)
+    ws.msgpack = ws.ws_protocol == ws_msgpack_protocol
+    ws.send_queue = WSSendQueue(request.app, ws, request.app['trackers.settings'].get('event_ws_send_queue_size', 20))
     with contextlib.ExitStack() as exit_stack:
         try:
             exit_stack.enter_context(list_register(request.app['trackers.ws_sessions'], ws))
@@ -620,11 +912,13 @@ async def event_ws(request):
             event_name = request.match_info['event']
             event = request.app['trackers.events'].get(event_name)
             if event is None:
+                await ws.send_queue.flush()
                 await ws.close(message='Error: Event not found.')
                 return ws
 
             if not event.config.get('live', False):
                 await send({'live': False})
+                await ws.send_queue.flush()
                 await ws.close(message='Event not live. Use rest api')
                 return ws
 
@@ -633,35 +927,44 @@ async def event_ws(request):
             state = await get_event_state(request.app, event)
             await send(state)
             exit_stack.enter_context(list_register(request.app['trackers.event_ws_sessions'][event_name], ws))
+            exit_stack.enter_context(event.subscriber())
+            subscription_index = request.app['trackers.event_ws_subscription_index'][event_name]
+            exit_stack.enter_context(subscription_index.register(ws))
 
             async for msg in ws:
-                if msg.type == WSMsgType.text:
+                if msg.type in (WSMsgType.text, WSMsgType.binary):
                     try:
                         logger.debug('receive: {}'.format(msg.data))
-                        data = json.loads(msg.data)
+                        if msg.type == WSMsgType.binary:
+                            data = msgpack.loads(msg.data, raw=False)
+                        else:
+                            data = json.loads(msg.data)
                         if 'subscriptions' in data:
                             old_subscriptions = ws.subscriptions
-                            ws.subscriptions = set(data['subscriptions'])
+                            subscription_index.update_subscriptions(ws, data['subscriptions'])
                             added_subscriptions = ws.subscriptions - old_subscriptions
+                            # The last point the client has of each rider's lists, so that only what it's missing is sent.
+                            known = data.get('known')
+                            if not isinstance(known, dict):
+                                known = {}
                             if 'riders_points' in added_subscriptions:
-                                await send({'riders_points': {rider_name: list_full
-                                                              for rider_name, list_full in get_rider_blocked_list(event, 'blocked_list')}})
+                                riders_points = dict(get_rider_blocked_list(event, 'blocked_list', known.get('riders_points')))
                             else:
-                                selected_rider_points = {rider_name: list_full
-                                                         for rider_name, list_full in get_rider_blocked_list(event, 'blocked_list')
-                                                         if f'riders_points.{rider_name}' in added_subscriptions}
-                                if selected_rider_points:
-                                    await send({'riders_points': selected_rider_points})
+                                riders_points = dict(get_rider_blocked_list(
+                                    event, 'blocked_list', known.get('riders_points'),
+                                    filter_rider=lambda rider_name: f'riders_points.{rider_name}' in added_subscriptions))
+                            if riders_points:
+                                await send({'riders_points': riders_points})
 
                             if 'riders_off_route' in added_subscriptions:
-                                await send({'riders_off_route': {rider_name: list_full
-                                                                 for rider_name, list_full in get_rider_blocked_list(event, 'off_route_blocked_list')}})
+                                riders_off_route = dict(get_rider_blocked_list(event, 'off_route_blocked_list', known.get('riders_off_route')))
+                                if riders_off_route:
+                                    await send({'riders_off_route': riders_off_route})
 
                             if 'riders_pre_post' in added_subscriptions:
                                 await send({
                                     'riders_pre_post_values': getattr(event, 'riders_pre_post_values', {}),
-                                    'riders_pre_post': {rider_name: list_full
-                                                        for rider_name, list_full in get_rider_blocked_list(event, 'pre_post_blocked_list')}
+                                    'riders_pre_post': dict(get_rider_blocked_list(event, 'pre_post_blocked_list', known.get('riders_pre_post'))),
                                 })
 
                             if 'riders_predicted' in added_subscriptions:
@@ -682,24 +985,20 @@ async def event_ws(request):
             await ws.close(message='Server Error: {}'.format(e))
             logger.exception('Error in event_ws: ')
         finally:
+            await ws.send_queue.stop()
             return ws
 
 
 async def message_to_multiple_wss(app, wss, msg, log_level=logging.DEBUG, filter_ws=None):
-    msg = json_dumps(msg)
     filtered_wss = [ws for ws in wss if (filter_ws(ws) if filter_ws else True) and not ws.closed]
 
     if logger.isEnabledFor(log_level):
-        logger.log(log_level, f'send to {len(filtered_wss)}: {msg[:1000]}')
-    if filtered_wss:
-        futures = [asyncio.ensure_future(ws.send_str(msg)) for ws in filtered_wss]
-        await asyncio.wait(futures)
-        for fut in futures:
-            try:
-                fut.result()
-            except Exception:
-                app['exception_recorder']()
-                logger.exception('Error sending msg to ws:')
+        logger.log(log_level, f'send to {len(filtered_wss)}: {json_dumps(msg)[:1000]}')
+    encoded = {}
+    for ws in filtered_wss:
+        if ws.msgpack not in encoded:
+            encoded[ws.msgpack] = encode_ws_msg(msg, ws.msgpack)
+        ws.send_queue.put(encoded[ws.msgpack])
 
 
 @say_error_handler
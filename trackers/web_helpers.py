@@ -1,10 +1,11 @@
 import asyncio
 import base64
+import gzip
 import hashlib
 import logging
 import mimetypes
 import os.path
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from contextlib import closing, suppress
 from copy import copy
 from functools import partial
@@ -17,6 +18,11 @@ from slugify import slugify
 
 from trackers.base import cancel_and_wait_task, Observable
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 immutable_cache_control = 'public,max-age=31536000,immutable'
 mutable_cache_control = 'public'
 
@@ -46,6 +52,92 @@ def etag_query_hash_response(request, response, etag):
         return etag_response(request, response, etag, cache_control=cache_control)
 
 
+class EncodedBody(object):
+    """
+    A body, and the body compressed with each content encoding. The compressed bodies are only made when first
+    requested, in an executor, so that compressing does not block the event loop.
+    """
+
+    compressors = {
+        'gzip': partial(gzip.compress, compresslevel=6),
+        # The default quality of 11 is very slow. 5 is close to gzip's speed, and still smaller.
+        'br': partial(brotli.compress, quality=5) if brotli else None,
+    }
+
+    def __init__(self, identity):
+        self.bodies = {'identity': identity}
+
+    @property
+    def identity(self):
+        return self.bodies['identity']
+
+    async def get(self, encoding):
+        try:
+            return self.bodies[encoding]
+        except KeyError:
+            body = await asyncio.get_event_loop().run_in_executor(None, self.compressors[encoding], self.identity)
+            self.bodies[encoding] = body
+            return body
+
+
+def accepted_encodings(request):
+    encodings = set()
+    for item in request.headers.get('Accept-Encoding', '').split(','):
+        encoding, _, params = item.partition(';')
+        if params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            encodings.add(encoding.strip().lower())
+    return encodings
+
+
+def preferred_encoding(request):
+    """Returns the content encoding, of those EncodedBody supports, that gives the smallest body the client accepts."""
+    encodings = accepted_encodings(request)
+    if brotli and 'br' in encodings:
+        return 'br'
+    if 'gzip' in encodings:
+        return 'gzip'
+    return 'identity'
+
+
+async def encoded_body_etag_response(request, encoded, etag, cache_control=None, **kwargs):
+    """
+    Returns an etag_response of encoded, in the preferred encoding of the client. The ETag varies with the encoding,
+    as the body does. The body is only compressed if the client does not have it already.
+    """
+    encoding = preferred_encoding(request)
+    headers = {'Vary': 'Accept-Encoding'}
+    if encoding != 'identity':
+        etag = f'{etag}-{encoding}'
+        headers['Content-Encoding'] = encoding
+    if request.headers.get('If-None-Match', '') == etag:
+        response = None
+    else:
+        response = Response(body=await encoded.get(encoding), headers=headers, **kwargs)
+    return etag_response(request, response, etag, cache_control=cache_control)
+
+
+class EncodedBodyCache(object):
+    """
+    Least recently used cache of EncodedBody, for responses that don't change, so that they only get encoded and
+    compressed once.
+    """
+
+    def __init__(self, max_items=10000):
+        self.max_items = max_items
+        self.cache = OrderedDict()
+
+    def get(self, key, get_body):
+        try:
+            encoded = self.cache[key]
+        except KeyError:
+            encoded = self.cache[key] = EncodedBody(get_body())
+            if len(self.cache) > self.max_items:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(key)
+        return encoded
+
+
 def coro_partial(func, *args, **keywords):
     """ Creates partial that pretends to be a coroutine if the func is a coroutine. """
     p = partial(func, *args, **keywords)